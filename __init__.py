@@ -1,4 +1,5 @@
 __all__=[
+    "arraystore",
     "autopyscf",
     "average_tools",
     "bundler",
@@ -8,15 +9,25 @@ __all__=[
     "crystal",
     "crystalrunner",
     "dmc",
+    "executor",
+    "forkpool",
     "linear",
     "manager",
+    "orbfile",
+    "planner",
     "postprocess",
     "propertiesreader",
     "pyscf2qwalk",
     "qwalkrunner",
     "runner",
+    "runtimedb",
+    "schedulers",
     "paths",
+    "stagechain",
+    "statestore",
     "submitter",
+    "taskfarm",
     "trialfunc",
     "variance",
+    "workflow",
   ]
@@ -0,0 +1,166 @@
+''' Keep large arrays from reader outputs out of the managers' saved state.
+
+`offload` moves the large numerical arrays in an output dictionary into a sidecar npz file
+and replaces them with `LazyArray` handles. A handle only holds the file, key, shape,
+dtype, and a digest of the data, so the manager pickle (and the memory of a manager that's
+reloaded on every `recover`) doesn't grow with the system size. The data is read from the
+sidecar the first time it's used (`handle.load()`, `np.asarray(handle)`, or `handle[index]`) and
+kept on the handle, read-only, until the handle is pickled.
+`materialize` loads every handle in a nested output, for code that needs plain data.
+'''
+import os
+import hashlib
+import numpy as np
+
+# Arrays smaller than this (in bytes) are left in the output.
+offload_bytes=4096
+
+#######################################################################
+class LazyArray:
+  ''' Handle to an array saved in a npz file. The data is read once, and isn't pickled with the handle.'''
+  def __init__(self,fname,key,shape,dtype,digest,aslist=False):
+    '''
+    Args:
+      fname (str): absolute path to the npz file.
+      key (str): name of the array in the file.
+      shape (tuple): shape of the array.
+      dtype (str): numpy dtype of the array.
+      digest (str): sha1 of the array, used to compare without loading.
+      aslist (bool): the original data was a (nested) list, so `load` returns a list.
+    '''
+    self.fname=fname
+    self.key=key
+    self.shape=tuple(shape)
+    self.dtype=np.dtype(dtype)
+    self.digest=digest
+    self.aslist=aslist
+    self._data=None
+
+  #------------------------------------------------
+  def __getstate__(self):
+    state=dict(self.__dict__)
+    state['_data']=None
+    return state
+
+  def __setstate__(self,state):
+    self.__dict__.update(state)
+    self.__dict__.setdefault('_data',None)
+
+  #------------------------------------------------
+  def _array(self):
+    ''' The data as a read-only array, read from the sidecar file on first use.'''
+    if self._data is None:
+      with np.load(self.fname) as data:
+        value=data[self.key]
+      value.flags.writeable=False
+      self._data=value
+    return self._data
+
+  #------------------------------------------------
+  def load(self):
+    ''' The data (read-only), or a list of it if the original data was a list.'''
+    if self.aslist:
+      return self._array().tolist()
+    return self._array()
+
+  #------------------------------------------------
+  def __array__(self,dtype=None,copy=None):
+    value=self._array()
+    if dtype is not None:
+      value=value.astype(dtype)
+    return value
+
+  #------------------------------------------------
+  def __getitem__(self,index):
+    return self._array()[index]
+
+  #------------------------------------------------
+  def __len__(self):
+    return self.shape[0]
+
+  #------------------------------------------------
+  @property
+  def nbytes(self):
+    return int(np.prod(self.shape))*self.dtype.itemsize
+
+  #------------------------------------------------
+  def __eq__(self,other):
+    if not isinstance(other,LazyArray):
+      return NotImplemented
+    return self.digest==other.digest and self.shape==other.shape and self.dtype==other.dtype
+
+  def __ne__(self,other):
+    equal=self.__eq__(other)
+    if equal is NotImplemented: return equal
+    return not equal
+
+  __hash__=None
+
+  #------------------------------------------------
+  def __repr__(self):
+    return "LazyArray(%s[%s], shape=%s, dtype=%s)"%(self.fname,self.key,self.shape,self.dtype)
+
+#######################################################################
+def _numeric_array(value,minbytes):
+  ''' Array version of value if it's a numerical array or nested list large enough to offload, else None.'''
+  if isinstance(value,np.ndarray):
+    array=value
+  elif isinstance(value,list) and len(value)>0:
+    try:
+      array=np.asarray(value)
+    except ValueError:
+      # Ragged lists.
+      return None
+  else:
+    return None
+  if array.dtype.kind not in 'biufc' or array.nbytes<minbytes:
+    return None
+  return array
+
+#######################################################################
+def offload(output,fname,minbytes=None):
+  ''' Write the large arrays in output to fname and replace them by LazyArray handles.
+
+  Args:
+    output (dict): nested dictionary of results, as in `reader.output`.
+    fname (str): npz file to write. It's overwritten.
+    minbytes (int): smallest array to offload (None implies `offload_bytes`).
+  Returns:
+    dict: copy of output with the large arrays replaced.
+  '''
+  if minbytes is None: minbytes=offload_bytes
+  fname=os.path.abspath(fname)
+  arrays={}
+
+  def _replace(value,key):
+    if isinstance(value,dict):
+      return dict([(k,_replace(v,"%s/%s"%(key,k))) for k,v in value.items()])
+    array=_numeric_array(value,minbytes)
+    if array is None:
+      if isinstance(value,(list,tuple)):
+        return type(value)([_replace(v,"%s/%d"%(key,i)) for i,v in enumerate(value)])
+      return value
+    array=np.ascontiguousarray(array)
+    arrays[key]=array
+    return LazyArray(fname,key,array.shape,array.dtype.str,
+        hashlib.sha1(array.data).hexdigest(),aslist=isinstance(value,list))
+
+  newoutput=_replace(output,'')
+
+  # Write then rename, so handles never point to a partially written file.
+  if len(arrays)>0:
+    with open(fname+'.tmp','wb') as outf:
+      np.savez(outf,**arrays)
+    os.replace(fname+'.tmp',fname)
+  return newoutput
+
+#######################################################################
+def materialize(value):
+  ''' Copy of value (nested dicts and lists) with every LazyArray loaded.'''
+  if isinstance(value,LazyArray):
+    return value.load()
+  elif isinstance(value,dict):
+    return dict([(k,materialize(v)) for k,v in value.items()])
+  elif isinstance(value,(list,tuple)):
+    return type(value)([materialize(v) for v in value])
+  return value
@@ -5,6 +5,7 @@ from pymatgen.io.cif import CifParser
 import pyscf
 from pyscf.scf.uhf import UHF,mulliken_meta
 from copy import deepcopy
+from arraystore import offload
 
 
 ####################################################
@@ -88,7 +89,7 @@ class PySCFWriter:
   #-----------------------------------------------
   def pyscf_input(self,fname,chkfile):
     f=open(fname,'w')
-    restart_fname = 'restart_'+fname
+    restart_fname = os.path.join(os.path.dirname(fname),'restart_'+os.path.basename(fname))
     re_f = open(restart_fname, 'w')
     add_paths=[]
 
@@ -293,7 +294,7 @@ class PySCFPBCWriter:
       
   def pyscf_input(self,fname,chkfile):
     f=open(fname,'w')
-    restart_fname = 'restart_'+fname
+    restart_fname = os.path.join(os.path.dirname(fname),'restart_'+os.path.basename(fname))
     re_f = open(restart_fname, 'w')
     add_paths=[]
 
@@ -423,7 +424,8 @@ class PySCFReader:
     for line in reversed(lines):
       if "converged SCF energy" in line: 
         converged=True
-        self.output.update(self.read_chkfile(chkfile))
+        # Large arrays go to a sidecar file so they aren't carried in the manager's state.
+        self.output.update(offload(self.read_chkfile(chkfile),outfile+'.npz'))
         self.output['chkfile']=chkfile
         self.output['conversion']=[]
         break
@@ -5,23 +5,47 @@ import numpy as np
 import subprocess as sub
 import shutil
 import submitter
+from schedulers import PBSScheduler,SlurmScheduler
 
 # TODO organize with inheritance.
 
 ####################################################
 class RunnerLocal:
-  ''' Object that can accumulate jobs to run and run them together locally.'''
-  def __init__(self,np='allprocs',nn=1):
+  ''' Object that can accumulate jobs to run and run them together locally.
+
+  Jobs run in the background on the cores of `submitter.local_pool`, so many small jobs can run at once.
+  Each submission takes nn*np cores (all of the pool's cores with np='allprocs'), and its
+  status is 'running' until it finishes, like a queued job. To change the number of cores,
+  replace the pool, e.g. `submitter.local_pool=submitter.LocalPool(ncores=16)`.
+  Started jobs keep running, and are still seen as running, after the driver script exits.
+  '''
+  def __init__(self,np='allprocs',nn=1,prefix=None,postfix=None):
     ''' Note: exelines are prefixed by appropriate mpirun commands.'''
 
     self.exelines=[]
     self.np=np
     self.nn=nn
     self.jobname='none, this runs with out queueing.'
+    if prefix is None: self.prefix=[]
+    else:              self.prefix=prefix
+    if postfix is None: self.postfix=[]
+    else:               self.postfix=postfix
+    self.queueid=[]
+
+  #-------------------------------------
+  def ncores(self):
+    ''' Cores used by each submission.'''
+    if self.np=='allprocs': return None
+    return self.nn*self.np
 
   #-------------------------------------
   def check_status(self):
-    return 'done'
+    return submitter.local_pool.status(self.queueid)
+
+  #-------------------------------------
+  def cancel(self):
+    ''' Stop this runner's jobs.'''
+    submitter.local_pool.cancel(self.queueid)
 
   #-------------------------------------
   def add_task(self,exestr):
@@ -52,27 +76,28 @@ class RunnerLocal:
       return False
 
     with open(scriptfile,'w') as outf:
-      outf.write('\n'.join(self.prefix + exelines + self.postfix))
+      outf.write('\n'.join(self.prefix + self.exelines + self.postfix))
 
     # Remove exelines so the runner is ready for the next go.
     self.exelines=[]
     return True
 
   #-------------------------------------
-  def submit(self,jobname=None):
-    ''' Submit series of commands.'''
+  def submit(self,jobname=None,cwd=None):
+    ''' Start the series of commands in the background.
+    Args:
+      jobname (str): not used, since nothing is queued.
+      cwd (str): directory to run in (None implies the current directory).
+    '''
     if jobname is None:
       jobname=self.jobname
 
     if len(self.exelines)==0:
       return ''
     
-    try:
-      for line in self.exelines:
-        result = sub.check_output(line,shell=True)
-        print(self.__class__.__name__,": executed %s"%line)
-    except sub.CalledProcessError as err:
-      print(self.__class__.__name__,": Error: {0}".format(err))
+    queueid=submitter.local_pool.submit(self.prefix+self.exelines+self.postfix,self.ncores(),cwd=cwd)
+    self.queueid.append(queueid)
+    print(self.__class__.__name__,": Started as %s"%queueid)
 
     # Remove exelines so the runner is ready for the next go.
     self.exelines=[]
@@ -86,9 +111,17 @@ class RunnerPBS:
                     jobname='AGRunner',
                     np='allprocs',nn=1,
                     prefix=None,
-                    postfix=None
+                    postfix=None,
+                    scheduler=None,
+                    autosize=None,
+                    priority=0
                     ):
-    ''' Note: exelines are prefixed by appropriate mpirun commands.'''
+    ''' Note: exelines are prefixed by appropriate mpirun commands.
+    scheduler (scheduler object): queueing system to submit to (None implies PBS). See `schedulers.py`.
+    autosize (dict): if set, choose nn and walltime from previous runtimes before each submission.
+      Options are passed to `runtimedb.RuntimeDB.suggest`, e.g. {'margin':0.5,'maxnodes':4}.
+    priority (float): order of submission when `submitter.governor` holds jobs back (higher goes first).
+      `Workflow` sets this from the dependency graph.'''
 
     # Good prefix choices (Blue Waters).
     # These are needed for Crystal runs.
@@ -107,11 +140,20 @@ class RunnerPBS:
     else:              self.prefix=prefix
     if postfix is None: self.postfix=[]
     else:               self.postfix=postfix
+    if scheduler is None: self.scheduler=PBSScheduler()
+    else:                 self.scheduler=scheduler
+    self.autosize=autosize
+    self.priority=priority
     self.queueid=[]
 
   #-------------------------------------
   def check_status(self):
-    return submitter.check_PBS_stati(self.queueid)
+    return submitter.governor.status(self.scheduler,self.queueid)
+
+  #-------------------------------------
+  def cancel(self):
+    ''' Remove this runner's jobs from the queue.'''
+    submitter.governor.cancel(self.scheduler,self.queueid)
 
   def add_command(self,cmdstr):
     ''' Accumulate commands that don't get an MPI command.
@@ -141,52 +183,59 @@ class RunnerPBS:
       return False
 
     with open(scriptfile,'w') as outf:
-      outf.write('\n'.join(self.prefix + exelines + self.postfix))
+      outf.write('\n'.join(self.prefix + self.exelines + self.postfix))
 
     # Remove exelines so the runner is ready for the next go.
     self.exelines=[]
     return True
 
   #-------------------------------------
-  def submit(self,jobname=None):
-    ''' Submit series of commands.'''
+  def submit(self,jobname=None,cwd=None):
+    ''' Submit series of commands.
+    Args:
+      jobname (str): name to appear in the queue.
+      cwd (str): directory to run in and write the qsub file to (None implies the current directory).
+    '''
     if jobname is None:
       jobname=self.jobname
+    if cwd is None: cwd=os.getcwd()
 
     if len(self.exelines)==0:
       #print(self.__class__.__name__,": All tasks completed or queued.")
       return
     
-    if self.np=='allprocs':
-      ppnstr=',flags=allprocs'
-    else:
-      ppnstr=':ppn=%d'%self.np
-
     jobout=jobname+'.qsub.out'
     # Submit all jobs.
-    qsub=[
-        "#PBS -q %s"%self.queue,
-        "#PBS -l nodes=%i%s"%(self.nn,ppnstr),
-        "#PBS -l walltime=%s"%self.walltime,
-        "#PBS -j oe ",
-        "#PBS -N %s "%jobname,
-        "#PBS -o %s "%jobout,
-        "cd %s"%os.getcwd(),
+    qsub=self.scheduler.header(jobname,self.queue,self.walltime,self.nn,self.np,jobout) + [
+        "cd %s"%os.path.abspath(cwd),
       ] + self.prefix + self.exelines + self.postfix
-    qsubfile=jobname+".qsub"
+    qsubfile=os.path.join(cwd,jobname+".qsub")
     with open(qsubfile,'w') as f:
       f.write('\n'.join(qsub))
-    try:
-      result = sub.check_output("qsub %s"%(qsubfile),shell=True)
-      self.queueid.append(result.decode().split()[0].split('.')[0])
-      print(self.__class__.__name__,": Submitted as %s"%self.queueid)
-    except sub.CalledProcessError as err:
-      print(self.__class__.__name__,": Error submitting job. Check queue settings.\n\t{0}".format(err))
+    # The governor retries failed submissions, and holds jobs back if the queue is full.
+    self.queueid.append(submitter.governor.submit(self.scheduler,os.path.basename(qsubfile),cwd,self.priority))
+    print(self.__class__.__name__,": Submitted as %s"%self.queueid)
 
     # Remove exelines so the runner is ready for the next go.
     self.exelines=[]
     return qsubfile
 
+####################################################
+class RunnerSlurm(RunnerPBS):
+  ''' RunnerPBS that submits to Slurm instead.'''
+  def __init__(self,queue='batch',
+                    walltime='48:00:00',
+                    jobname='AGRunner',
+                    np='allprocs',nn=1,
+                    prefix=None,
+                    postfix=None,
+                    scheduler=None,
+                    autosize=None,
+                    priority=0
+                    ):
+    if scheduler is None: scheduler=SlurmScheduler()
+    RunnerPBS.__init__(self,queue,walltime,jobname,np,nn,prefix,postfix,scheduler,autosize,priority)
+
 ####################################################
 class FakeRunner:
   ''' Object that can be used as a runner, but will ignore run commands.
@@ -218,61 +267,48 @@ class FakeRunner:
     return False
 
   #-------------------------------------
-  def submit(self,jobname=None):
+  def submit(self,jobname=None,cwd=None):
     ''' Submit series of commands.'''
     return ''
 
 ####################################################
-class PySCFRunnerLocal:
-  ''' Object that can accumulate jobs to run and run them together locally.'''
-  def __init__(self,np='allprocs'):
-    ''' Note: exelines are prefixed by appropriate mpirun commands.'''
-    self.exelines=[]
-    self.queueid=[]
-
-  #-------------------------------------
-  def check_status(self):
-    return 'done'
+class PySCFRunnerLocal(RunnerLocal):
+  ''' Object that can accumulate jobs to run and run them together locally.
+  Tasks are OMP python commands: each submission runs with OMP_NUM_THREADS set to its cores.'''
+  def __init__(self,np='allprocs',prefix=None,postfix=None):
+    ''' Note: exelines are not prefixed by mpirun.'''
+    RunnerLocal.__init__(self,np,1,prefix,postfix)
 
   #-------------------------------------
   def add_task(self,exestr):
     ''' Accumulate executable commands.
     Args: 
-      exestr (str): executible statement. Will be prepended with appropriate mpirun. 
+      exestr (str): executible statement. 
     '''
     self.exelines.append(exestr)
 
   #-------------------------------------
-  def script(self,scriptfile):
-    ''' Dump accumulated commands into a script for another job to run.
-    Returns true if the runner had lines to actually execute.'''
-
-    if len(self.exelines)==0:
-      return False
-
-    with open(scriptfile,'w') as outf:
-      outf.write('\n'.join(self.prefix + exelines + self.postfix))
-
-    # Remove exelines so the runner is ready for the next go.
-    self.exelines=[]
-    return True
-
-  #-------------------------------------
-  def submit(self,jobname=None,ppath=None):
-    ''' Submit series of commands.
-    Note: jobname is not used because it doesn't submit anything.'''
-    sys.path=ppath+sys.path
+  def submit(self,jobname=None,ppath=None,cwd=None):
+    ''' Start the series of commands in the background.
+    Note: jobname is not used because it doesn't submit anything.
+    Args:
+      ppath (list): python path needed for the run (default: current path).
+      cwd (str): directory to run in (None implies the current directory).
+    '''
+    if ppath is None: ppath=sys.path
 
     if len(self.exelines)==0:
       #print(self.__class__.__name__,": All tasks completed or queued.")
       return ''    
 
-    try:
-      for line in self.exelines:
-        result = sub.check_output(line,shell=True)
-        print(self.__class__.__name__,": executed %s"%line)
-    except sub.CalledProcessError as err:
-      print(self.__class__.__name__,": Error: {0}".format(err))
+    ncores=self.ncores()
+    if ncores is None: ncores=submitter.local_pool.ncores
+    env=dict(os.environ,
+        OMP_NUM_THREADS=str(ncores),
+        PYTHONPATH=':'.join(ppath+[os.environ.get('PYTHONPATH','')]))
+    queueid=submitter.local_pool.submit(self.prefix+self.exelines+self.postfix,ncores,cwd=cwd,env=env)
+    self.queueid.append(queueid)
+    print(self.__class__.__name__,": Started as %s"%queueid)
 
     # Remove exelines so the runner is ready for the next go.
     self.exelines=[]
@@ -287,8 +323,13 @@ class PySCFRunnerPBS(RunnerPBS):
                     nn=1,
                     jobname=os.getcwd().split('/')[-1]+'_pyscf',
                     prefix=None,
-                    postfix=None
+                    postfix=None,
+                    scheduler=None,
+                    autosize=None,
+                    priority=0
                     ):
+    ''' autosize (dict): if set, choose the walltime from previous runtimes. See RunnerPBS.
+    priority (float): order of submission when the queue is full. See RunnerPBS.'''
     self.np=np
     if nn!=1: raise NotImplementedError
     self.nn=nn
@@ -302,6 +343,10 @@ class PySCFRunnerPBS(RunnerPBS):
     else:              self.prefix=prefix
     if postfix is None: self.postfix=[]
     else:               self.postfix=postfix
+    if scheduler is None: self.scheduler=PBSScheduler()
+    else:                 self.scheduler=scheduler
+    self.autosize=autosize
+    self.priority=priority
     self.queueid=[]
 
   #-------------------------------------
@@ -321,7 +366,7 @@ class PySCFRunnerPBS(RunnerPBS):
       return False
 
     # Prepend mp specs.
-    actions=["export OMP_NUM_THREADS=%d"%(self.nn*self.np)]+actions
+    actions=["export OMP_NUM_THREADS=%d"%(self.nn*self.np)]+self.exelines
 
     # Dump script.
     with open(scriptfile,'w') as outf:
@@ -333,15 +378,17 @@ class PySCFRunnerPBS(RunnerPBS):
     return True
 
   #-------------------------------------
-  def submit(self,jobname=None,ppath=None):
+  def submit(self,jobname=None,ppath=None,cwd=None):
     ''' Submit any accumulated tasks.
 
     Args:
       jobname (str): name to appear in the queue.
       ppath (list): python path needed for the run (default: current path).
+      cwd (str): directory to run in and write the qsub file to (None implies the current directory).
     '''
       
     if ppath is None: ppath=sys.path
+    if cwd is None: cwd=os.getcwd()
 
     if len(self.exelines)==0: 
       #print(self.__class__.__name__,": All tasks completed or queued.")
@@ -349,36 +396,18 @@ class PySCFRunnerPBS(RunnerPBS):
     if jobname is None: jobname=self.jobname
 
     jobout=jobname+".jobout"
-    qsublines=[
-         "#PBS -q %s"%self.queue,
-       ]
-    if self.np == 'allprocs' :
-      qsublines+=[
-           "#PBS -l nodes=%i,flags=allprocs"%self.nn,
-         ]
-    else:
-      qsublines+=[
-           "#PBS -l nodes=%i:ppn=%i"%(self.nn,self.np),
-         ]
+    qsublines=self.scheduler.header(jobname,self.queue,self.walltime,self.nn,self.np,jobout)
     qsublines+=[
-         "#PBS -l walltime=%s"%self.walltime,
-         "#PBS -j oe",
-         "#PBS -N %s"%self.jobname,
-         "#PBS -o %s"%jobout,
-         "cd ${PBS_O_WORKDIR}",
+         "cd %s"%os.path.abspath(cwd),
          "export OMP_NUM_THREADS=%d"%(self.nn*self.np),
          "export PYTHONPATH=%s"%(':'.join(ppath)),
          "cwd=`pwd`"
        ] + self.prefix + self.exelines + self.postfix
-    qsubfile=jobname+".qsub"
+    qsubfile=os.path.join(cwd,jobname+".qsub")
     with open(qsubfile,'w') as f:
       f.write('\n'.join(qsublines))
-    try: 
-      result = sub.check_output("qsub %s"%(qsubfile),shell=True)
-      self.queueid.append(result.decode().split()[0].split('.')[0])
-      print(self.__class__.__name__,": Submitted as %s"%self.queueid)
-    except sub.CalledProcessError as err:
-      print(self.__class__.__name__,": Error submitting job. Check queue settings.\n\t{0}".format(err))
+    self.queueid.append(submitter.governor.submit(self.scheduler,os.path.basename(qsubfile),cwd,self.priority))
+    print(self.__class__.__name__,": Submitted as %s"%self.queueid)
 
     # Clear out the lines to set up for the next job.
     self.exelines=[]
@@ -4,10 +4,15 @@
 import pickle as pkl
 import sys
 import argparse
+from statestore import SQLiteStore
 
-def get_info(pickle):
+def get_info(pickle,dbfile=None):
   print("Info about %s..."%pickle)
-  man=pkl.load(open(pickle,'rb'))
+  if dbfile is None:
+    man=pkl.load(open(pickle,'rb'))
+  else:
+    path,name=pickle.rsplit('/',1) if '/' in pickle else ('.',pickle)
+    man=SQLiteStore(dbfile).load(path+'/',name)
 
   print("  Queue id: {}".format(man.runner.queueid))
   try:
@@ -18,9 +23,10 @@ def get_info(pickle):
 if __name__=='__main__':
 
   parser=argparse.ArgumentParser("Autogen untilities.")
-  parser.add_argument('manager',type=str,help='Pickle file to look at.')
+  parser.add_argument('manager',type=str,help='Pickle file to look at, or path/name of the manager if --db is used.')
+  parser.add_argument('--db',type=str,default=None,help='SQLite state database the manager is stored in.')
   # Can add more options as needed.
 
   args=parser.parse_args()
-  get_info(args.manager)
+  get_info(args.manager,args.db)
   
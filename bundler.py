@@ -1,17 +1,42 @@
 import numpy as np
 import subprocess as sub
+import submitter
+import runtimedb
+import os
+from schedulers import PBSScheduler, walltime_seconds, seconds_walltime
 
+#######################################################################
 class Bundler:
   ''' Class for handling the bundling of several jobs of approximately the same 
-  length, but possibly in different locations. ''' 
+  length, but possibly in different locations. 
+
+  Jobs are packed into bundles using estimates of their runtimes. Within a bundle, jobs run in lanes:
+  each lane is a group of nodes that runs its jobs one after the other, and the lanes run side by side.
+  Jobs are placed longest first into the lane that finishes earliest and still fits in the walltime
+  (opening a new lane, or a new bundle, if none does), which keeps the nodes of a bundle busy until
+  the end instead of waiting on one long job.
+
+  Runtime estimates come from, in order: the `estimates` given by the user (by path+name or by kind),
+  the prediction of the runtime database from previous runs of the same kind (see `runtimedb.py`),
+  or the runner's walltime. The kind of a manager's task is the one its runtimes are recorded under
+  (see `runtimedb.task_kind`, e.g. 'qwalk:dmc'), so all the k-points of a DMC calculation share estimates.
+  ''' 
   def __init__(self,queue='normal',
                     walltime='48:00:00',
                     jobname='AGBundler',
                     npb=16,ppn=32,
                     prefix=None,
-                    postfix=None
+                    postfix=None,
+                    scheduler=None,
+                    estimates=None,
+                    db=None
                     ):
-    ''' npb is the number of nodes desired per bundle. '''
+    ''' npb is the number of nodes desired per bundle. 
+    Args:
+      scheduler (scheduler object): where to submit (None implies PBS). See `schedulers.py`.
+      estimates (dict): runtime estimates in seconds, keyed by manager path+name or kind.
+      db (RuntimeDB): runtimes of previous tasks (None implies runtimedb.default_db).
+    '''
     self.npb=npb
     self.ppn=ppn
     self.jobname=jobname
@@ -22,57 +47,225 @@ class Bundler:
     else:              self.prefix=prefix
     if postfix is None: self.postfix=[]
     else:               self.postfix=postfix
+    if scheduler is None: self.scheduler=PBSScheduler()
+    else:                 self.scheduler=scheduler
+    if estimates is None: self.estimates={}
+    else:                 self.estimates=estimates
+    if db is None: self.db=runtimedb.default_db
+    else:          self.db=db
     self.queueid=[]
 
+  def check_status(self):
+    ''' Whether any bundle is still in the queue.'''
+    return submitter.governor.status(self.scheduler,self.queueid)
+
   def add_job(self,mgr):
     ''' mgr is a Manager. Add Managers that have a script ready 
     to run in their current directory.'''
-    if mgr._runready: self.jobs.append(mgr)
+    if getattr(mgr,'bundle_ready',False): self.jobs.append(mgr)
+
+  #------------------------------------------------
+  def priority(self,mgrs):
+    ''' Submission priority of a job running these managers: the highest of their runners.'''
+    return max([getattr(mgr.runner,'priority',0) for mgr in mgrs])
+
+  #------------------------------------------------
+  def estimate(self,mgr):
+    ''' Expected runtime of the manager's job in seconds.'''
+    if mgr.path+mgr.name in self.estimates:
+      return float(self.estimates[mgr.path+mgr.name])
+    kind=runtimedb.task_kind(mgr)
+    if kind in self.estimates:
+      return float(self.estimates[kind])
+    runner=mgr.runner
+    predicted=self.db.predict(kind,runtimedb.features(mgr,kind),runtimedb.count_cores(runner.nn,runner.np))
+    if predicted is not None:
+      return predicted
+    return walltime_seconds(runner.walltime)
+
+  #------------------------------------------------
+  def plan(self):
+    ''' Pack the added jobs into bundles.
+    Returns:
+      list: bundles, each a dict with 'lanes' (list of dicts with 'nodes', 'jobs', 'end'),
+        'nodes' (nodes requested), 'makespan' (predicted seconds), and 'utilization'
+        (predicted fraction of the requested node-time spent running jobs).
+    '''
+    maxtime=walltime_seconds(self.walltime)
+    tasks=[(self.estimate(mgr),mgr) for mgr in self.jobs]
+    # Longest first.
+    tasks.sort(key=lambda task:-task[0])
+
+    bundles=[]
+    for runtime,mgr in tasks:
+      nn=mgr.runner.nn
+      if runtime>maxtime:
+        print(self.__class__.__name__,": %s is expected to take %s, longer than the walltime %s."%\
+            (mgr.path+mgr.name,seconds_walltime(runtime),self.walltime))
+      # Earliest-finishing lane that has the right width and room left.
+      best=None
+      for bundle in bundles:
+        for lane in bundle['lanes']:
+          if lane['nodes']==nn and lane['end']+runtime<=maxtime:
+            if best is None or lane['end']<best['end']: best=lane
+      if best is None:
+        # New lane in the first bundle with enough free nodes, else a new bundle.
+        best={'nodes':nn,'jobs':[],'end':0.0}
+        for bundle in bundles:
+          if bundle['nodes']+nn<=self.npb:
+            break
+        else:
+          bundle={'lanes':[],'nodes':0}
+          bundles.append(bundle)
+        bundle['lanes'].append(best)
+        bundle['nodes']+=nn
+      best['jobs'].append((mgr,runtime))
+      best['end']+=runtime
+
+    for bundle in bundles:
+      bundle['makespan']=max([lane['end'] for lane in bundle['lanes']])
+      busy=sum([lane['nodes']*lane['end'] for lane in bundle['lanes']])
+      if bundle['makespan']>0: bundle['utilization']=busy/(bundle['nodes']*bundle['makespan'])
+      else:                    bundle['utilization']=1.0
+    return bundles
 
-  def _submit_bundle(self,mgrs,jobname=None,nn=None):
-    if nn is None:      nn=sum([mgr.runner.nn for mgr in mgrs])
+  #------------------------------------------------
+  def report(self,bundles):
+    ''' Print the predicted use of each bundle.'''
+    print(self.__class__.__name__,": %d jobs in %d bundles."%(len(self.jobs),len(bundles)))
+    for bidx,bundle in enumerate(bundles):
+      print("  bundle %d: %d nodes, %d lanes, %d jobs, predicted runtime %s (walltime %s), utilization %.0f%%"%\
+          (bidx,bundle['nodes'],len(bundle['lanes']),sum([len(lane['jobs']) for lane in bundle['lanes']]),
+           seconds_walltime(bundle['makespan']),self.walltime,100*bundle['utilization']))
+
+  #------------------------------------------------
+  def _submit_bundle(self,bundle,jobname=None):
     if jobname is None: jobname=self.jobname
 
-    qsublines=[
-        "#PBS -q %s"%self.queue,
-        "#PBS -l nodes=%i:ppn=%i:xe"%(nn,self.ppn),
-        "#PBS -l walltime=%s"%self.walltime,
-        "#PBS -j oe ",
-        "#PBS -A bahu",
-        "#PBS -N %s "%jobname,
-        "#PBS -o %s.out "%jobname,
-      ] + self.prefix
-    for mgr in mgrs:
-      # This might be better without an error-out.
-      assert mgr._runready, "One of the Managers is not prepped for run."
-      qsublines+=[
-          "cd %s"%mgr.location,
-          "bash %s &"%mgr.scriptfile
-        ]
+    qsublines=self.scheduler.header(jobname,self.queue,self.walltime,bundle['nodes'],self.ppn,
+        "%s.out"%jobname) + self.prefix
+    for lane in bundle['lanes']:
+      # Each lane runs its jobs in order, in the background.
+      # The managers' scripts time their tasks, and the runtimes are recorded when the results are collected.
+      qsublines+=["("]
+      for mgr,runtime in lane['jobs']:
+        # This might be better without an error-out.
+        assert mgr.bundle_ready, "One of the Managers is not prepped for run."
+        qsublines+=[
+            "  cd %s"%os.path.abspath(mgr.path),
+            "  bash %s"%mgr.scriptfile,
+          ]
+      qsublines+=[") &"]
     qsublines+=["wait"]+self.postfix
 
     qsubfile=jobname+".qsub"
     with open(qsubfile,'w') as f:
       f.write('\n'.join(qsublines))
-    try:
-      result=sub.check_output("qsub %s"%(qsubfile),shell=True)
-      queueid=result.decode().split()[0].split('.')[0]
-      print("Submitted as %s"%queueid)
-    except sub.CalledProcessError:
-      print("Error submitting job. Check queue settings.")
-
-    for mgr in mgrs:
-      mgr.update_queueid(queueid)
+    queueid=submitter.governor.submit(self.scheduler,qsubfile,priority=self.priority(
+        [mgr for lane in bundle['lanes'] for mgr,runtime in lane['jobs']]))
+    self.queueid.append(queueid)
+    print(self.__class__.__name__,": Submitted as %s"%queueid)
 
+    for lane in bundle['lanes']:
+      for mgr,runtime in lane['jobs']:
+        mgr.update_queueid(queueid)
 
+  #------------------------------------------------
   def submit(self,jobname=None):
     ''' Submit all the jobs in the Managers that were added.'''
     if jobname is None: jobname=self.jobname
+    if len(self.jobs)==0: return
+
+    bundles=self.plan()
+    self.report(bundles)
+
+    for bidx,bundle in enumerate(bundles):
+      self._submit_bundle(bundle,"%s_%d"%(jobname,bidx))
+    self.jobs=[]
+
+#######################################################################
+class ArraySubmitter:
+  ''' Submit families of managers with the same resources (e.g. DMC runs for each k-point) as job arrays.
+
+  Managers should be run with bundle=True, so `nextstep` leaves a script in their directory instead
+  of submitting. Each group of managers whose runners ask for the same queue, walltime, nodes,
+  processors and scheduler is submitted as one array job. Element i of the array runs the script of
+  the i-th manager, and that manager's queueid is updated to the element's id.
+  '''
+  def __init__(self,jobname='AGArray',path='./',prefix=None,postfix=None):
+    '''
+    Args:
+      jobname (str): base name of the array jobs.
+      path (str): directory to write the array scripts to.
+      prefix (list): lines at the start of every array job (after the scheduler header).
+      postfix (list): lines at the end of every array job.
+    '''
+    self.jobname=jobname
+    self.path=path
+    self.jobs=[]
+    if prefix is None: self.prefix=[]
+    else:              self.prefix=prefix
+    if postfix is None: self.postfix=[]
+    else:               self.postfix=postfix
+    self.queueid=[]
 
-    assign=np.cumsum([mgr.runner.nn for mgr in self.jobs])
-    assign=((assign-0.1)//self.npb).astype(int)
+  #------------------------------------------------
+  def add_job(self,mgr):
+    ''' Add a manager if it has a script ready to run.'''
+    if getattr(mgr,'bundle_ready',False): self.jobs.append(mgr)
 
-    print(assign)
+  #------------------------------------------------
+  def signature(self,mgr):
+    ''' Resources requested by the manager's runner. Managers with the same signature can share an array.'''
+    runner=mgr.runner
+    return (runner.scheduler.__class__.__name__,runner.queue,runner.walltime,runner.nn,runner.np)
 
-    for bidx in range(assign[-1]+1):
-      self._submit_bundle(np.array(self.jobs)[assign==bidx],"%s_%d"%(jobname,bidx))
+  #------------------------------------------------
+  def groups(self):
+    ''' Managers added so far, grouped by signature (in the order they were added).'''
+    groups={}
+    for mgr in self.jobs:
+      groups.setdefault(self.signature(mgr),[]).append(mgr)
+    return groups
+
+  #------------------------------------------------
+  def _submit_array(self,mgrs,jobname):
+    runner=mgrs[0].runner
+    scheduler=runner.scheduler
+    lines=scheduler.header(jobname,runner.queue,runner.walltime,runner.nn,runner.np,jobname+'.out')
+    lines+=self.prefix
+    lines+=["paths=("]+['  "%s"'%os.path.abspath(mgr.path) for mgr in mgrs]+[")"]
+    lines+=["scripts=("]+['  "%s"'%mgr.scriptfile for mgr in mgrs]+[")"]
+    lines+=[
+        "index=%s"%scheduler.array_index,
+        'cd "${paths[$index]}"',
+        'bash "${scripts[$index]}"',
+      ]
+    lines+=self.postfix
+
+    scriptfile=os.path.join(self.path,jobname+".array")
+    with open(scriptfile,'w') as f:
+      f.write('\n'.join(lines))
+    # The governor retries failed submissions, and holds the array back if the queue is full.
+    queueid=submitter.governor.submit(scheduler,os.path.basename(scriptfile),self.path,
+        max([getattr(mgr.runner,'priority',0) for mgr in mgrs]),njobs=len(mgrs))
+    print(self.__class__.__name__,": Submitted %d managers as array %s"%(len(mgrs),queueid))
+    self.queueid.append(queueid)
+
+    for index,mgr in enumerate(mgrs):
+      mgr.update_queueid(submitter.governor.array_element(scheduler,queueid,index))
+    return queueid
+
+  #------------------------------------------------
+  def submit(self,jobname=None):
+    ''' Submit one array job for each group of managers that were added.
+    Returns:
+      list: queue ids of the arrays ('pending:N' for arrays the governor holds back).
+    '''
+    if jobname is None: jobname=self.jobname
+    queueids=[]
+    for gidx,mgrs in enumerate(self.groups().values()):
+      queueid=self._submit_array(mgrs,"%s_%d"%(jobname,gidx))
+      if queueid is not None: queueids.append(queueid)
+    self.jobs=[]
+    return queueids
@@ -5,7 +5,7 @@ import pandas as pd
 import numpy as np
 from functools import reduce
 import crystal2qmc
-from crystal2qmc import periodic_table,read_gred, read_kred, read_outputfile
+from crystal2qmc import periodic_table,read_gred, read_kred, read_outputfile, CrystalCache
 import pyscf
 import pyscf.lo
 import pyscf.pbc
@@ -17,12 +17,14 @@ from collections import Counter
 def crystal2pyscf_mol(propoutfn="prop.in.o",
     basis='bfd_vtz',
     gs=(8,8,8),
-    basis_order=None):
+    basis_order=None,
+    cache=False):
   ''' Make a PySCF object with solution from a crystal run.
 
   Args:
     propoutfn (str): properties or crystal stdout.
     basis (str): PySCF basis option--should match the crystal basis.
+    cache (bool): use the binary cache of the parsed crystal files (see crystal2qmc.CrystalCache).
   Returns:
     tuple: (mol,scf) PySCF-equilivent Mole and SCF object.
   '''
@@ -31,8 +33,13 @@ def crystal2pyscf_mol(propoutfn="prop.in.o",
   nspin=2
 
   # Load crystal data.
-  info, crylat_parm, cryions, crybasis, crypseudo = read_gred()
-  cryeigsys = read_kred(info,crybasis)
+  if cache:
+    crycache=CrystalCache()
+    info, crylat_parm, cryions, crybasis, crypseudo = crycache.read_gred()
+    cryeigsys = crycache.read_kred()
+  else:
+    info, crylat_parm, cryions, crybasis, crypseudo = read_gred()
+    cryeigsys = read_kred(info,crybasis)
 
 
   # Format and input structure.
@@ -63,12 +70,14 @@ def crystal2pyscf_cell(
     cryoutfn="prop.in.o",
     basis='bfd_vtz',
     mesh=(16,16,16),
-    basis_order=None):
+    basis_order=None,
+    cache=False):
   ''' Make a PySCF object with solution from a crystal run.
 
   Args:
     cryoutfn (str): properties or crystal stdout.
     basis (str): PySCF basis option--should match the crystal basis.
+    cache (bool): use the binary cache of the parsed crystal files (see crystal2qmc.CrystalCache).
   Returns:
     tuple: (cell,scf) PySCF-equilivent Mole and SCF object.
   '''
@@ -76,8 +85,13 @@ def crystal2pyscf_cell(
   #TODO Generalize spin and kpoint.
 
   # Load crystal data.
-  info, crylat_parm, cryions, crybasis, crypseudo = read_gred(gred=gred)
-  cryeigsys = read_kred(info,crybasis,kred=kred)
+  if cache:
+    crycache=CrystalCache(gred,kred)
+    info, crylat_parm, cryions, crybasis, crypseudo = crycache.read_gred()
+    cryeigsys = crycache.read_kred()
+  else:
+    info, crylat_parm, cryions, crybasis, crypseudo = read_gred(gred=gred)
+    cryeigsys = read_kred(info,crybasis,kred=kred)
 
   totspin=read_outputfile(cryoutfn)
   ntot=int(round(sum(crybasis['charges'])))
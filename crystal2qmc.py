@@ -1,6 +1,19 @@
 from __future__ import division,print_function
 import numpy as np
 import sys
+import os
+import warnings
+import hashlib
+import pickle
+import shutil
+import tempfile
+from contextlib import contextmanager
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+import orbfile
+import forkpool
 
 def error(message,errortype):
   print(message)
@@ -16,6 +29,102 @@ periodic_table = [
   "rf","db","sg","bh","hs","mt","ds","rg","cp","uut","uuq","uup","uuh","uus","uuo"
 ]
 
+###############################################################################
+# Numbers of a file of whitespace-separated numbers (like GRED.DAT and KRED.DAT), read in
+# order from a memory map. Numbers are only converted to floats when they're read: skipped
+# numbers are just counted by finding where they end, which is much faster and needs no memory.
+# Fortran leaves no space before negative numbers that fill their field ("1.0-2.0"), so a
+# minus sign that isn't part of an exponent also starts a new number.
+# Integers are exact as floats up to 2**53.
+class NumberStream:
+  def __init__(self,fname,blocksize=2**20):
+    self.fname = fname
+    if os.path.getsize(fname) > 0:
+      self.data = np.memmap(fname,dtype=np.uint8,mode='r')
+    else:
+      self.data = np.zeros(0,dtype=np.uint8)
+    self.blocksize = blocksize
+    self.pos = 0     # Byte offset of the next number.
+    self.index = 0   # Index of the next number.
+    self.chunks = [] # (index, array) of the sections read by slicing.
+
+  def _ends(self,start,end):
+    """ Byte offsets in (start,end] where a number ends."""
+    window = np.asarray(self.data[start:end+1])
+    space = window <= ord(' ')
+    glued = (window[1:] == ord('-')) & (window[:-1] != ord('E')) & (window[:-1] != ord('e'))
+    ends = np.flatnonzero(~space[:-1] & (space[1:] | glued)) + 1 + start
+    if end+1 >= self.data.size and window.size > 0 and not space[-1]:
+      ends = np.append(ends,self.data.size)
+    return ends
+
+  def _offset(self,count):
+    """ Byte offset just after the next count numbers (the end of the file if there are fewer)."""
+    start = self.pos
+    while count > 0 and start < self.data.size:
+      # Numbers take about 20 bytes, so short reads only look at the next few lines.
+      size = min(self.blocksize,max(4096,32*count))
+      ends = self._ends(start,start+size)
+      if ends.size >= count:
+        return int(ends[count-1])
+      count -= ends.size
+      start += size
+    if count > 0: return self.data.size
+    return start
+
+  def read(self,count):
+    """ Convert the next count numbers (fewer at the end of the file)."""
+    end = self._offset(count)
+    text = self.data[self.pos:end].tobytes()
+    text = text.replace(b"-",b" -").replace(b"E -",b"E-")
+    if text.strip() == b'':
+      numbers = np.zeros(0)
+    else:
+      with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        try:
+          numbers = np.fromstring(text,sep=' ')
+        except (DeprecationWarning,ValueError):
+          error("ERROR: %s contains something other than numbers."%self.fname,"IO Error")
+    self.pos = end
+    self.index += numbers.size
+    return numbers
+
+  def ints(self,count):
+    return self.read(count).astype(int)
+
+  def skip(self,count):
+    """ Move past the next count numbers without converting them."""
+    self.pos = self._offset(count)
+    self.index += count
+
+  def peek(self):
+    """ Text of the next number, without moving past it."""
+    return self.data[self.pos:self._offset(1)].tobytes().strip()
+
+  def __getitem__(self,key):
+    """ Numbers by index, as in a list of the words of the file.
+    Sections must be read in order (or again), and are kept, so slices are views."""
+    if not isinstance(key,slice):
+      section = self[key:key+1]
+      if section.size == 0:
+        raise IndexError("%s has only %d numbers."%(self.fname,self.index))
+      return section[0]
+    start,stop = key.start,key.stop
+    if start is None: start = 0
+    for first,numbers in self.chunks:
+      if first <= start and stop <= first+numbers.size:
+        return numbers[start-first:stop-first]
+    if start < self.index:
+      raise IndexError("%s is read in order: number %d was already passed."%(self.fname,start))
+    self.skip(start-self.index)
+    numbers = self.read(stop-start)
+    self.chunks.append((start,numbers))
+    return numbers
+
+  def close(self):
+    self.data = np.zeros(0,dtype=np.uint8)
+
 ###############################################################################
 # Reads in the geometry, basis, and pseudopotential from GRED.DAT.
 def read_gred(gred="GRED.DAT"):
@@ -24,34 +133,32 @@ def read_gred(gred="GRED.DAT"):
   basis = {}
   pseudo = {}
 
-  gred = open(gred,'r').read()
-
-  # Fix numbers with no space between them.
-  gred = gred.replace("-"," -")
-  gred = gred.replace("E -","E-") 
+  # Skipped sections (and everything after the pseudopotentials) are never converted.
+  gred_words = NumberStream(gred)
+  def ints(start,end):
+    return gred_words[start:end].astype(int)
 
-  gred_words = gred.split()
-  nparms = [int(w) for w in gred_words[1:4]]
+  nparms = ints(1,4).tolist()
   cursor = 4
 
   # These follow naming of cryapi_inp (but "inf" -> "info").
-  info = [int(w) for w in gred_words[cursor          :cursor+nparms[0]]]
-  itol = [int(w) for w in gred_words[cursor+nparms[0]:cursor+nparms[1]]]
-  par  = [int(w) for w in gred_words[cursor+nparms[1]:cursor+nparms[2]]]
+  info = ints(cursor          ,cursor+nparms[0]).tolist()
+  itol = ints(cursor+nparms[0],cursor+nparms[1]).tolist()
+  par  = ints(cursor+nparms[1],cursor+nparms[2]).tolist()
   cursor += sum(nparms)
 
   lat_parm['struct_dim'] = int(info[9])
 
   # Lattice parameters.
   lat_parm['latvecs'] = \
-      np.array(gred_words[cursor:cursor+9],dtype=float).reshape(3,3).T.round(15)
+      gred_words[cursor:cursor+9].reshape(3,3).T.round(15)
   if (lat_parm['latvecs'] > 100).any():
     print("Lattice parameter larger than 100 A! Reducing to 100.")
     print("If this is a dimension < 3 system, there is no cause for alarm.")
     print("Otherwise if this is a problem for you, please generalize crystal2qmc.")
     lat_parm['latvecs'][lat_parm['latvecs']>100] = 100.
   cursor += 9
-  prim_trans= np.array(gred_words[cursor:cursor+9],dtype=float).reshape(3,3)
+  prim_trans= gred_words[cursor:cursor+9].reshape(3,3)
   cursor += 9
   lat_parm['conv_cell'] = prim_trans.dot(lat_parm['latvecs'])
   cursor += info[1] + 48*48 + 9*info[1] + 3*info[1] # Skip symmetry part.
@@ -61,10 +168,10 @@ def read_gred(gred="GRED.DAT"):
 
   # Some of ion information.
   natoms = info[23]
-  ions['charges'] = [float(w) for w in gred_words[cursor:cursor+natoms]]
+  ions['charges'] = gred_words[cursor:cursor+natoms].tolist()
   cursor += natoms
   # Atom positions.
-  atom_poss = np.array(gred_words[cursor:cursor+3*natoms],dtype=float)
+  atom_poss = gred_words[cursor:cursor+3*natoms]
   ions['positions'] = atom_poss.reshape(natoms,3)
   cursor += 3*natoms
 
@@ -72,57 +179,57 @@ def read_gred(gred="GRED.DAT"):
   nshells = info[19]
   nprim   = info[74]
   # Formal charge of shell.
-  basis['charges'] = np.array(gred_words[cursor:cursor+nshells],dtype=float)
+  basis['charges'] = gred_words[cursor:cursor+nshells]
   cursor += nshells
   # "Adjoined gaussian" of shells.
-  basis['adj_gaus'] = np.array(gred_words[cursor:cursor+nshells],dtype=float)
+  basis['adj_gaus'] = gred_words[cursor:cursor+nshells]
   cursor += nshells
   # Position of shell.
-  shell_poss = np.array(gred_words[cursor:cursor+3*nshells],dtype=float)
+  shell_poss = gred_words[cursor:cursor+3*nshells]
   basis['positions'] = shell_poss.reshape(nshells,3)
   cursor += 3*nshells
   # Primitive gaussian exponents.
-  basis['prim_gaus'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  basis['prim_gaus'] = gred_words[cursor:cursor+nprim]
   cursor += nprim
   # Coefficients of s, p, d, and (?).
-  basis['coef_s'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  basis['coef_s'] = gred_words[cursor:cursor+nprim]
   cursor += nprim
-  basis['coef_p'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  basis['coef_p'] = gred_words[cursor:cursor+nprim]
   cursor += nprim
-  basis['coef_dfg'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  basis['coef_dfg'] = gred_words[cursor:cursor+nprim]
   cursor += nprim
-  basis['coef_max'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  basis['coef_max'] = gred_words[cursor:cursor+nprim]
   cursor += nprim
   # Skip "old normalization"
   cursor += 2*nprim
   # Atomic numbers.
-  ions['atom_nums'] = np.array(gred_words[cursor:cursor+natoms],dtype=int)
+  ions['atom_nums'] = ints(cursor,cursor+natoms)
   cursor += natoms
   # First shell of each atom (skip extra number after).
-  basis['first_shell'] = np.array(gred_words[cursor:cursor+natoms],dtype=int)
+  basis['first_shell'] = ints(cursor,cursor+natoms)
   cursor += natoms + 1
   # First primitive of each shell (skips an extra number after).
-  basis['first_prim'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  basis['first_prim'] = ints(cursor,cursor+nshells)
   cursor += nshells + 1
   # Number of prims per shell.
-  basis['prim_shell'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  basis['prim_shell'] = ints(cursor,cursor+nshells)
   cursor += nshells
   # Type of shell: 0=s,1=sp,2=p,3=d,4=f.
-  basis['shell_type'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  basis['shell_type'] = ints(cursor,cursor+nshells)
   cursor += nshells
   # Number of atomic orbtials per shell.
-  basis['nao_shell'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  basis['nao_shell'] = ints(cursor,cursor+nshells)
   cursor += nshells
   # First atomic orbtial per shell (skip extra number after).
-  basis['first_ao'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  basis['first_ao'] = ints(cursor,cursor+nshells)
   cursor += nshells + 1
   # Atom to which each shell belongs.
-  basis['atom_shell'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  basis['atom_shell'] = ints(cursor,cursor+nshells)
   cursor += nshells
 
   # Pseudopotential information.
   # Pseudopotential for each element.
-  pseudo_atom = np.array(gred_words[cursor:cursor+natoms],dtype=int)
+  pseudo_atom = ints(cursor,cursor+natoms)
   cursor += natoms
   cursor += 1 # skip INFPOT
   ngauss = int(gred_words[cursor])
@@ -133,18 +240,18 @@ def read_gred(gred="GRED.DAT"):
   numpseudo = int(gred_words[cursor])
   cursor += 1
   # Exponents of r^l prefactor.
-  r_exps = -1*np.array(gred_words[cursor:cursor+ngauss],dtype=int)
+  r_exps = -1*ints(cursor,cursor+ngauss)
   cursor += ngauss
   # Number of Gaussians for angular momenutum j
-  n_per_j = np.array(gred_words[cursor:cursor+headlen],dtype=int)
+  n_per_j = ints(cursor,cursor+headlen)
   cursor += headlen
   # index of first n_per_j for each pseudo.
-  pseudo_start = np.array(gred_words[cursor:cursor+numpseudo],dtype=int)
+  pseudo_start = ints(cursor,cursor+numpseudo)
   cursor += numpseudo + 1
   # Actual floats of pseudopotential.
-  exponents = np.array(gred_words[cursor:cursor+ngauss],dtype=float)
+  exponents = gred_words[cursor:cursor+ngauss]
   cursor += ngauss
-  prefactors = np.array(gred_words[cursor:cursor+ngauss],dtype=float)
+  prefactors = gred_words[cursor:cursor+ngauss]
   cursor += ngauss
   # Store information nicely.
   npjlen = int(headlen / len(pseudo_start))
@@ -159,6 +266,7 @@ def read_gred(gred="GRED.DAT"):
       pseudo[atom]['r_exps'] = r_exps[start:end]
       pseudo[atom]['n_per_j'] = n_per_j[npjlen*psidx:npjlen*(psidx+1)]
       pseudo[atom]['exponents'] = exponents[start:end]
+  gred_words.close()
 
   ## Density matrix information.
   # This is impossible to figure out.  See `cryapi_inp.f`.
@@ -173,124 +281,93 @@ def read_gred(gred="GRED.DAT"):
 
 ###############################################################################
 # Reads in kpoints and eigen{values,vectors} from KRED.DAT.
-def read_kred(info,basis,kred="KRED.DAT"):
+# Only the eigenvectors of the kpoints in kset ('complex' for all of them, 'real' for
+# the real ones) are kept, and only their first maxmo_spin orbitals (-1 for all).
+# The rest of the file is skipped without being converted.
+def read_kred(info,basis,kred="KRED.DAT",kset='complex',maxmo_spin=-1):
   eigsys = {}
 
-  kred = open(kred)
-#  print(kred.readline())
-#  kred=kred.read()
-  kred_words = [] #kred.split()
-  for lin in kred:
-    kred_words += lin.split()
-  cursor = 0
+  kred_words = NumberStream(kred)
 
   # Number of k-points in each direction.
-  eigsys['nkpts_dir'] = np.array([int(w) for w in kred_words[cursor:cursor+3]])
-  cursor += 3
+  eigsys['nkpts_dir'] = kred_words.ints(3)
   # Total number of inequivilent k-points.
-  nikpts = int(kred_words[cursor])
-  cursor += 1
+  nikpts = int(kred_words.read(1)[0])
   # Reciprocal basis.
-  recip_vecs = np.array(kred_words[cursor:cursor+9],dtype=float)
+  recip_vecs = kred_words.read(9)
   eigsys['recip_vecs'] = recip_vecs.reshape(3,3)
-  cursor += 9
   # Inequivilent k-point coord in reciprocal basis.
-  ikpt_coords = np.array(kred_words[cursor:cursor+3*nikpts],int)
-  ikpt_coords = list(map(tuple,ikpt_coords.reshape(nikpts,3)))
+  ikpt_coords = kred_words.ints(3*nikpts)
+  ikpt_coords = list(map(tuple,ikpt_coords.reshape(nikpts,3).tolist()))
   # Useful to compare to old output format.
   eigsys['kpt_index'] = dict(zip(ikpt_coords,range(len(ikpt_coords))))
-  cursor += 3*nikpts
   # is complex (0) or not (1), converted to True (if complex) or False
-  ikpt_iscmpx = \
-    np.array([int(w) for w in kred_words[cursor:cursor+nikpts]]) == 0
+  ikpt_iscmpx = kred_words.ints(nikpts) == 0
   eigsys['ikpt_iscmpx'] = dict(zip(ikpt_coords,ikpt_iscmpx))
-  cursor += nikpts
   # Skip symmetry information.
-  cursor += 9*48
+  kred_words.skip(9*48)
   # Geometric weight of kpoints.
-  eigsys['kpt_weights'] = np.array(kred_words[cursor:cursor+nikpts],dtype=float)
-  cursor += nikpts
+  eigsys['kpt_weights'] = kred_words.read(nikpts)
   # Eigenvalues: (how many) = (spin) * (number of basis) * (number of kpoints)
   eigsys['nspin'] = info[63]+1
   nevals = eigsys['nspin']*info[6]*nikpts
-  eigsys['eigvals'] = np.array(kred_words[cursor:cursor+nevals],dtype=float)
-  cursor += nevals
+  eigsys['eigvals'] = kred_words.read(nevals)
   # Weights of eigenvales--incorperating Fermi energy cutoff.
   nbands = int(round(nevals / nikpts / eigsys['nspin']))
-  eigsys['eig_weights'] = np.array(kred_words[cursor:cursor+nevals],dtype=float)\
+  eigsys['eig_weights'] = kred_words.read(nevals)\
       .reshape(nikpts,eigsys['nspin'],nbands)
-  cursor += nevals
 
   # Read in eigenvectors at inequivilent kpoints. Can't do all kpoints because we 
   # don't know if non-inequivilent kpoints are real or complex (without symmetry
   # info)
-  nbands = int(round(nevals / nikpts / eigsys['nspin']))
   nkpts  = np.prod(eigsys['nkpts_dir'])
   nao = sum(basis['nao_shell'])
   ncpnts = int(nbands * nao)
-  kpt_coords   = []
+  # Orbitals kept; each orbital is nao numbers (pairs of numbers if complex).
+  if maxmo_spin < 0: nkeep = nbands
+  else:              nkeep = min(maxmo_spin,nbands)
   # Format: eigvecs[kpoint][<real/imag>][<spin up/spin down>]
+  # Real kpoints have no 'imag' part.
   eigvecs = {}
   for kpt in range(nkpts*eigsys['nspin']):
-    try:
-      new_kpt_coord = tuple([int(w) for w in kred_words[cursor:cursor+3]])
-    except IndexError: # End of file.
-      error("ERROR: KRED.DAT seems to have ended prematurely.\n" + \
-            "Didn't find all {0} kpoints.".format(nikpts),"IO Error")
-    cursor += 3
+    new_kpt_coord = kred_words.ints(3)
+    if new_kpt_coord.size < 3: # End of file: only inequivalent kpoints are listed.
+      break
+    new_kpt_coord = tuple(new_kpt_coord.tolist())
 
     # If new_kpt_coord is an inequivilent point...
     if new_kpt_coord in ikpt_coords:
-      # If complex...
-      if eigsys['ikpt_iscmpx'][new_kpt_coord]:
-        eig_k = np.array(kred_words[cursor:cursor+2*ncpnts],dtype=float)
-        cursor += 2*ncpnts
-        eig_k = eig_k.reshape(ncpnts,2)
-        kpt_coords.append(new_kpt_coord)
-        if new_kpt_coord in eigvecs.keys():
-          eigvecs[new_kpt_coord]['real'].append(
-              eig_k[:,0].reshape(int(round(ncpnts/nao)),nao)
-            )
-          eigvecs[new_kpt_coord]['imag'].append(
-              eig_k[:,1].reshape(int(round(ncpnts/nao)),nao)
-            )
-        else:
-          eigvecs[new_kpt_coord] = {}
-          eigvecs[new_kpt_coord]['real'] = \
-            [eig_k[:,0].reshape(int(round(ncpnts/nao)),nao)]
-          eigvecs[new_kpt_coord]['imag'] = \
-            [eig_k[:,1].reshape(int(round(ncpnts/nao)),nao)]
+      iscmpx = eigsys['ikpt_iscmpx'][new_kpt_coord]
+      if iscmpx and kset=='real':
+        kred_words.skip(2*ncpnts)
+        continue
+      if iscmpx:
+        eig_k = kred_words.read(2*nkeep*nao).reshape(nkeep,nao,2)
+        kred_words.skip(2*(ncpnts-nkeep*nao))
+        parts = {'real':eig_k[:,:,0],'imag':eig_k[:,:,1]}
       else: # ...else real.
-        eig_k = np.array(kred_words[cursor:cursor+ncpnts],dtype=float)
-        cursor += ncpnts
-        kpt_coords.append(new_kpt_coord)
-        if new_kpt_coord in eigvecs.keys():
-          eigvecs[new_kpt_coord]['real'].append(
-              eig_k.reshape(int(round(ncpnts/nao)),nao)
-            )
-          eigvecs[new_kpt_coord]['imag'].append(
-              np.zeros((int(round(ncpnts/nao)),nao))
-            ) # Not efficient, but safe.
-        else:
-          eigvecs[new_kpt_coord] = {}
-          eigvecs[new_kpt_coord]['real'] = \
-            [eig_k.reshape(int(round(ncpnts/nao)),nao)]
-          eigvecs[new_kpt_coord]['imag'] = \
-            [np.zeros((int(round(ncpnts/nao)),nao))]
+        eig_k = kred_words.read(nkeep*nao).reshape(nkeep,nao)
+        kred_words.skip(ncpnts-nkeep*nao)
+        parts = {'real':eig_k}
+      if new_kpt_coord not in eigvecs.keys():
+        eigvecs[new_kpt_coord] = dict([(part,[]) for part in parts])
+      for part in parts:
+        eigvecs[new_kpt_coord][part].append(parts[part])
     else: # ...else, skip.
       skip = True
       while skip:
+        word = kred_words.peek()
+        if word == b'': # End of file.
+          break
         try: # If there's an int, we're at next kpoint.
-          int(kred_words[cursor])
+          int(word)
           skip = False
         except ValueError: # Keep skipping.
-          cursor += ncpnts
-        except IndexError: # End of file.
-          skip = False
-          break
+          kred_words.skip(ncpnts)
+  kred_words.close()
 
   # It's probably true that kpt_coords == ikpt_coords, with repitition for spin
-  # up and spin down, because we only read in inequivilent kpoints. However,
+  # up and spin down, because we only read in inequivalent kpoints. However,
   # ordering might be different, and the ordering is correct for kpt_coords.
   # If there are bugs, this might be a source.
   eigsys['kpt_coords'] = ikpt_coords # kpt_coords
@@ -298,6 +375,187 @@ def read_kred(info,basis,kred="KRED.DAT"):
 
   return eigsys
 
+###############################################################################
+# Binary cache of the parsed GRED.DAT and KRED.DAT, so converting the same crystal
+# again (with another kset or nvirtual, or to PySCF) doesn't parse the text again.
+# The cache is a directory next to GRED.DAT: the arrays are .npy files, loaded as
+# copy-on-write memory maps, and everything else is in index.pkl, with the size,
+# modification time, and sha1 of the files it was made from. A cache is used if the
+# sizes and times match; if only the times changed (e.g. the files were copied) the
+# hashes are compared. Otherwise it's rebuilt from the files.
+# Caches are made from all the orbitals at all the kpoints, and read_kred only maps
+# the kpoints and rows it's asked for. Building one costs a full parse, so it's only
+# worth it for files that are converted several times; it's off by default.
+# Several processes can share a cache: it's rebuilt in a new directory that replaces
+# the old one while holding an exclusive lock (crystal_cache.lock), and each read
+# checks the index and maps its arrays while holding a shared lock.
+class CrystalCache:
+  version = 1
+  # Arrays smaller than this (in bytes) are kept in the index.
+  minbytes = 4096
+
+  def __init__(self,gred="GRED.DAT",kred="KRED.DAT",cachedir=None):
+    self.gred = gred
+    self.kred = kred
+    if cachedir is None:
+      cachedir = os.path.join(os.path.dirname(os.path.abspath(gred)),"crystal_cache")
+    self.cachedir = cachedir
+    self.index = None
+
+  #------------------------------------------------
+  def _identity(self,fname,digest=False):
+    stat = os.stat(fname)
+    ident = {'size':stat.st_size,'mtime':stat.st_mtime_ns}
+    if digest:
+      sha = hashlib.sha1()
+      with open(fname,'rb') as inpf:
+        for block in iter(lambda: inpf.read(2**24),b''):
+          sha.update(block)
+      ident['sha1'] = sha.hexdigest()
+    return ident
+
+  #------------------------------------------------
+  # Hold the lock of the cache (shared or exclusive) if the platform has flock.
+  @contextmanager
+  def _locked(self,exclusive=False):
+    if fcntl is None or not os.path.isdir(os.path.dirname(os.path.abspath(self.cachedir))):
+      yield
+      return
+    try:
+      lockf = open(self.cachedir+".lock",'a')
+    except OSError:
+      yield
+      return
+    try:
+      fcntl.flock(lockf,fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+      yield
+    finally:
+      lockf.close()
+
+  #------------------------------------------------
+  # Whether the cache matches the files; loads the index if it does.
+  # Called with the lock held, so the index can't be replaced while it's used.
+  def valid(self):
+    self.index = None
+    indexfn = os.path.join(self.cachedir,"index.pkl")
+    if not os.path.isfile(indexfn):
+      return False
+    try:
+      with open(indexfn,'rb') as inpf:
+        index = pickle.load(inpf)
+    except (pickle.UnpicklingError,EOFError,AttributeError,ValueError):
+      return False
+    if index.get('version') != self.version:
+      return False
+    for key,fname in (('gred',self.gred),('kred',self.kred)):
+      ident = self._identity(fname)
+      cached = index['sources'][key]
+      if ident['size'] != cached['size']:
+        return False
+      if ident['mtime'] != cached['mtime'] and \
+          self._identity(fname,digest=True)['sha1'] != cached['sha1']:
+        return False
+    self.index = index
+    return True
+
+  #------------------------------------------------
+  # Parse the files and write the cache. Returns the parsed data.
+  def build(self):
+    sources = {
+        'gred':self._identity(self.gred,digest=True),
+        'kred':self._identity(self.kred,digest=True)
+      }
+    gred = read_gred(self.gred)
+    eigsys = read_kred(gred[0],gred[3],self.kred)
+
+    stored = []
+    def _store(value):
+      if isinstance(value,dict):
+        return dict([(k,_store(v)) for k,v in value.items()])
+      if isinstance(value,(list,tuple)):
+        return type(value)([_store(v) for v in value])
+      if isinstance(value,np.ndarray) and value.nbytes >= self.minbytes:
+        stored.append(value)
+        return _StoredArray("%d.npy"%(len(stored)-1))
+      return value
+    index = {'version':self.version,'sources':sources,'gred':_store(gred),'kred':_store(eigsys)}
+
+    # The new cache is written next to the old one, and swapped in while no one is reading.
+    # Arrays already mapped from the old one stay readable after it's removed.
+    parent = os.path.dirname(os.path.abspath(self.cachedir))
+    newdir = None
+    try:
+      newdir = tempfile.mkdtemp(dir=parent,prefix=os.path.basename(self.cachedir)+".new")
+      for aidx,array in enumerate(stored):
+        np.save(os.path.join(newdir,"%d.npy"%aidx),array)
+      with open(os.path.join(newdir,"index.pkl"),'wb') as outf:
+        pickle.dump(index,outf,protocol=pickle.HIGHEST_PROTOCOL)
+      with self._locked(exclusive=True):
+        olddir = None
+        if os.path.isdir(self.cachedir):
+          olddir = tempfile.mkdtemp(dir=parent,prefix=os.path.basename(self.cachedir)+".old")
+          os.rename(self.cachedir,os.path.join(olddir,"cache"))
+        os.rename(newdir,self.cachedir)
+        newdir = None
+      if olddir is not None:
+        shutil.rmtree(olddir,ignore_errors=True)
+    except OSError as err:
+      print("CrystalCache: Warning: couldn't write cache in %s (%s)."%(self.cachedir,err))
+    finally:
+      if newdir is not None:
+        shutil.rmtree(newdir,ignore_errors=True)
+    return gred,eigsys
+
+  #------------------------------------------------
+  def _load(self,value):
+    if isinstance(value,_StoredArray):
+      return np.load(os.path.join(self.cachedir,value.fname),mmap_mode='c')
+    if isinstance(value,np.ndarray):
+      return value.copy()
+    if isinstance(value,dict):
+      return dict([(k,self._load(v)) for k,v in value.items()])
+    if isinstance(value,(list,tuple)):
+      return type(value)([self._load(v) for v in value])
+    return value
+
+  #------------------------------------------------
+  # Same as read_gred(self.gred).
+  def read_gred(self):
+    with self._locked():
+      if self.valid():
+        return self._load(self.index['gred'])
+    return self.build()[0]
+
+  #------------------------------------------------
+  # Same as read_kred(info,basis,self.kred,kset,maxmo_spin).
+  def read_kred(self,kset='complex',maxmo_spin=-1):
+    with self._locked():
+      if self.valid():
+        return self._select(self.index['kred'],kset,maxmo_spin)
+    return self._select(self.build()[1],kset,maxmo_spin)
+
+  #------------------------------------------------
+  # The kpoints and rows of eigsys (parsed or from the index) that read_kred returns.
+  def _select(self,eigsys,kset,maxmo_spin):
+    eigvecs = {}
+    for kpt,parts in eigsys['eigvecs'].items():
+      if eigsys['ikpt_iscmpx'][kpt] and kset=='real': continue
+      eigvecs[kpt] = {}
+      for part in parts:
+        eigvecs[kpt][part] = []
+        for vecs in parts[part]:
+          vecs = self._load(vecs)
+          if maxmo_spin >= 0: vecs = vecs[:maxmo_spin]
+          eigvecs[kpt][part].append(vecs)
+    eigsys = dict([(k,self._load(v)) for k,v in eigsys.items() if k != 'eigvecs'])
+    eigsys['eigvecs'] = eigvecs
+    return eigsys
+
+# Place of an array of the cache in index.pkl.
+class _StoredArray:
+  def __init__(self,fname):
+    self.fname = fname
+
 ###############################################################################
 # Reads total spin from output file. 
 # TODO Is there a way around this? Yes.
@@ -454,7 +712,7 @@ def normalize_eigvec(eigsys,basis,kpt):
   if any(ao_type==1):
     error("sp orbtials not implemented in normalize_eigvec(...)","Not implemented")
 
-  for part in ['real','imag']:
+  for part in eigsys['eigvecs'][kpt]:
     for spin in range(eigsys['nspin']):
       eigsys['eigvecs'][kpt][part][spin][:,ao_type==0] *= snorm
       eigsys['eigvecs'][kpt][part][spin][:,ao_type==2] *= pnorm
@@ -470,37 +728,25 @@ def write_orb(eigsys,basis,ions,kpt,outfn,maxmo_spin=-1):
     maxmo_spin=basis['nmo']
 
   eigvecs_real = eigsys['eigvecs'][kpt]['real']
-  eigvecs_imag = eigsys['eigvecs'][kpt]['imag']
   atidxs = np.unique(basis['atom_shell'])-1
   nao_atom = np.zeros(atidxs.size,dtype=int)
   for shidx in range(len(basis['nao_shell'])):
     nao_atom[basis['atom_shell'][shidx]-1] += basis['nao_shell'][shidx]
   #nao_atom = int(round(sum(basis['nao_shell']) / len(ions['positions'])))
-  coef_cnt = 1
   totnmo = maxmo_spin*eigsys['nspin'] #basis['nmo'] * eigsys['nspin']
-  for moidx in np.arange(totnmo)+1:
-    for atidx in atidxs+1:
-      for aoidx in np.arange(nao_atom[atidx-1])+1:
-        outf.write(" {:5d} {:5d} {:5d} {:5d}\n"\
-            .format(moidx,aoidx,atidx,coef_cnt))
-        coef_cnt += 1
-  eigreal_flat = [e[0:maxmo_spin,:].flatten() for e in eigvecs_real]
-  eigimag_flat = [e[0:maxmo_spin,:].flatten() for e in eigvecs_imag]
-  print_cnt = 0
+  orbfile.write_index(outf,totnmo,nao_atom[atidxs],atidxs+1,fmt=" %5d %5d %5d %5d\n")
   outf.write("COEFFICIENTS\n")
   if eigsys['ikpt_iscmpx'][kpt]: #complex coefficients
-    for eigr,eigi in zip(eigreal_flat,eigimag_flat):
-      for r,i in zip(eigr,eigi):
-        outf.write("({:<.12e},{:<.12e}) "\
-            .format(r,i))
-        print_cnt+=1
-        if print_cnt%5==0: outf.write("\n")
+    eigvecs = []
+    for eigr,eigi in zip(eigvecs_real,eigsys['eigvecs'][kpt]['imag']):
+      eig = np.empty(eigr[0:maxmo_spin,:].shape,dtype=complex)
+      eig.real = eigr[0:maxmo_spin,:]
+      eig.imag = eigi[0:maxmo_spin,:]
+      eigvecs.append(eig)
+    orbfile.write_coefficients(outf,eigvecs,None,5,cfmt="(%.12e,%.12e) ")
   else: #Real coefficients
-    for eigr in eigreal_flat:
-      for r in eigr:
-        outf.write("{:< 15.12e} ".format(r))
-        print_cnt+=1
-        if print_cnt%5==0: outf.write("\n")
+    orbfile.write_coefficients(outf,[e[0:maxmo_spin,:] for e in eigvecs_real],"% -15.12e ",5)
+  outf.close()
 
 ###############################################################################
 # TODO Generalize to no pseudopotential.
@@ -725,9 +971,18 @@ def convert_crystal(
     base="qwalk",
     propoutfn="prop.in.o",
     kset='complex',
-    nvirtual=50):
+    nvirtual=50,
+    path="./",
+    cache=False,
+    nproc=1):
   """
   Files are named by [base]_[kindex].sys etc.
+  Inputs are read from and files are written to path. The file names returned
+  (and those referenced inside the files) are relative to path.
+  With cache, the parsed files are kept in path/crystal_cache (see CrystalCache), which
+  only pays off if the same files are converted again.
+  With nproc > 1, the files of the kpoints are written by that many forked
+  processes, which share the parsed data (see forkpool).
   """
   # kfmt='coord' is probably a bad thing because it doesn't always work and can 
   # lead to unexpected changes in file name conventions.
@@ -735,21 +990,32 @@ def convert_crystal(
   # keeps track of the files that get produced.
   files={}
 
-  info, lat_parm, ions, basis, pseudo = read_gred()
-  eigsys = read_kred(info,basis)
-
-  if eigsys['nspin'] > 1:
-    eigsys['totspin'] = read_outputfile(propoutfn)
+  if cache:
+    crycache = CrystalCache(os.path.join(path,"GRED.DAT"),os.path.join(path,"KRED.DAT"))
+    info, lat_parm, ions, basis, pseudo = crycache.read_gred()
   else:
-    eigsys['totspin'] = 0
+    info, lat_parm, ions, basis, pseudo = read_gred(os.path.join(path,"GRED.DAT"))
 
-  # Useful quantities.
+  # Number of orbitals needed, so only those are read from KRED.DAT.
+  if info[63]+1 > 1:
+    totspin = read_outputfile(os.path.join(path,propoutfn))
+  else:
+    totspin = 0
   basis['ntot'] = int(round(sum(basis['charges'])))
   basis['nmo']  = sum(basis['nao_shell']) # = nao
-  eigsys['nup'] = int(round(0.5 * (basis['ntot'] + eigsys['totspin'])))
-  eigsys['ndn'] = int(round(0.5 * (basis['ntot'] - eigsys['totspin'])))
+  nup = int(round(0.5 * (basis['ntot'] + totspin)))
+  ndn = int(round(0.5 * (basis['ntot'] - totspin)))
+  maxmo_spin=min(max(nup,ndn)+nvirtual,basis['nmo'])
 
-  maxmo_spin=min(max(eigsys['nup'],eigsys['ndn'])+nvirtual,basis['nmo'])
+  if cache:
+    eigsys = crycache.read_kred(kset,maxmo_spin)
+  else:
+    eigsys = read_kred(info,basis,os.path.join(path,"KRED.DAT"),kset,maxmo_spin)
+
+  # Useful quantities.
+  eigsys['totspin'] = totspin
+  eigsys['nup'] = nup
+  eigsys['ndn'] = ndn
   if (np.array(eigsys['kpt_coords']) >= 10).any():
     print("Cannot use coord kpoint format when SHRINK > 10.")
     print("Falling back on int format (old style).")
@@ -765,9 +1031,10 @@ def convert_crystal(
       'sys':{},
       'slater':{}
     }
-  write_basis(basis,ions,files['basis'])
-  write_jast2(lat_parm,ions,files['jastrow2'])
+  write_basis(basis,ions,os.path.join(path,files['basis']))
+  write_jast2(lat_parm,ions,os.path.join(path,files['jastrow2']))
  
+  kpts=[]
   for kpt in eigsys['kpt_coords']:
     if eigsys['ikpt_iscmpx'][kpt] and kset=='real': continue
     kidx=eigsys['kpt_index'][kpt]
@@ -776,20 +1043,26 @@ def convert_crystal(
     files['slater'][kidx]="%s_%d.slater"%(base,kidx)
     files['orb'][kidx]="%s_%d.orb"%(base,kidx)
     files['sys'][kidx]="%s_%d.sys"%(base,kidx)
+    kpts.append(kpt)
+
+  # The kpoints are independent: each only normalizes its own eigenvectors.
+  def write_kpoint(kpt):
+    kidx=eigsys['kpt_index'][kpt]
     write_slater(basis,eigsys,kpt,
-        outfn=files['slater'][kidx],
+        outfn=os.path.join(path,files['slater'][kidx]),
         orbfn=files['orb'][kidx],
         basisfn=files['basis'],
         maxmo_spin=maxmo_spin)
     write_orbplot(basis,eigsys,kpt,
-        outfn=files['orbplot'][kidx],
+        outfn=os.path.join(path,files['orbplot'][kidx]),
         orbfn=files['orb'][kidx],
         basisfn=files['basis'],
         sysfn=files['sys'][kidx],
         maxmo_spin=maxmo_spin)
     normalize_eigvec(eigsys,basis,kpt)
-    write_orb(eigsys,basis,ions,kpt,files['orb'][kidx],maxmo_spin)
-    write_sys(lat_parm,basis,eigsys,pseudo,ions,kpt,files['sys'][kidx])
+    write_orb(eigsys,basis,ions,kpt,os.path.join(path,files['orb'][kidx]),maxmo_spin)
+    write_sys(lat_parm,basis,eigsys,pseudo,ions,kpt,os.path.join(path,files['sys'][kidx]))
+  forkpool.fork_map(write_kpoint,kpts,nproc)
 
   return files
 
@@ -804,7 +1077,11 @@ if __name__ == "__main__":
       help="[='complex'] 'real' or 'complex' kpoints.")
   parser.add_argument('-v','--nvirtual',type=int,default=50,
       help="[=50] Number of unoccupied or virtual orbitals to allow access to.")
+  parser.add_argument('--cache',action='store_true',
+      help="Read or write the binary cache of GRED.DAT and KRED.DAT, for repeated conversions.")
+  parser.add_argument('-n','--nproc',type=int,default=1,
+      help="[=1] Number of processes writing kpoints at once.")
   args=parser.parse_args()
 
-  convert_crystal(args.base,args.propout,args.kset,args.nvirtual)
+  convert_crystal(args.base,args.propout,args.kset,args.nvirtual,cache=args.cache,nproc=args.nproc)
 
@@ -1,9 +1,10 @@
-from manager_tools import resolve_status, update_attributes
+from manager_tools import resolve_status, update_attributes, same_attributes, invalidate, locked
 from crystal import CrystalReader
 from propertiesreader import PropertiesReader
 from autorunner import RunnerPBS
+import statestore
+import runtimedb
 import os
-import pickle as pkl
 import shutil as sh
 import crystal2qmc
 from autopaths import paths
@@ -13,7 +14,7 @@ class CrystalManager:
   Has authority over file names associated with this task."""
   def __init__(self,writer,runner,creader=None,name='crystal_run',path=None,
       preader=None,prunner=None,
-      trylev=False,bundle=False,max_restarts=2):
+      trylev=False,bundle=False,max_restarts=2,store=None,fuse_properties=False,nproc=1):
     ''' CrystalManager manages the writing of a Crystal input file, it's running, and keeping track of the results.
     Args:
       writer (PySCFWriter): writer for input.
@@ -26,6 +27,10 @@ class CrystalManager:
       trylev (bool): When restarting use LEVSHIFT option to encourage convergence, then do a rerun without LEVSHIFT.
       bundle (bool): Whether you'll use a bundling tool to run these jobs.
       max_restarts (int): maximum number of times you'll allow restarting before giving up (and manually intervening).
+      store (store object): where the manager's state is saved (None implies statestore.default_store). See `statestore.py`.
+      fuse_properties (bool): run properties in the same job as crystal, right after the SCF converges,
+        instead of submitting it separately once the SCF results are collected.
+      nproc (int): processes writing the k-points when converting to QWalk (see `crystal2qmc.convert_crystal`).
     '''
     # Where to save self.
     self.name=name
@@ -41,6 +46,9 @@ class CrystalManager:
 
     #print(self.logname,": initializing")
 
+    if store is None: self.store=statestore.default_store
+    else: self.store=store
+
     # Handle reader and runner defaults.
     self.writer=writer
     if creader is None: self.creader=CrystalReader()
@@ -57,11 +65,18 @@ class CrystalManager:
     self.propinpfn=self.name+'.prop'
     self.crysoutfn=self.crysinpfn+'.o'
     self.propoutfn=self.propinpfn+'.o'
+    self.crysstamp=self.crysinpfn+'.runtime'
+    self.propstamp=self.propinpfn+'.runtime'
     self.restarts=0
     self._runready=False
+    self.bundle_ready=False
     self.scriptfile=None
     self.completed=False
+    # Status from `resolve_status` after the last step, which stores index.
+    self.run_status=None
     self.bundle=bundle
+    self.fuse_properties=fuse_properties
+    self.nproc=nproc
     self.qwfiles={ 
         'kpoints':[],
         'basis':'',
@@ -79,34 +94,38 @@ class CrystalManager:
     self.lev=False
 
     # Handle old results if present.
-    if os.path.exists(self.path+self.pickle):
+    # Changes to the state are flagged with _dirty, so the store only writes when something changed.
+    self._dirty=True
+    if self.store.exists(self.path,self.name):
       #print(self.logname,": rebooting old manager.")
-      old=pkl.load(open(self.path+self.pickle,'rb'))
+      old=self.store.load(self.path,self.name)
       self.recover(old)
+      # Whatever recover changes is rederived on the next load, so there's nothing new to save.
+      self._dirty=False
 
     # Update the file.
     if not os.path.exists(self.path): os.mkdir(self.path)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    self.store.save(self)
 
   #------------------------------------------------
   def recover(self,other):
     ''' Recover old class by copying over data. Retain variables from old that may change final answer.'''
     # Practically speaking, the run will preserve old `take_keys` and allow new changes to `skip_keys`.
     # This is because you are taking the attributes from the older instance, and copying into the new instance.
+    self._saved_fingerprint=other.__dict__.get('_fingerprint')
 
     update_attributes(copyto=self,copyfrom=other,
-        skip_keys=['writer','runner','creader','preader','prunner','lev','savebroy',
+        skip_keys=['writer','runner','creader','preader','prunner','store','lev','savebroy',
                    'path','logname','name',
-                   'trylev','max_restarts','bundle'],
-        take_keys=['restarts','completed','qwfiles'])
+                   'trylev','max_restarts','bundle','fuse_properties','nproc','_dirty'],
+        take_keys=['restarts','completed','run_status','qwfiles'])
 
     # Update queue settings, but save queue information.
     update_attributes(copyto=self.runner,copyfrom=other.runner,
-        skip_keys=['queue','walltime','np','nn','jobname'],
+        skip_keys=['queue','walltime','np','nn','jobname','priority'],
         take_keys=['queueid'])
     update_attributes(copyto=self.prunner,copyfrom=other.prunner,
-        skip_keys=['queue','walltime','np','nn','jobname'],
+        skip_keys=['queue','walltime','np','nn','jobname','priority'],
         take_keys=['queueid'])
 
     update_attributes(copyto=self.creader,copyfrom=other.creader,
@@ -117,42 +136,50 @@ class CrystalManager:
         skip_keys=[],
         take_keys=['completed','output'])
 
-    updated=update_attributes(copyto=self.writer,copyfrom=other.writer,
-        skip_keys=['maxcycle','edifftol'],
-        take_keys=['completed','modisymm','restart','guess_fort','_elements'])
-    if updated:
+    update_attributes(copyto=self.writer,copyfrom=other.writer,
+        skip_keys=['maxcycle','edifftol','completed'],
+        take_keys=['modisymm','restart','guess_fort','_elements'])
+    # The input is only rewritten if the writer differs from the one that wrote it.
+    if same_attributes(self.writer,other.writer,skip_keys=['completed']):
+      self.writer.completed=other.writer.completed
+    else:
       self.writer.completed=False
+      self._dirty=True
 
   #----------------------------------------
+  @locked
   def nextstep(self):
     ''' Determine and perform the next step in the calculation.'''
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self.recover(self.store.load(self.path,self.name))
 
     print(self.logname,": next step.")
-    cwd=os.getcwd()
-    os.chdir(self.path)
 
     # Generate input files.
+    # File names are relative to self.path, which is where the jobs run.
     if not self.writer.completed:
+      self._dirty=True
       if self.writer.guess_fort is not None:
-        sh.copy(self.writer.guess_fort,'fort.20')
-      with open(self.crysinpfn,'w') as f:
-        self.writer.write_crys_input(self.crysinpfn)
-      with open(self.propinpfn,'w') as f:
-        self.writer.write_prop_input(self.propinpfn)
+        sh.copy(os.path.join(self.path,self.writer.guess_fort),self.path+'fort.20')
+      self.writer.write_crys_input(self.path+self.crysinpfn)
+      self.writer.write_prop_input(self.path+self.propinpfn)
 
     # Check on the CRYSTAL run
-    status=resolve_status(self.runner,self.creader,self.crysoutfn)
+    status=resolve_status(self.runner,self.creader,self.path+self.crysoutfn,self.path+"%s.run"%self.name)
     print(self.logname,": status= %s"%(status))
 
     if status=="not_started":
+      self._dirty=True
       self.runner.add_command("cp %s INPUT"%self.crysinpfn)
-      self.runner.add_task("%s &> %s"%(paths['Pcrystal'],self.crysoutfn))
+      self._add_crystal_task()
 
     elif status=="ready_for_analysis":
       #This is where we (eventually) do error correction and resubmits
-      status=self.creader.collect(self.crysoutfn)
+      self._dirty=True
+      status=self.creader.collect(self.path+self.crysoutfn)
+      invalidate(self.creader)
       print(self.logname,": status %s"%status)
+      if status=='done':
+        runtimedb.record_run(self,self.runner,'crystal',self.crysstamp)
       if status=='killed':
         if self.restarts >= self.max_restarts:
           print(self.logname,": restarts exhausted (%d previous restarts). Human intervention required."%self.restarts)
@@ -165,55 +192,90 @@ class CrystalManager:
             self.savebroy=deepcopy(self.writer.broyden)
             self.writer.broyden=[]
             self.lev=True
-          sh.copy(self.crysinpfn,"%d.%s"%(self.restarts,self.crysinpfn))
-          sh.copy(self.crysoutfn,"%d.%s"%(self.restarts,self.crysoutfn))
-          sh.copy('fort.79',"%d.fort.79"%(self.restarts))
+          self._save_restart()
           self.writer.guess_fort='./fort.79'
-          sh.copy(self.writer.guess_fort,'fort.20')
-          self.writer.write_crys_input(self.crysinpfn)
-          sh.copy(self.crysinpfn,'INPUT')
-          self.runner.add_task("%s &> %s"%(paths['Pcrystal'],self.crysoutfn))
+          sh.copy(self.path+'fort.79',self.path+'fort.20')
+          self.writer.write_crys_input(self.path+self.crysinpfn)
+          sh.copy(self.path+self.crysinpfn,self.path+'INPUT')
+          self._add_crystal_task()
           self.restarts+=1
     elif status=='done' and self.lev:
       # We used levshift to converge. Now let's restart to be sure.
       print("Recovering from LEVSHIFTer.")
+      self._dirty=True
       self.writer.restart=True
       self.writer.levshift=[]
       self.creader.completed=False
       self.lev=False
-      sh.copy(self.crysinpfn,"%d.%s"%(self.restarts,self.crysinpfn))
-      sh.copy(self.crysoutfn,"%d.%s"%(self.restarts,self.crysoutfn))
-      sh.copy('fort.79',"%d.fort.79"%(self.restarts))
+      self._save_restart()
       self.writer.guess_fort='./fort.79'
-      sh.copy(self.writer.guess_fort,'fort.20')
-      self.writer.write_crys_input(self.crysinpfn)
-      sh.copy(self.crysinpfn,'INPUT')
-      self.runner.add_task("%s &> %s"%(paths['Pcrystal'],self.crysoutfn))
+      sh.copy(self.path+'fort.79',self.path+'fort.20')
+      self.writer.write_crys_input(self.path+self.crysinpfn)
+      sh.copy(self.path+self.crysinpfn,self.path+'INPUT')
+      self._add_crystal_task()
       self.restarts+=1
 
     # Ready for bundler or else just submit the jobs as needed.
+    runtimedb.autosize(self,self.runner,'crystal')
     if self.bundle:
       self.scriptfile="%s.run"%self.name
-      self.bundle_ready=self.runner.script(self.scriptfile)
+      self.bundle_ready=self.runner.script(self.path+self.scriptfile)
     else:
-      qsubfile=self.runner.submit(self.path.replace('/','-')+self.name)
+      qsubfile=self.runner.submit(self.path.replace('/','-')+self.name,cwd=self.path)
 
+    if self.completed!=self.creader.completed:
+      self._dirty=True
     self.completed=self.creader.completed
 
+    status=resolve_status(self.runner,self.creader,self.path+self.crysoutfn,self.path+"%s.run"%self.name)
+    if self.run_status!=status:
+      self._dirty=True
+    self.run_status=status
+
     # Update the file.
-    with open(self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
-    os.chdir(cwd)
+    self.store.save(self)
+
+  #----------------------------------------
+  def _add_crystal_task(self):
+    ''' Run crystal. With fuse_properties, the job also runs properties if the SCF converges.'''
+    runtimedb.add_timed_task(self.runner,"%s &> %s"%(paths['Pcrystal'],self.crysoutfn),self.crysstamp)
+    if self.fuse_properties:
+      # Properties from an earlier SCF would be out of date.
+      self.runner.add_command("rm -f %s"%self.propoutfn)
+      runtimedb.add_conditional_task(self.runner,
+          "grep -q 'SCF ENDED - CONVERGENCE ON ENERGY' %s"%self.crysoutfn,
+          "%s &> %s"%(paths['Pproperties'],self.propoutfn),self.propstamp,
+          setup=["cp %s INPUT"%self.propinpfn])
+
+  #----------------------------------------
+  def _save_restart(self):
+    ''' Keep copies of the files of the current attempt before restarting.'''
+    for fname in (self.crysinpfn,self.crysoutfn,'fort.79'):
+      sh.copy(self.path+fname,self.path+"%d.%s"%(self.restarts,fname))
+
+  #------------------------------------------------
+  def update_queueid(self,qid):
+    ''' If a bundler handles the submission, it can update the queue info with this.
+    Args:
+      qid (str): new queue id from submitting a job. The Manager will check if this is running.
+    '''
+    self.runner.queueid.append(qid)
+    self._dirty=True
+    self.bundle_ready=False # After running, we won't run again without more analysis.
+
+    # Update the file.
+    self.store.save(self)
 
   #----------------------------------------
   def collect(self):
     ''' Call the collect routine for readers.'''
     print(self.logname,": collecting results.")
     self.creader.collect(self.path+self.crysoutfn)
+    invalidate(self.creader)
+    self._dirty=True
 
     # Update the file.
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    self.store.save(self)
 
   #------------------------------------------------
   def script(self,jobname=None):
@@ -237,11 +299,12 @@ class CrystalManager:
     self.creader.write_summary()
     
   #------------------------------------------------
+  @locked
   def export_qwalk(self):
     ''' Export QWalk input files into current directory.
     Returns:
       bool: whether it was successful.'''
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self.recover(self.store.load(self.path,self.name))
 
     ready=False
     if len(self.qwfiles['slater'])==0:
@@ -250,41 +313,44 @@ class CrystalManager:
       if not self.completed:
         return False
 
-      cwd=os.getcwd()
-      os.chdir(self.path)
-
       print(self.logname,": %s attempting to generate QWalk files."%self.name)
 
       # Check on the properties run
-      status=resolve_status(self.prunner,self.preader,self.propoutfn)
+      status=resolve_status(self.prunner,self.preader,self.path+self.propoutfn)
       print(self.logname,": properties status= %s"%(status))
       if status=='not_started':
         ready=False
+        self._dirty=True
         self.prunner.add_command("cp %s INPUT"%self.propinpfn)
-        self.prunner.add_task("%s &> %s"%(paths['Pproperties'],self.propoutfn))
+        runtimedb.add_timed_task(self.prunner,"%s &> %s"%(paths['Pproperties'],self.propoutfn),self.propstamp)
 
+        runtimedb.autosize(self,self.prunner,'properties')
         if self.bundle:
           self.scriptfile="%s.run"%self.name
-          self.bundle_ready=self.prunner.script(self.scriptfile,self.driverfn)
+          self.bundle_ready=self.prunner.script(self.path+self.scriptfile)
         else:
-          qsubfile=self.runner.submit(self.path.replace('/','-')+self.name)
+          qsubfile=self.prunner.submit(self.path.replace('/','-')+self.name,cwd=self.path)
       elif status=='ready_for_analysis':
-        self.preader.collect(self.propoutfn)
+        self._dirty=True
+        self.preader.collect(self.path+self.propoutfn)
+        invalidate(self.preader)
+        if self.preader.completed:
+          # Fused properties runs used the crystal runner.
+          runtimedb.record_run(self,self.runner if self.fuse_properties else self.prunner,'properties',self.propstamp)
 
       if self.preader.completed:
         ready=True
         print(self.logname,": converting crystal to QWalk input now.")
-        self.qwfiles=crystal2qmc.convert_crystal(base=self.name,propoutfn=self.propoutfn)
+        self.qwfiles=crystal2qmc.convert_crystal(base=self.name,propoutfn=self.propoutfn,path=self.path,
+            nproc=self.nproc)
+        self._dirty=True
       else:
         ready=False
         print(self.logname,": conversion postponed because properties is not finished.")
-
-      os.chdir(cwd)
     else:
       ready=True
 
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    self.store.save(self)
 
     return ready
     
@@ -5,6 +5,7 @@ import subprocess as sub
 import shutil
 import submitter
 from submitter import LocalSubmitter
+from schedulers import PBSScheduler
 
 ####################################################
 
@@ -60,10 +61,11 @@ class CrystalRunnerPBS:
     self.prefix=prefix
     self.postfix=postfix
     self.queueid=None
+    self.scheduler=PBSScheduler()
 
   #-------------------------------------
   def check_status(self):
-    return submitter.check_PBS_status(self.queueid)
+    return self.scheduler.status([self.queueid])
   #-------------------------------------
 
   def run(self,crysinpfn,crysoutfn):
@@ -75,12 +77,7 @@ class CrystalRunnerPBS:
     np_tot=self.np*self.nn
  #"mpirun -np %i %s > %s\n"%(np_tot,exe,crysoutfn) +
     
-    qsub="#PBS -q %s \n"%self.queue +\
-         "#PBS -l nodes=%i:ppn=%i\n"%(self.nn,self.np) +\
-         "#PBS -l walltime=%s\n"%self.walltime +\
-         "#PBS -j oe \n" +\
-         "#PBS -N %s \n"%self.jobname +\
-         "#PBS -o %s \n"%jobout +\
+    qsub='\n'.join(self.scheduler.header(self.jobname,self.queue,self.walltime,self.nn,self.np,jobout))+"\n" +\
          self.prefix+"\n" +\
          "cd ${PBS_O_WORKDIR}\n" +\
          "cp %s INPUT\n"%(crysinpfn) +\
@@ -89,8 +86,7 @@ class CrystalRunnerPBS:
     qsubfile=crysinpfn+".qsub"
     with open(qsubfile,'w') as f:
       f.write(qsub)
-    result = sub.check_output("qsub %s"%(qsubfile),shell=True)
-    self.queueid = result.decode().split()[0]
+    self.queueid = self.scheduler.submit(qsubfile)
     print("Submitted as %s"%self.queueid)
 
 ####################################################
@@ -114,10 +110,11 @@ class CrystalRunnerVeritas:
     self.prefix=prefix
     self.postfix=postfix
     self.queueid=None
+    self.scheduler=PBSScheduler()
 
   #-------------------------------------
   def check_status(self):
-    return submitter.check_PBS_status(self.queueid)
+    return self.scheduler.status([self.queueid])
   #-------------------------------------
 
   def run(self,crysinpfn,crysoutfn):
@@ -129,12 +126,7 @@ class CrystalRunnerVeritas:
     np_tot=self.np*self.nn
  #"mpirun -np %i %s > %s\n"%(np_tot,exe,crysoutfn) +
     
-    qsub="#PBS -q %s \n"%self.queue +\
-         "#PBS -l nodes=%i:ppn=%i\n"%(self.nn,self.np) +\
-         "#PBS -l walltime=%s\n"%self.walltime +\
-         "#PBS -j oe \n" +\
-         "#PBS -N %s \n"%self.jobname +\
-         "#PBS -o %s \n"%jobout +\
+    qsub='\n'.join(self.scheduler.header(self.jobname,self.queue,self.walltime,self.nn,self.np,jobout))+"\n" +\
          self.prefix+"\n" +\
          "cd ${PBS_O_WORKDIR}\n" +\
          ". ~/bin/add_intel\n" +\
@@ -145,8 +137,7 @@ class CrystalRunnerVeritas:
     qsubfile=crysinpfn+".qsub"
     with open(qsubfile,'w') as f:
       f.write(qsub)
-    result = sub.check_output("qsub %s"%(qsubfile),shell=True)
-    self.queueid = result.decode().split()[0]
+    self.queueid = self.scheduler.submit(qsubfile)
     print("Submitted as %s"%self.queueid)
     
 
@@ -15,6 +15,7 @@ class DMCWriter:
         extra_observables (list): see `average_tools.py` for how to use this.
         minblocks (int): minimum number of DMC steps to take, considering equillibration time.
         iterations (int): number of DMC steps to attempt.
+        storeconfig (bool): save the walkers at the end of the run, so an unconverged run can be continued.
     '''
     self.trialfunc=''
     self.errtol=0.1
@@ -24,6 +25,11 @@ class DMCWriter:
     self.tmoves=True
     self.savetrace=True
     self.extra_observables=[]
+    self.storeconfig=True
+
+    # Set by the manager to continue a run from stored walkers.
+    self.readconfig=''
+    self.nblock_continue=None
 
     self.qmc_abr='dmc'
     self.completed=False
@@ -52,14 +58,22 @@ class DMCWriter:
       print(self.__class__.__name__,": Trial function not ready. Postponing input file generation.")
       self.completed=False
     else:
+      nblock=self.nblock
+      if self.readconfig!='' and self.nblock_continue is not None:
+        nblock=self.nblock_continue
       outlines=[
-          "method { dmc timestep %g nblock %i"%(self.timestep,self.nblock)
+          "method { dmc timestep %g nblock %i"%(self.timestep,nblock)
         ]
       if self.tmoves:
         outlines+=['tmoves']
       if self.savetrace:
-        tracename = "%s.trace"%infile
+        # QWalk runs in the directory of infile.
+        tracename = "%s.trace"%os.path.basename(infile)
         outlines+=['save_trace %s'%tracename]
+      if self.storeconfig:
+        outlines+=['storeconfig %s'%self.configfile(infile)]
+      if self.readconfig!='':
+        outlines+=['readconfig %s'%self.readconfig]
       for avg_opts in self.extra_observables:
         outlines+=avg.average_section(avg_opts)
       outlines+=["}"]
@@ -70,32 +84,70 @@ class DMCWriter:
 
       self.completed=True
 
+  #-----------------------------------------------
+  def configfile(self,infile):
+    ''' Name of the file the walkers are stored in, relative to the directory of infile.'''
+    return "%s.config"%os.path.basename(infile)
+
      
 ####################################################
 import subprocess as sub
 import json
+import numpy as np
+from arraystore import offload
 class DMCReader:
   ''' Reads results from a DMC calculation. 
 
+  A run that doesn't meet the tolerances can be continued from its stored walkers (see `QWalkManager`).
+  Each run is then a segment: the finished segments are kept in `segments`, and `output` 
+  combines the blocks of all the segments into one estimate (see `merge_segments`). 
+  Only the first segment has warmup blocks, since the later ones start from equilibrated walkers.
+
+  In adaptive mode, the error is corrected for the autocorrelation of the block energies, and the
+  manager sizes each continuation (blocks and walltime) from the corrected error and the time per block
+  of the run so far. A continuation that would cost more than `maxcorehours` isn't run: the run is
+  then left as it is, marked completed and refused.
+
   Attributes:
     output (dict): results of calculation. 
-    completed (bool): whether the run has converged to a final answer.
+    completed (bool): whether the run has converged to a final answer, or was refused a continuation.
+    refused (bool): whether the run stopped short of the tolerances, since continuing would cost too much.
+    segments (list): outputs of the earlier segments of a continued run.
   '''
-  def __init__(self,errtol=0.01,minblocks=15):
+  def __init__(self,errtol=0.01,minblocks=15,adaptive=False,maxcorehours=None,margin=0.5):
+    '''
+    Args:
+      errtol (float): tolerance for the error of the total energy.
+      minblocks (int): minimum number of blocks after warmup.
+      adaptive (bool): size continuations from the measured (autocorrelation-corrected) error.
+      maxcorehours (float): in adaptive mode, most core-hours to spend on a continuation (None for no limit).
+        When the runner uses np='allprocs', the cores per node aren't known, and this is in node-hours.
+      margin (float): in adaptive mode, the continuation's walltime is its expected runtime times (1+margin).
+    '''
     self.output={}
     self.completed=False
+    self.refused=False
+    self.segments=[]
+    self.last_segment=None
 
     self.errtol=errtol
     self.minblocks=minblocks
+    self.adaptive=adaptive
+    self.maxcorehours=maxcorehours
+    self.margin=margin
     self.gosling="gosling"
 
-  def read_outputfile(self,outfile):
+  def read_outputfile(self,outfile,skip=None):
     ''' Read output file results.
 
     Args:
       outfile (str): output to read.
+      skip (int): number of warmup blocks to skip (None lets gosling decide).
     '''
-    return json.loads(sub.check_output([self.gosling,"-json",outfile.replace('.o','.log')]).decode())
+    command=[self.gosling,"-json"]
+    if skip is not None:
+      command+=["-skip",str(skip)]
+    return json.loads(sub.check_output(command+[os.path.splitext(outfile)[0]+'.log']).decode())
 
   def check_complete(self):
     ''' Check if a DMC run is complete.
@@ -126,8 +178,17 @@ class DMCReader:
     self.completed=True
     status='unknown'
     if os.path.exists(outfile):
-      self.output=self.read_outputfile(outfile)
-      self.output['file']=outfile
+      # Large data (e.g. tbdm and derivative averages) goes to a sidecar file.
+      if len(self.segments)==0:
+        self.last_segment=offload(self.read_outputfile(outfile),outfile+'.npz')
+      else:
+        # Continued from equilibrated walkers: every block counts.
+        self.last_segment=offload(self.read_outputfile(outfile,skip=0),outfile+'.%d.npz'%len(self.segments))
+      self.last_segment['file']=outfile
+      if self.adaptive:
+        energies=read_block_energies(os.path.splitext(outfile)[0]+'.log')
+        self.last_segment['autocorrelation']=autocorrelation_time(energies[self.last_segment['warmup blocks']:])
+      self.output=offload(merge_segments(self.segments+[self.last_segment]),outfile+'.merged.npz')
 
     # Check files.
     self.completed=self.check_complete()
@@ -137,9 +198,107 @@ class DMCReader:
       status='ok'
     return status
       
+  #------------------------------------------------
+  def checkpoint(self):
+    ''' Keep the last run as a finished segment, before continuing it with a new one.'''
+    self.segments.append(self.last_segment)
+    self.last_segment=None
+
+  #------------------------------------------------
+  def blocks_needed(self,safety=1.1,minimum=5):
+    ''' Number of additional blocks expected to bring the run within tolerances,
+    assuming the error falls as 1/sqrt(blocks).
+    Args:
+      safety (float): factor on the estimate, to make another continuation unlikely.
+      minimum (int): fewest blocks to run.
+    '''
+    nblocks=self.output['total blocks']-self.output['warmup blocks']
+    error=self.output['properties']['total_energy']['error'][0]
+    if self.adaptive:
+      error*=np.sqrt(self.output.get('autocorrelation',1.0))
+    needed=max(nblocks*(error/self.errtol)**2,self.minblocks)-nblocks
+    return max(int(np.ceil(safety*needed)),minimum)
+
   #------------------------------------------------
   def write_summary(self):
     ''' Print out all the items in output. '''
     print("#### Diffusion Monte Carlo")
     for f,out in self.output.items():
       print(f,out)
+
+################################################
+def merge_segments(segments):
+  ''' Combine the results of the segments of a continued run, as if they were one run.
+
+  Averages are weighted by the number of blocks (after warmup) in each segment, and errors are
+  combined as for independent segments. Properties without a value and error, or that don't
+  match between segments, are taken from the last segment. Merged values are lists if the last
+  segment's were, and arrays otherwise (e.g. when they were offloaded), to be offloaded again.
+  Args:
+    segments (list): gosling outputs of each segment, in order.
+  Returns:
+    dict: combined output.
+  '''
+  if len(segments)==1:
+    return segments[0]
+  merged=dict(segments[-1])
+  weights=np.array([seg['total blocks']-seg['warmup blocks'] for seg in segments],dtype=float)
+  merged['total blocks']=sum([seg['total blocks'] for seg in segments])
+  merged['warmup blocks']=sum([seg['warmup blocks'] for seg in segments])
+  merged['segments']=len(segments)
+  taus=[seg['autocorrelation'] for seg in segments if 'autocorrelation' in seg]
+  if len(taus)>0:
+    merged['autocorrelation']=max(taus)
+
+  merged['properties']=dict(segments[-1]['properties'])
+  for key,prop in segments[-1]['properties'].items():
+    try:
+      values=np.concatenate([np.asarray(seg['properties'][key]['value'],dtype=float)[np.newaxis] for seg in segments])
+      errors=np.concatenate([np.asarray(seg['properties'][key]['error'],dtype=float)[np.newaxis] for seg in segments])
+    except (KeyError,TypeError,ValueError):
+      continue
+    w=weights.reshape((-1,)+(1,)*(values.ndim-1))
+    value=(w*values).sum(axis=0)/weights.sum()
+    error=np.sqrt((w**2*errors**2).sum(axis=0))/weights.sum()
+    merged['properties'][key]=dict(prop)
+    merged['properties'][key]['value']=value.tolist() if isinstance(prop['value'],list) else value
+    merged['properties'][key]['error']=error.tolist() if isinstance(prop['error'],list) else error
+  return merged
+
+################################################
+def read_block_energies(logfile):
+  ''' Total energy of each block in a QWalk log.'''
+  energies=[]
+  if not os.path.exists(logfile):
+    return np.array(energies)
+  with open(logfile,'r') as inpf:
+    for line in inpf:
+      spl=line.split()
+      if len(spl)>1 and spl[0]=='total_energy0':
+        energies.append(float(spl[1]))
+  return np.array(energies)
+
+################################################
+def autocorrelation_time(series):
+  ''' Integrated autocorrelation time of a series, in units of its spacing.
+
+  The autocorrelation is summed until it first drops to zero (or a quarter of the series). 
+  The variance of the mean is larger than for independent samples by this factor.
+  Returns:
+    float: at least 1; 1 if the series is too short to tell.
+  '''
+  series=np.asarray(series,dtype=float)
+  nsamp=len(series)
+  if nsamp<8:
+    return 1.0
+  dev=series-series.mean()
+  var=np.dot(dev,dev)/nsamp
+  if var==0:
+    return 1.0
+  tau=1.0
+  for lag in range(1,nsamp//4):
+    rho=np.dot(dev[:-lag],dev[lag:])/(nsamp*var)
+    if rho<=0:
+      break
+    tau+=2*rho
+  return tau
@@ -0,0 +1,74 @@
+''' Advance many managers at once.
+
+Most of the time in `nextstep` is spent waiting on files and subprocesses (qstat, qsub, gosling),
+so independent managers can be advanced concurrently in a thread pool. A process pool can be
+used instead when the parsing itself is the bottleneck; the managers are then advanced on copies
+and reloaded from their store afterwards.
+
+Managers must be independent: don't advance two managers in the same call if one depends on the
+other (the `Workflow` only advances managers whose dependencies are done, which satisfies this).
+An exception in one manager is recorded and doesn't stop the others.
+'''
+import traceback
+from manager_tools import manager_lock
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+#######################################################################
+def advance(mgr,method='nextstep'):
+  ''' Call mgr.method(), catching any exception.
+  Returns:
+    tuple: (result, traceback string or None, writes, writes avoided).
+  '''
+  writes,avoided=mgr.store.writes,mgr.store.writes_avoided
+  try:
+    # Other managers being advanced may export this one at the same time.
+    with manager_lock(mgr):
+      result=getattr(mgr,method)()
+    error=None
+  except Exception:
+    result=None
+    error=traceback.format_exc()
+  return result,error,mgr.store.writes-writes,mgr.store.writes_avoided-avoided
+
+#######################################################################
+class ManagerExecutor:
+  ''' Calls a method of many managers using a pool of workers.'''
+  def __init__(self,nworkers=8,processes=False):
+    '''
+    Args:
+      nworkers (int): maximum number of managers advanced at once. 1 runs serially without a pool.
+      processes (bool): use processes instead of threads.
+    '''
+    self.nworkers=nworkers
+    self.processes=processes
+
+  #------------------------------------------------
+  def run(self,calls):
+    ''' Call the methods and wait for them to finish.
+    Args:
+      calls (list): (manager, method name) pairs.
+    Returns:
+      dict: path+name to traceback, for each manager that raised an exception.
+    '''
+    if len(calls)==0:
+      return {}
+    if self.nworkers==1 or len(calls)==1:
+      results=[advance(mgr,method) for mgr,method in calls]
+    else:
+      if self.processes: pool=ProcessPoolExecutor
+      else:              pool=ThreadPoolExecutor
+      with pool(max_workers=min(self.nworkers,len(calls))) as workers:
+        futures=[workers.submit(advance,mgr,method) for mgr,method in calls]
+        results=[future.result() for future in futures]
+
+    errors={}
+    for (mgr,method),(result,error,writes,avoided) in zip(calls,results):
+      if self.processes and self.nworkers>1 and len(calls)>1:
+        # The work was done on a copy, so bring the manager up to date and count the copy's writes.
+        mgr.store.writes+=writes
+        mgr.store.writes_avoided+=avoided
+        mgr.recover(mgr.store.load(mgr.path,mgr.name))
+      if error is not None:
+        print(self.__class__.__name__,": %s raised an exception in %s:\n%s"%(mgr.path+mgr.name,method,error))
+        errors[mgr.path+mgr.name]=error
+    return errors
@@ -0,0 +1,45 @@
+''' Run independent pieces of a conversion in forked worker processes.
+
+The workers are forked from the process that has already parsed the data, so they use its
+arrays (including memory maps) directly: nothing is pickled or copied, except the pages a
+worker writes to. Only the items and the results are sent through pipes.
+
+Forking isn't available on every platform (e.g. Windows), in which case the work is done
+serially. It's also done serially when the process has other threads running (e.g. managers
+advanced by `executor.ManagerExecutor`), since a forked child only gets a copy of the calling
+thread, and a lock another thread held at the time stays locked in the child forever.
+Each item must be independent of the others, e.g. writing the files of one k-point.
+'''
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Function the workers of a pool call. It's set in each worker by the pool's initializer,
+# and is inherited by fork, so it doesn't need to be picklable.
+_work=None
+
+def _init(func):
+  global _work
+  _work=func
+
+def _call(item):
+  return _work(item)
+
+#######################################################################
+def fork_map(func,items,nproc=1):
+  ''' [func(item) for item in items], using up to nproc worker processes.
+
+  Args:
+    func (callable): function of one item; may be a closure over large data.
+    items (list): picklable arguments, one per call.
+    nproc (int): number of worker processes. 1 runs serially without forking.
+  Returns:
+    list: results, in the order of items.
+  '''
+  items=list(items)
+  if nproc<=1 or len(items)<=1 or 'fork' not in multiprocessing.get_all_start_methods() \
+      or threading.active_count()>1:
+    return [func(item) for item in items]
+  with ProcessPoolExecutor(max_workers=min(nproc,len(items)),
+      mp_context=multiprocessing.get_context('fork'),initializer=_init,initargs=(func,)) as workers:
+    return list(workers.map(_call,items))
@@ -82,9 +82,13 @@ class LinearReader:
     Attributes:
       output (dict): Results for energy, error, and other information.
       completed (bool): Whether no more runs are needed.
+      segments (list): outputs of earlier attempts, when restarts continue from the last wave function.
+        `output` then holds the steps of all the attempts, and the tests apply to all of them.
     '''
     self.output={}
     self.completed=False
+    self.segments=[]
+    self.last_segment=None
     self.sigtol=sigtol
     self.minsteps=minsteps
 
@@ -130,8 +134,13 @@ class LinearReader:
     # Gather output from files.
     status='unknown'
     if os.path.exists(outfile):
-      self.output=self.read_outputfile(outfile)
-      self.output['file']=outfile
+      self.last_segment=self.read_outputfile(outfile)
+      self.last_segment['file']=outfile
+      self.output=dict(self.last_segment)
+      # Steps of earlier attempts come first.
+      self.output['energy']=sum([seg['energy'] for seg in self.segments],[])+self.output['energy']
+      self.output['energy_err']=sum([seg['energy_err'] for seg in self.segments],[])+self.output['energy_err']
+      self.output['attempts']=len(self.segments)+1
 
     # Check files.
     self.completed=self.check_complete()
@@ -141,6 +150,12 @@ class LinearReader:
       status='ok'
     return status
       
+  #------------------------------------------------
+  def checkpoint(self):
+    ''' Keep the last attempt, before restarting from its wave function.'''
+    self.segments.append(self.last_segment)
+    self.last_segment=None
+
   #------------------------------------------------
   def write_summary(self):
     print("#### Linear optimization")
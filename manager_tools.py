@@ -1,13 +1,31 @@
 import numpy as np
 import os 
+import hashlib
+import threading
+import functools
+from arraystore import LazyArray
+import taskfarm
 
-def resolve_status(runner,reader,outfile):
+def resolve_status(runner,reader,outfile,scriptfile=None):
   #Check if the reader is done
   if reader.completed:
     return 'done'
 
   #Check if the job is in the queue or running. If so, we just return that.
-  currstat=runner.check_status()
+  #A task farm leaves a record of the script it ran for the last submission. A finished record saves
+  #asking the queue; a running one is only believed while the farm job is still in the queue, since
+  #a farm that's killed (walltime, node failure) can't update it.
+  record=None
+  if scriptfile is not None and len(runner.queueid)>0:
+    record=taskfarm.read_record(scriptfile)
+  if record is not None and record['queueid']==str(runner.queueid[-1]) and record['state'] in ('C','E'):
+    currstat='unknown'
+  else:
+    currstat=runner.check_status()
+    if record is not None and record['queueid']==str(runner.queueid[-1]) and currstat!='running':
+      record['state']='E'
+      record['stale']=True
+      taskfarm.write_record(scriptfile,record)
   if currstat=='running':
     return currstat
   
@@ -31,12 +49,112 @@ def deep_compare(d1,d2):
     for key in d1.keys():
       allsame=allsame and deep_compare(d1[key],d2[key])
     return allsame
+  elif type(d1)==LazyArray:
+    # Offloaded arrays are compared by content without reading them.
+    return d1==d2
   else:
     try:
       return np.array_equal(d1,d2)
     except TypeError:
       return d1==d2
 
+######################################################################
+# Content fingerprints.
+# Each object keeps a digest per attribute in `_fingerprint_parts` and the combined digest in `_fingerprint`.
+# Digests of large values are cached with a reference to the value, and are used as long as the
+# attribute is still that value. Code that changes a large value in place has to `invalidate` it,
+# as the managers do after a reader collects. The cache is pickled with the object (keeping the
+# references), so an object loaded from a store has the digests of its saved state without rehashing.
+
+# Attributes that are bookkeeping rather than state.
+fingerprint_skip_keys=('_fingerprint','_fingerprint_parts','_saved_fingerprint','_dirty','store')
+# Values at least this large (bytes hashed) have their digests cached.
+fingerprint_cache_bytes=4096
+
+def _hash_value(h,value):
+  ''' Feed value into the hash h in a way that's stable between runs. Returns the number of bytes hashed.'''
+  h.update(type(value).__name__.encode())
+  if isinstance(value,dict):
+    nbytes=0
+    for key in sorted(value.keys(),key=repr):
+      h.update(repr(key).encode())
+      nbytes+=_hash_value(h,value[key])
+    return nbytes
+  elif isinstance(value,(list,tuple)):
+    h.update(b'%d'%len(value))
+    return sum([_hash_value(h,v) for v in value])
+  elif isinstance(value,np.ndarray):
+    h.update(("%s%s"%(value.dtype,value.shape)).encode())
+    if value.dtype==object:
+      return sum([_hash_value(h,v) for v in value.flat])
+    h.update(np.ascontiguousarray(value).data)
+    return value.nbytes
+  elif isinstance(value,LazyArray):
+    h.update(value.digest.encode())
+    return 0
+  elif hasattr(value,'nextstep') and hasattr(value,'path') and hasattr(value,'name'):
+    # Managers (for example in trial functions) are identified by where they live, not their contents.
+    h.update((value.path+value.name).encode())
+    return 0
+  elif hasattr(value,'__dict__'):
+    h.update(fingerprint(value).encode())
+    return 0
+  else:
+    text=repr(value).encode()
+    h.update(text)
+    return len(text)
+
+def fingerprint_parts(obj,skip_keys=()):
+  ''' Digest of each attribute of obj, using cached digests where they're still valid.
+  Args:
+    obj (object): writer, reader, runner, or manager.
+    skip_keys (list): attributes not to digest, besides `fingerprint_skip_keys`.
+  Returns:
+    dict: attribute name to hex digest.
+  '''
+  cache=obj.__dict__.get('_fingerprint_parts',{})
+  newcache={}
+  parts={}
+  for key,value in obj.__dict__.items():
+    if key in fingerprint_skip_keys: continue
+    entry=cache.get(key)
+    if key in skip_keys:
+      # Not digested now, but a valid digest is kept for later.
+      if entry is not None: newcache[key]=entry
+      continue
+    if entry is not None and entry[-2] is value:
+      parts[key]=entry[-1]
+      newcache[key]=entry
+    else:
+      h=hashlib.sha1()
+      nbytes=_hash_value(h,value)
+      parts[key]=h.hexdigest()
+      if nbytes>=fingerprint_cache_bytes:
+        newcache[key]=(value,parts[key])
+  obj.__dict__['_fingerprint_parts']=newcache
+  return parts
+
+def fingerprint(obj):
+  ''' Stable digest of the contents of obj. Also stored in obj._fingerprint.'''
+  parts=fingerprint_parts(obj)
+  h=hashlib.sha1()
+  for key in sorted(parts.keys()):
+    h.update(key.encode())
+    h.update(parts[key].encode())
+  obj.__dict__['_fingerprint']=h.hexdigest()
+  return obj.__dict__['_fingerprint']
+
+def invalidate(obj,keys=None):
+  ''' Forget cached digests of obj, for example after modifying an attribute in place.
+  Args:
+    keys (list): attributes to forget (None means all).
+  '''
+  cache=obj.__dict__.get('_fingerprint_parts',{})
+  if keys is None: keys=list(cache.keys())
+  for key in keys:
+    cache.pop(key,None)
+  obj.__dict__.pop('_fingerprint',None)
+
 ######################################################################
 def update_attributes(copyto,copyfrom,skip_keys=[],take_keys=[]):
   ''' Save update of class attributes. If copyfrom has additional attributes, they are ignored.
@@ -49,25 +167,81 @@ def update_attributes(copyto,copyfrom,skip_keys=[],take_keys=[]):
   Returns:
     bool: Whether any changes were made.
   '''
+  # Attributes with matching fingerprints are the same, so only the others need a full comparison.
+  # Both objects normally have their digests cached: copyto from the last call, and copyfrom
+  # from when it was saved. Skipped attributes (e.g. the reader of a manager) aren't digested.
+  toparts=fingerprint_parts(copyto,skip_keys)
+  fromparts=fingerprint_parts(copyfrom,skip_keys)
+  if toparts==fromparts:
+    return False
+
   updated=False
   for key in copyfrom.__dict__.keys():
-    if key in skip_keys: 
+    if key in skip_keys or key in fingerprint_skip_keys: 
       #print("Skipping key (%s)"%key)
       pass
     elif key not in copyto.__dict__.keys():
       print("Warning: Object update. An attribute (%s) was skipped because it doesn't exist in both objects."%key)
+    elif toparts.get(key)==fromparts.get(key):
+      pass
     elif not deep_compare(copyto.__dict__[key],copyfrom.__dict__[key]):
       if key not in take_keys:
         print("Warning: update to attribute (%s) cancelled, because it requires job to be rerun."%key)
       else:
         #print("Copy",key)
         copyto.__dict__[key]=copyfrom.__dict__[key]
+        # The digest comes along with the value.
+        invalidate(copyto,[key])
+        if key in copyfrom.__dict__.get('_fingerprint_parts',{}):
+          copyto.__dict__['_fingerprint_parts'][key]=(copyto.__dict__[key],fromparts[key])
         updated=True
     else:
       #print("Keys match (%s)"%key)
       pass
   return updated
 
+def same_attributes(obj,other,skip_keys=()):
+  ''' Whether obj and other have the same attributes, besides skip_keys.
+
+  Args:
+    obj (obj): e.g. the writer of a manager.
+    other (obj): e.g. the writer of the saved manager.
+    skip_keys (list): attributes (str) that don't matter.
+  Returns:
+    bool: Whether they're the same.
+  '''
+  objparts=fingerprint_parts(obj,skip_keys)
+  otherparts=fingerprint_parts(other,skip_keys)
+  if objparts.keys()!=otherparts.keys():
+    return False
+  for key in objparts.keys():
+    if objparts[key]!=otherparts[key] and not deep_compare(obj.__dict__[key],other.__dict__[key]):
+      return False
+  return True
+
+######################################################################
+# Managers advanced from several threads at once (see executor.py) can share an upstream manager,
+# e.g. k-point DMCs that all export the same CrystalManager. Each manager has a reentrant lock,
+# kept here by path and name rather than on the manager, since managers are pickled.
+_manager_locks={}
+_manager_locks_lock=threading.Lock()
+
+def manager_lock(mgr):
+  ''' Lock for changing mgr from one thread at a time.'''
+  key=os.path.abspath(mgr.path)+'/'+mgr.name
+  with _manager_locks_lock:
+    if key not in _manager_locks:
+      _manager_locks[key]=threading.RLock()
+    return _manager_locks[key]
+
+def locked(method):
+  ''' Decorator for manager methods that hold the manager's lock while they run.'''
+  @functools.wraps(method)
+  def wrapper(self,*args,**kwargs):
+    with manager_lock(self):
+      return method(self,*args,**kwargs)
+  return wrapper
+
 def separate_jastrow(wffile,optimizebasis=False):
   ''' Seperate the jastrow section of a QWalk wave function file.'''
   # Copied from utils/separate_jastrow TODO: no copy, bad
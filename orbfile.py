@@ -0,0 +1,85 @@
+''' Write the orbital coefficient files (.orb) read by QWalk.
+
+An orb file has an index block, with a line (orbital, AO of the atom, atom, count) for each
+coefficient, then "COEFFICIENTS" and the coefficients, a fixed number per line.
+The converters (crystal2qmc and pyscf2qwalk) each have their own number formats, which are
+passed in as %-formats so their files don't change.
+
+The lines are made from arrays and formatted with one %-operation per chunk of numbers,
+and each chunk is written at once. This is much faster than a write per number, which
+takes minutes per k-point for large supercells.
+'''
+import numpy as np
+
+# Numbers formatted and written at once.
+chunk_size=2**16
+
+#######################################################################
+def _layout(fmt,perline,pos,count):
+  ''' Format string for count numbers, starting at position pos of a line.'''
+  if pos+count<perline:
+    return fmt*count
+  first=perline-pos
+  nlines,rest=divmod(count-first,perline)
+  return fmt*first+"\n"+(fmt*perline+"\n")*nlines+fmt*rest
+
+#######################################################################
+def write_index(f,nmo,naos,atoms=None,fmt="%i %i %i %i\n"):
+  ''' Write the index block.
+
+  Args:
+    f (file): open file to write to.
+    nmo (int): number of orbitals.
+    naos (list): number of AOs of each atom, in the order the coefficients are in.
+    atoms (list): atom number written for each atom (None implies counting from 1).
+    fmt (str): format of a line, taking (orbital, AO, atom, count).
+  '''
+  naos=np.asarray(naos,dtype=int)
+  if atoms is None: atoms=np.arange(naos.size)+1
+  # (AO, atom) for the coefficients of one orbital.
+  ao_idx=np.concatenate([np.arange(nao) for nao in naos]+[np.zeros(0,dtype=int)])+1
+  at_idx=np.repeat(np.asarray(atoms,dtype=int),naos)
+  nao=ao_idx.size
+  if nao==0: return
+  mos_chunk=max(1,chunk_size//nao)
+  for start in range(0,nmo,mos_chunk):
+    end=min(nmo,start+mos_chunk)
+    lines=np.empty((end-start,nao,4),dtype=int)
+    lines[:,:,0]=np.arange(start,end)[:,None]+1
+    lines[:,:,1]=ao_idx
+    lines[:,:,2]=at_idx
+    lines[:,:,3]=np.arange(start*nao,end*nao).reshape(end-start,nao)+1
+    f.write(fmt*((end-start)*nao)%tuple(lines.ravel().tolist()))
+
+#######################################################################
+def write_coefficients(f,coeffs,fmt,perline,cfmt=None):
+  ''' Write the coefficient block (after the "COEFFICIENTS" line).
+
+  Args:
+    f (file): open file to write to.
+    coeffs (list): arrays of coefficients, written in order (each flattened in C order),
+      as if they were one list. A single array is also accepted.
+    fmt (str): format of a real coefficient.
+    perline (int): coefficients per line; a newline follows every perline-th coefficient.
+    cfmt (str): format of a complex coefficient, taking (real, imaginary). Complex arrays
+      are written with cfmt, real arrays with fmt.
+  Returns:
+    int: number of coefficients written.
+  '''
+  if isinstance(coeffs,np.ndarray): coeffs=[coeffs]
+  count=0
+  for coeff in coeffs:
+    flat=np.asarray(coeff).ravel()
+    iscomplex=np.iscomplexobj(flat)
+    for start in range(0,flat.size,chunk_size):
+      values=flat[start:start+chunk_size]
+      if iscomplex:
+        pairs=np.empty((values.size,2),dtype=values.real.dtype)
+        pairs[:,0]=values.real
+        pairs[:,1]=values.imag
+        text=_layout(cfmt,perline,count%perline,values.size)%tuple(pairs.ravel().tolist())
+      else:
+        text=_layout(fmt,perline,count%perline,values.size)%tuple(values.tolist())
+      f.write(text)
+      count+=values.size
+  return count
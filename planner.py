@@ -0,0 +1,158 @@
+''' Plan what a set of managers will submit, and how much it will cost, without running anything.
+
+The planner walks the same dependency graph as `Workflow`, but only reads the managers' state:
+nothing is submitted, the queue isn't checked, and no input or job files are written.
+Every task that still has to run is listed with the resources its runner asks for and an
+estimated runtime, taken (in order of preference) from:
+  table: the `estimates` given by the user, by manager path+name or by kind (e.g. 'qwalk:dmc'),
+  model: the prediction of the runtime model in `runtimedb.py`, from previous runs of the kind,
+  walltime: the walltime the runner asks for (an upper bound, so the total is pessimistic).
+The plan totals the estimated core-hours (and the core-hours the requested walltimes could
+use), and finds the critical path: the chain of dependent managers that takes longest,
+which is the shortest the workflow can take however many jobs run at once, not counting
+the time spent waiting in the queue.
+
+Restarts and continuations aren't predicted, so the plan covers one run of each task.
+'''
+from __future__ import print_function
+import runtimedb
+from workflow import Workflow
+from schedulers import walltime_seconds, seconds_walltime
+
+#######################################################################
+def manager_tasks(mgr,exported=False):
+  ''' Tasks a manager has left, as runtimedb kinds.
+  Args:
+    mgr (Manager): manager to check.
+    exported (bool): whether other managers need its QWalk files (CrystalManager then runs properties).
+  Returns:
+    list: (kind, runner) for each task, in the order they run.
+  '''
+  if mgr.completed and not (exported and hasattr(mgr,'preader') and not mgr.preader.completed):
+    return []
+  if hasattr(mgr,'creader'):
+    tasks=[]
+    if not mgr.creader.completed:
+      tasks.append(('crystal',mgr.runner))
+    if exported and not mgr.preader.completed:
+      if mgr.fuse_properties: tasks.append(('properties',mgr.runner))
+      else:                   tasks.append(('properties',mgr.prunner))
+    return tasks
+  if hasattr(mgr.writer,'qmc_abr'):
+    return [('qwalk:%s'%mgr.writer.qmc_abr,mgr.runner)]
+  return [('pyscf',mgr.runner)]
+
+#######################################################################
+class Planner:
+  ''' Dry run of a set of managers and the managers they depend on.'''
+  def __init__(self,managers,estimates=None,db=None,ppn=32):
+    '''
+    Args:
+      managers (list): managers to plan (or a Workflow).
+      estimates (dict): runtimes in seconds, by manager path+name or by kind.
+      db (RuntimeDB): runtime model (None implies runtimedb.default_db).
+      ppn (int): cores per node, for runners that use all the cores of a node (np='allprocs').
+    '''
+    if isinstance(managers,Workflow): self.workflow=managers
+    else:                             self.workflow=Workflow(managers)
+    if estimates is None: self.estimates={}
+    else:                 self.estimates=estimates
+    if db is None: self.db=runtimedb.default_db
+    else:          self.db=db
+    self.ppn=ppn
+
+  #------------------------------------------------
+  def _cores(self,runner):
+    if runner.np=='allprocs': return runner.nn*self.ppn
+    return runner.nn*runner.np
+
+  #------------------------------------------------
+  def estimate(self,mgr,kind,runner):
+    ''' Estimated runtime of a task.
+    Returns:
+      tuple: (seconds, source), where source is 'table', 'model' or 'walltime'.
+    '''
+    if mgr.path+mgr.name in self.estimates:
+      return float(self.estimates[mgr.path+mgr.name]),'table'
+    if kind in self.estimates:
+      return float(self.estimates[kind]),'table'
+    predicted=self.db.predict(kind,runtimedb.features(mgr,kind),runtimedb.count_cores(runner.nn,runner.np))
+    if predicted is not None:
+      return predicted,'model'
+    return walltime_seconds(runner.walltime),'walltime'
+
+  #------------------------------------------------
+  def plan(self):
+    ''' Tasks left to run, their cost, and the critical path.
+    Returns:
+      dict: 'tasks' (list of dicts with 'key', 'kind', 'nodes', 'np', 'cores', 'walltime', 'runtime',
+        'source' and 'corehours'), 'corehours' (estimated total), 'requested' (core-hours of the
+        requested walltimes), 'critical' (keys of the managers on the critical path), and
+        'span' (seconds along the critical path).
+    '''
+    wf=self.workflow
+    tasks=[]
+    finish={}
+    previous={}
+    for key in wf.order:
+      mgr=wf.nodes[key]
+      runtime=0.0
+      for kind,runner in manager_tasks(mgr,exported=len(wf.consumers[key])>0):
+        seconds,source=self.estimate(mgr,kind,runner)
+        cores=self._cores(runner)
+        tasks.append({'key':key,'kind':kind,'nodes':runner.nn,'np':runner.np,'cores':cores,
+            'walltime':runner.walltime,'runtime':seconds,'source':source,
+            'corehours':seconds*cores/3600.})
+        tasks[-1]['requested']=walltime_seconds(runner.walltime)*cores/3600.
+        runtime+=seconds
+      # Managers start once everything they depend on is done.
+      start=0.0
+      previous[key]=None
+      for dep in wf.deps[key]:
+        if finish[dep]>start or previous[key] is None:
+          start=max(start,finish[dep])
+          previous[key]=dep
+      finish[key]=start+runtime
+
+    critical=[]
+    if len(finish)>0:
+      key=max(wf.order,key=lambda key:finish[key])
+      span=finish[key]
+      while key is not None:
+        critical.insert(0,key)
+        key=previous[key]
+    else:
+      span=0.0
+    return {
+        'tasks':tasks,
+        'corehours':sum([task['corehours'] for task in tasks]),
+        'requested':sum([task['requested'] for task in tasks]),
+        'critical':critical,
+        'span':span
+      }
+
+  #------------------------------------------------
+  def report(self,plan=None,budget=None):
+    ''' Print the plan.
+    Args:
+      plan (dict): result of `plan` (None implies making one).
+      budget (float): core-hours available; the report warns if the plan exceeds it.
+    Returns:
+      dict: the plan.
+    '''
+    if plan is None: plan=self.plan()
+    print(self.__class__.__name__,": %d tasks left for %d managers."%(len(plan['tasks']),len(self.workflow.nodes)))
+    print("  %-40s %-16s %5s %8s %10s %10s %-8s %10s"%\
+        ("manager","task","nodes","np","walltime","estimate","source","core-hrs"))
+    for task in plan['tasks']:
+      print("  %-40s %-16s %5d %8s %10s %10s %-8s %10.1f"%(task['key'],task['kind'],task['nodes'],task['np'],
+          task['walltime'],seconds_walltime(task['runtime']),task['source'],task['corehours']))
+    print("  estimated core-hours: %.1f (requested walltimes allow %.1f)"%(plan['corehours'],plan['requested']))
+    nguess=len([task for task in plan['tasks'] if task['source']=='walltime'])
+    if nguess>0:
+      print("  %d tasks have no estimate and are counted at their full walltime."%nguess)
+    print("  critical path (%s): %s"%(seconds_walltime(plan['span']),' -> '.join(plan['critical'])))
+    if budget is not None and plan['corehours']>budget:
+      print(self.__class__.__name__,": Warning: estimated %.1f core-hours exceeds the budget of %.1f."%\
+          (plan['corehours'],budget))
+    return plan
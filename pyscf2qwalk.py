@@ -1,9 +1,13 @@
 import sys
+import os
 import numpy as np
 from pyscf import gto,fci, mcscf, scf,pbc
 import math
 import cmath
 import json 
+import orbfile
+import forkpool
+import copy
 ###########################################################
 def find_label(sph_label):
   data = sph_label.split( )
@@ -17,7 +21,7 @@ def find_label(sph_label):
 
 #----------------------------------------------
 def print_orb(mol,m,f,k=0):
-  coeff=np.array(m.mo_coeff)
+  coeff=np.asarray(m.mo_coeff)
   print_orb_coeff(mol,coeff,f,k)
     
 
@@ -46,15 +50,8 @@ def print_orb_coeff(mol,coeff,f,k=0):
   coeff=mocoeff_project(coeff)
 
   nmo=coeff.shape[1]
-  count=0
-  for ni in range(nmo):
-    for ai,a in enumerate(aos_atom):
-      for bi,b in enumerate(range(a[2],a[3])):
-        f.write("%i %i %i %i\n"%(ni+1,bi+1,ai+1,count+1))
-        count += 1
+  orbfile.write_index(f,nmo,[a[3]-a[2] for a in aos_atom])
 
-
-  count=0
   f.write("COEFFICIENTS\n")
 
   snorm=1./math.sqrt(4.*math.pi)
@@ -97,16 +94,9 @@ def print_orb_coeff(mol,coeff,f,k=0):
   for i in gto.mole.spheric_labels(mol):
     aosym.append(find_label(i))
 
-  for a in coeff.T:
-    for ib,b in enumerate(a):
-      c=norms[aosym[ib]]*b
-      if isinstance(c,float):
-        f.write(str(c)+" ")
-      else:
-        f.write("("+str(c.real)+","+str(c.imag)+") ")
-      count+=1
-      if count%10==0:
-        f.write("\n")
+  # str() of a float is its repr.
+  aonorms=np.array([norms[sym] for sym in aosym])
+  orbfile.write_coefficients(f,aonorms*coeff.T,"%r ",10,cfmt="(%r,%r) ")
 
   f.write("\n")
   f.close() 
@@ -264,15 +254,15 @@ def print_sys(mol, f,kpoint=[0.,0.,0.]):
 
 def print_slater(mol, mf, orbfile, basisfile, f,k=0,occ=None):
   if occ is None:
-    occ=np.array(mf.mo_occ)
-  corb = np.array(mf.mo_coeff).flatten()[0]
+    occ=np.asarray(mf.mo_occ)
+  corb = np.asarray(mf.mo_coeff).flat[0]
   if isinstance(mol,pbc.gto.Cell):
     if len(occ.shape)==3:
       occ=occ[:,k,:]
-      corb=np.array(mf.mo_coeff)[0,k,:,:]
+      corb=np.asarray(mf.mo_coeff)[0,k,:,:]
     else:
       occ=occ[k,:]
-      corb=np.array(mf.mo_coeff)[k,:,:]
+      corb=np.asarray(mf.mo_coeff)[k,:,:]
       
   corb=mocoeff_project(corb)
   
@@ -500,7 +490,7 @@ def print_jastrow(mol,jastfile,optbasis=True,threebody=False):
 
 ###########################################################
 
-def print_qwalk_mol(mol, mf, method='scf', tol=0.01, basename='qw'):
+def print_qwalk_mol(mol, mf, method='scf', tol=0.01, basename='qw', path='./'):
   # Some are one-element lists to be compatible with PBC routines.
   files={
       'basis':basename+".basis",
@@ -511,25 +501,28 @@ def print_qwalk_mol(mol, mf, method='scf', tol=0.01, basename='qw'):
       'orb':[basename+".orb"]
     }
 
-  print_orb(mol,mf,open(files['orb'][0],'w'))
-  print_basis(mol,open(files['basis'],'w'))
-  print_sys(mol,open(files['sys'][0],'w'))
-  print_jastrow(mol,open(files['jastrow2'],'w'))
-  print_jastrow(mol,open(files['jastrow3'],'w'),threebody=True)
+  # Files are written in path, but refer to each other relative to path.
+  out=lambda fname: open(os.path.join(path,fname),'w')
+  print_orb(mol,mf,out(files['orb'][0]))
+  print_basis(mol,out(files['basis']))
+  print_sys(mol,out(files['sys'][0]))
+  print_jastrow(mol,out(files['jastrow2']))
+  print_jastrow(mol,out(files['jastrow3']),threebody=True)
 
   if method == 'scf':
-    print_slater(mol,mf,files['orb'][0],files['basis'],open(files['slater'][0],'w'))
+    print_slater(mol,mf,files['orb'][0],files['basis'],out(files['slater'][0]))
   elif method == 'mcscf':
     files['ci']=basename+".ci.json"
-    print_cas_slater(mf,files['orb'][0], files['basis'],open(files['slater'][0],'w'), 
-                     tol,open(files['ci'],'w'))
+    print_cas_slater(mf,files['orb'][0], files['basis'],out(files['slater'][0]), 
+                     tol,out(files['ci']))
   else:
     raise NotImplementedError("Conversion not available yet.")
 
   return files
 ###########################################################
 
-def print_qwalk_pbc(cell,mf,method='scf',tol=0.01,basename='qw'):
+def print_qwalk_pbc(cell,mf,method='scf',tol=0.01,basename='qw',path='./',nproc=1):
+  ''' Files of the kpoints are written by nproc forked processes, which share mf (see forkpool).'''
   files={
       'basis':basename+".basis",
       'jastrow2':basename+".jast2",
@@ -538,30 +531,38 @@ def print_qwalk_pbc(cell,mf,method='scf',tol=0.01,basename='qw'):
       'slater':["%s_%i.slater"%(basename,nk) for nk in range(mf.kpts.shape[0])]
     }
 
-  print_basis(cell,open(files['basis'],'w'))
-  print_jastrow(cell,open(files['jastrow2'],'w'))
+  out=lambda fname: open(os.path.join(path,fname),'w')
+  print_basis(cell,out(files['basis']))
+  print_jastrow(cell,out(files['jastrow2']))
+
+  # Convert the orbitals to arrays once, instead of once per kpoint.
+  kmf=copy.copy(mf)
+  kmf.mo_coeff=np.asarray(mf.mo_coeff)
+  kmf.mo_occ=np.asarray(mf.mo_occ)
   
   kpoints=cell.get_scaled_kpts(mf.kpts)
-  for i in range(mf.kpts.shape[0]):
-    print_slater(cell,mf,files['orb'][i],files['basis'],
-                 open(files['slater'][i],'w'),k=i)
-    print_sys(cell,open(files['sys'][i],'w'),kpoint=2.*kpoints[i,:])
-    print_orb(cell,mf,open(files['orb'][i],'w'),k=i)
+  def print_kpoint(i):
+    print_slater(cell,kmf,files['orb'][i],files['basis'],
+                 out(files['slater'][i]),k=i)
+    print_sys(cell,out(files['sys'][i]),kpoint=2.*kpoints[i,:])
+    print_orb(cell,kmf,out(files['orb'][i]),k=i)
+  forkpool.fork_map(print_kpoint,range(mf.kpts.shape[0]),nproc)
 
   return files
   
 ###########################################################
 
-def print_qwalk(mol,mf,method='scf',tol=0.01,basename='qw'):
-  ''' Convenience function for converting any PySCF object. '''
+def print_qwalk(mol,mf,method='scf',tol=0.01,basename='qw',path='./',nproc=1):
+  ''' Convenience function for converting any PySCF object. 
+  Files are written to path; nproc processes write the kpoints of periodic systems.'''
   if isinstance(mol,pbc.gto.Cell):
-    return print_qwalk_pbc(mol,mf,method,tol,basename)
+    return print_qwalk_pbc(mol,mf,method,tol,basename,path,nproc)
   else:
-    return print_qwalk_mol(mol,mf,method,tol,basename)
+    return print_qwalk_mol(mol,mf,method,tol,basename,path)
   
 ###########################################################
 
-def print_qwalk_chkfile(chkfile,method='scf',tol=0.01,basename='qw'):
+def print_qwalk_chkfile(chkfile,method='scf',tol=0.01,basename='qw',path='./',nproc=1):
   ''' Convenience function for converting using only the chkfile.'''
   from pyscf import lib
   import pyscf
@@ -578,7 +579,7 @@ def print_qwalk_chkfile(chkfile,method='scf',tol=0.01,basename='qw'):
       self.__dict__=lib.chkfile.load(chkfile,'scf')
 
   mf=FakeMF(chkfile)  
-  return print_qwalk(mol,mf,basename=basename)
+  return print_qwalk(mol,mf,basename=basename,path=path,nproc=nproc)
   
 ###########################################################
 
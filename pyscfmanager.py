@@ -1,14 +1,15 @@
-from manager_tools import resolve_status, update_attributes
+from manager_tools import resolve_status, update_attributes, same_attributes, invalidate, locked
 from autopyscf import PySCFReader,dm_from_chkfile
 from autorunner import PySCFRunnerPBS
 import os
 import shutil as sh 
-import pickle as pkl
 import pyscf2qwalk
+import statestore
+import runtimedb
 from autopaths import paths
 
 class PySCFManager:
-  def __init__(self,writer,reader=None,runner=None,name='psycf_run',path=None,bundle=False):
+  def __init__(self,writer,reader=None,runner=None,name='psycf_run',path=None,bundle=False,store=None,nproc=1):
     ''' PySCFManager manages the writing of a PySCF input file, it's running, and keep track of the results.
     Args:
       writer (PySCFWriter): writer for input.
@@ -17,6 +18,8 @@ class PySCFManager:
       name (str): identifier for this job. This names the files associated with run.
       path (str): directory where this manager is free to store information.
       bundle (bool): False - submit jobs. True - dump job commands into a script for a bundler to run.
+      store (store object): where the manager's state is saved (None implies statestore.default_store). See `statestore.py`.
+      nproc (int): processes writing the k-points when exporting to QWalk (see `pyscf2qwalk.print_qwalk_pbc`).
     '''
     # Where to save self.
     self.name=name
@@ -32,16 +35,21 @@ class PySCFManager:
 
     #print(self.logname,": initializing")
 
+    if store is None: self.store=statestore.default_store
+    else: self.store=store
+
     self.writer=writer
     if reader is not None: self.reader=reader
     else: self.reader=PySCFReader()
     if runner is not None: self.runner=runner
     else: self.runner=PySCFRunnerPBS()
     self.bundle=bundle
+    self.nproc=nproc
 
     self.driverfn="%s.py"%name
     self.outfile=self.driverfn+'.o'
     self.chkfile=self.driverfn+'.chkfile'
+    self.stampfile=self.driverfn+'.runtime'
     self.qwfiles={ 
         'kpoints':[],
         'basis':'',
@@ -52,119 +60,136 @@ class PySCFManager:
         'slater':{}
       }
     self.completed=False
+    # Status from `resolve_status` after the last step, which stores index.
+    self.run_status=None
     self.bundle_ready=False
     self.restarts=0
 
     # Handle old results if present.
-    if os.path.exists(self.path+self.pickle):
+    # Changes to the state are flagged with _dirty, so the store only writes when something changed.
+    self._dirty=True
+    if self.store.exists(self.path,self.name):
       print(self.logname,": rebooting old manager.")
-      old=pkl.load(open(self.path+self.pickle,'rb'))
+      old=self.store.load(self.path,self.name)
       self.recover(old)
+      # Whatever recover changes is rederived on the next load, so there's nothing new to save.
+      self._dirty=False
 
     # Update the file.
     if not os.path.exists(self.path): os.mkdir(self.path)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    self.store.save(self)
 
   #------------------------------------------------
   def recover(self,other):
     ''' Safe copy options from other to self. '''
     # Practically speaking, the run will preserve old `take_keys` and allow new changes to `skip_keys`.
     # This is because you are taking the attributes from the older instance, and copying into the new instance.
+    self._saved_fingerprint=other.__dict__.get('_fingerprint')
     updated=update_attributes(copyto=self,copyfrom=other,
-        skip_keys=['writer','runner','reader', 'path','logname','name','max_restarts','bundle'],
-        take_keys=['restarts','completed','qwfiles'])
+        skip_keys=['writer','runner','reader','store','path','logname','name','max_restarts','bundle','nproc','_dirty'],
+        take_keys=['restarts','completed','run_status','qwfiles'])
 
     update_attributes(copyto=self.runner,copyfrom=other.runner,
-        skip_keys=['queue','walltime','np','nn','jobname'],
+        skip_keys=['queue','walltime','np','nn','jobname','priority'],
         take_keys=['queueid'])
 
     update_attributes(copyto=self.reader,copyfrom=other.reader,
         skip_keys=[],
         take_keys=['completed','output'])
 
-    updated=update_attributes(copyto=self.writer,copyfrom=other.writer,
-        skip_keys=['max_cycle'],
-        take_keys=['completed','dm_generator'])
-
-    # Update the file.
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    update_attributes(copyto=self.writer,copyfrom=other.writer,
+        skip_keys=['max_cycle','completed'],
+        take_keys=['dm_generator'])
+    # The input is only rewritten if the writer differs from the one that wrote it.
+    if same_attributes(self.writer,other.writer,skip_keys=['completed']):
+      self.writer.completed=other.writer.completed
+    else:
+      self.writer.completed=False
+      self._dirty=True
     
   #------------------------------------------------
+  @locked
   def nextstep(self):
     ''' Determine and perform the next step in the calculation.'''
     # Recover old data.
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self.recover(self.store.load(self.path,self.name))
 
     print(self.logname,": next step.")
-    cwd=os.getcwd()
-    os.chdir(self.path)
 
+    # File names are relative to self.path, which is where the jobs run.
     if not self.writer.completed:
-      self.writer.pyscf_input(self.driverfn,self.chkfile)
+      self._dirty=True
+      self.writer.pyscf_input(self.path+self.driverfn,self.chkfile)
     
-    status=resolve_status(self.runner,self.reader,self.outfile)
+    status=resolve_status(self.runner,self.reader,self.path+self.outfile,self.path+"%s.run"%self.name)
     print(self.logname,": %s status= %s"%(self.name,status))
 
     if status=="not_started":
-      self.runner.add_task("python3 %s > %s"%(self.driverfn,self.outfile))
+      self._dirty=True
+      runtimedb.add_timed_task(self.runner,"python3 %s > %s"%(self.driverfn,self.outfile),self.stampfile)
     elif status=="ready_for_analysis":
-      status=self.reader.collect(self.outfile,self.chkfile)
+      self._dirty=True
+      status=self.reader.collect(self.path+self.outfile,self.path+self.chkfile)
+      invalidate(self.reader)
       if status=='killed':
         print(self.logname,": attempting restart (%d previous restarts)."%self.restarts)
-        sh.copy(self.driverfn,"%d.%s"%(self.restarts,self.driverfn))
-        sh.copy(self.outfile,"%d.%s"%(self.restarts,self.outfile))
-        sh.copy(self.chkfile,"%d.%s"%(self.restarts,self.chkfile))
-        if os.path.exists(self.chkfile):
+        for fname in (self.driverfn,self.outfile,self.chkfile):
+          sh.copy(self.path+fname,self.path+"%d.%s"%(self.restarts,fname))
+        if os.path.exists(self.path+self.chkfile):
           self.writer.dm_generator=dm_from_chkfile("%d.%s"%(self.restarts,self.chkfile))
-        self.writer.pyscf_input(self.driverfn,self.chkfile)
-        self.runner.add_task("/usr/bin/python3 %s > %s"%(self.driverfn,self.outfile))
+        self.writer.pyscf_input(self.path+self.driverfn,self.chkfile)
+        runtimedb.add_timed_task(self.runner,"/usr/bin/python3 %s > %s"%(self.driverfn,self.outfile),self.stampfile)
         self.restarts+=1
       elif status=='done':
         print(self.logname,": %s status= %s, task complete."%(self.name,status))
+        runtimedb.record_run(self,self.runner,'pyscf',self.stampfile)
 
     # Ready for bundler or else just submit the jobs as needed.
+    runtimedb.autosize(self,self.runner,'pyscf')
     if self.bundle:
       self.scriptfile="%s.run"%self.name
-      self.bundle_ready=self.runner.script(self.scriptfile,self.driverfn)
+      self.bundle_ready=self.runner.script(self.path+self.scriptfile)
     else:
-      qsubfile=self.runner.submit(jobname=self.path.replace('/','-')+self.name,ppath=[paths['pyscf']])
+      qsubfile=self.runner.submit(jobname=self.path.replace('/','-')+self.name,ppath=[paths['pyscf']],cwd=self.path)
 
+    if self.completed!=self.reader.completed:
+      self._dirty=True
     self.completed=self.reader.completed
+
+    status=resolve_status(self.runner,self.reader,self.path+self.outfile,self.path+"%s.run"%self.name)
+    if self.run_status!=status:
+      self._dirty=True
+    self.run_status=status
+
     # Update the file.
-    with open(self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
-    os.chdir(cwd)
+    self.store.save(self)
 
   #------------------------------------------------
   def update_queueid(self,qid):
     ''' If a bundler handles the submission, it can update the queue info with this.'''
     self.runner.queueid.append(qid)
+    self._dirty=True
+    self.bundle_ready=False # After running, we won't run again without more analysis.
     # Update the file.
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
-    self._runready=False # After running, we won't run again without more analysis.
+    self.store.save(self)
       
   #------------------------------------------------
+  @locked
   def export_qwalk(self):
     ''' Export QWalk input files into current directory.
     Returns:
       bool: whether it was successful.'''
     # Recover old data.
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self.recover(self.store.load(self.path,self.name))
 
     if len(self.qwfiles['slater'])==0:
       self.nextstep()
       if not self.completed:
         return False
       print(self.logname,": %s generating QWalk files."%self.name)
-      cwd=os.getcwd()
-      os.chdir(self.path)
-      self.qwfiles=pyscf2qwalk.print_qwalk_chkfile(self.chkfile)
-      os.chdir(cwd)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+      self.qwfiles=pyscf2qwalk.print_qwalk_chkfile(self.path+self.chkfile,path=self.path,nproc=self.nproc)
+      self._dirty=True
+    self.store.save(self)
     return True
 
   #----------------------------------------
@@ -1,13 +1,17 @@
-from manager_tools import resolve_status, update_attributes, separate_jastrow
+from manager_tools import resolve_status, update_attributes, same_attributes, invalidate, locked, separate_jastrow
 from autorunner import RunnerPBS
+import statestore
+import runtimedb
 import os
-import pickle as pkl
+import shutil as sh
+import numpy as np
+from schedulers import seconds_walltime
 from autopaths import paths
 
 #######################################################################
 class QWalkManager:
   def __init__(self,writer,reader,runner=None,trialfunc=None,
-      name='qw_run',path=None,bundle=False):
+      name='qw_run',path=None,bundle=False,store=None):
     ''' QWalkManager managers the writing of a QWalk input files, it's running, and keeping track of the results.
     Args:
       writer (qwalk writer): writer for input.
@@ -19,6 +23,7 @@ class QWalkManager:
       path (str): directory where this manager is free to store information.
       bundle (bool): False - submit jobs. True - dump job commands into a script for a bundler to run.
       qwalk (str): absolute path to qwalk executible.
+      store (store object): where the manager's state is saved (None implies statestore.default_store). See `statestore.py`.
     '''
     self.name=name
     self.pickle="%s.pkl"%(self.name)
@@ -33,6 +38,9 @@ class QWalkManager:
 
     #print(self.logname,": initializing")
 
+    if store is None: self.store=statestore.default_store
+    else: self.store=store
+
     self.writer=writer
     self.reader=reader
     self.trialfunc=trialfunc
@@ -41,6 +49,8 @@ class QWalkManager:
     self.bundle=bundle
 
     self.completed=False
+    # Status from `resolve_status` after the last step, which stores index.
+    self.run_status=None
     self.scriptfile=None
     self.bundle_ready=False
     self.infile=name
@@ -51,48 +61,58 @@ class QWalkManager:
         'wfout':''
       }
     self.stdout="%s.out"%self.infile
+    self.stampfile="%s.runtime"%self.infile
 
     # Handle old results if present.
-    if os.path.exists(self.path+self.pickle):
+    # Changes to the state are flagged with _dirty, so the store only writes when something changed.
+    self._dirty=True
+    if self.store.exists(self.path,self.name):
       print(self.logname,": rebooting old manager.")
-      old=pkl.load(open(self.path+self.pickle,'rb'))
+      old=self.store.load(self.path,self.name)
       self.recover(old)
+      # Whatever recover changes is rederived on the next load, so there's nothing new to save.
+      self._dirty=False
 
     # Update the file.
     if not os.path.exists(self.path): os.mkdir(self.path)
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    self.store.save(self)
 
   #------------------------------------------------
   def recover(self,other):
     ''' Recover old class by copying over data. Retain variables from old that may change final answer.'''
     # Practically speaking, the run will preserve old `take_keys` and allow new changes to `skip_keys`.
     # This is because you are taking the attributes from the older instance, and copying into the new instance.
+    self._saved_fingerprint=other.__dict__.get('_fingerprint')
 
     update_attributes(copyto=self,copyfrom=other,
-        skip_keys=['writer','runner','reader','path','logname','name','bundle'],
-        take_keys=['restarts','completed','trialfunc','qwfiles'])
+        skip_keys=['writer','runner','reader','store','path','logname','name','bundle','_dirty'],
+        take_keys=['restarts','completed','run_status','trialfunc','qwfiles'])
 
     # Update queue settings, but save queue information.
     update_attributes(copyto=self.runner,copyfrom=other.runner,
-        skip_keys=['queue','walltime','np','nn','jobname'],
+        skip_keys=['queue','walltime','np','nn','jobname','priority'],
         take_keys=['queueid'])
 
     update_attributes(copyto=self.reader,copyfrom=other.reader,
         skip_keys=[],
-        take_keys=['completed','output'])
+        take_keys=['completed','refused','output','segments','last_segment'])
 
-    updated=update_attributes(copyto=self.writer,copyfrom=other.writer,
-        skip_keys=['maxcycle','errtol','minblocks','nblock','savetrace'],
-        take_keys=['completed','tmoves','extra_observables','timestep','trialfunc'])
-    if updated:
+    update_attributes(copyto=self.writer,copyfrom=other.writer,
+        skip_keys=['maxcycle','errtol','minblocks','nblock','savetrace','completed'],
+        take_keys=['tmoves','extra_observables','timestep','trialfunc','readconfig','nblock_continue'])
+    # The input is only rewritten if the writer differs from the one that wrote it.
+    if same_attributes(self.writer,other.writer,skip_keys=['completed']):
+      self.writer.completed=other.writer.completed
+    else:
       self.writer.completed=False
+      self._dirty=True
 
   #------------------------------------------------
+  @locked
   def nextstep(self):
     ''' Perform next step in calculation. trialfunc managers are updated if they aren't completed yet.'''
     # Recover old data.
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self.recover(self.store.load(self.path,self.name))
 
     print(self.logname,": next step.")
 
@@ -100,46 +120,164 @@ class QWalkManager:
     if self.writer.trialfunc=='':
       print(self.logname,": checking trial function.")
       self.writer.trialfunc=self.trialfunc.export(self.path)
+      if self.writer.trialfunc!='':
+        self._dirty=True
 
     # Work on this job.
-    cwd=os.getcwd()
-    os.chdir(self.path)
+    # File names are relative to self.path, which is where the jobs run.
 
     # Write the input file.
     if not self.writer.completed:
-      self.writer.qwalk_input(self.infile)
+      self.writer.qwalk_input(self.path+self.infile)
+      self._dirty=self._dirty or self.writer.completed
     
-    status=resolve_status(self.runner,self.reader,self.outfile)
+    status=resolve_status(self.runner,self.reader,self.path+self.outfile,self.path+"%s.run"%self.name)
     print(self.logname,": %s status= %s"%(self.name,status))
     if status=="not_started" and self.writer.completed:
+      self._dirty=True
       exestr="%s %s &> %s"%(paths['qwalk'],self.infile,self.stdout)
-      self.runner.add_task(exestr)
+      runtimedb.add_timed_task(self.runner,exestr,self.stampfile)
       print(self.logname,": %s status= submitted"%(self.name))
     elif status=="ready_for_analysis":
       #This is where we (eventually) do error correction and resubmits
-      status=self.reader.collect(self.outfile)
+      self._dirty=True
+      status=self.reader.collect(self.path+self.outfile)
+      invalidate(self.reader)
       if status=='ok':
         print(self.logname,": %s status= %s, task complete."%(self.name,status))
+        runtimedb.record_run(self,self.runner,'qwalk:%s'%self.writer.qmc_abr,self.stampfile)
         self.completed=True
       else:
-        print(self.logname,": %s status= %s, attempting rerun."%(self.name,status))
-        exestr="%s %s &> %s"%(paths['qwalk'],self.infile,self.stdout)
-        self.runner.add_task(exestr)
-    elif status=='done':
+        plan=self._continue()
+        if plan=='continue' and self.writer.qmc_abr=='dmc':
+          print(self.logname,": %s status= %s, continuing from stored walkers for %d blocks."%\
+              (self.name,status,self.writer.nblock_continue))
+        elif plan=='continue':
+          print(self.logname,": %s status= %s, continuing optimization."%(self.name,status))
+        elif plan=='refused':
+          print(self.logname,": %s status= %s, keeping the result short of the tolerances."%(self.name,status))
+        else:
+          print(self.logname,": %s status= %s, attempting rerun."%(self.name,status))
+        if plan=='refused':
+          # Keep the result as it is, so the run isn't collected and refused again on every step.
+          self.reader.completed=True
+          self.reader.refused=True
+          invalidate(self.reader)
+          self.completed=True
+        else:
+          exestr="%s %s &> %s"%(paths['qwalk'],self.infile,self.stdout)
+          runtimedb.add_timed_task(self.runner,exestr,self.stampfile)
+    elif status=='done' and not self.completed:
+      self._dirty=True
       self.completed=True
 
     # Ready for bundler or else just submit the jobs as needed.
+    runtimedb.autosize(self,self.runner,'qwalk:%s'%self.writer.qmc_abr)
     if self.bundle:
       self.scriptfile="%s.run"%self.name
-      self.bundle_ready=self.runner.script(self.scriptfile)
+      self.bundle_ready=self.runner.script(self.path+self.scriptfile)
     else:
-      qsubfile=self.runner.submit(self.path.replace('/','-')+self.name)
+      qsubfile=self.runner.submit(self.path.replace('/','-')+self.name,cwd=self.path)
+
+    status=resolve_status(self.runner,self.reader,self.path+self.outfile,self.path+"%s.run"%self.name)
+    if self.run_status!=status:
+      self._dirty=True
+    self.run_status=status
 
     # Update the file.
-    with open(self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    self.store.save(self)
+
+  #------------------------------------------------
+  def _continue(self):
+    ''' Set up the run to continue from where the last run got to, rather than starting over.
+    Optimizations restart from the last wave function (see `_warm_start`); DMC continues
+    from the walkers stored by the last run.
+    For DMC, the last run is kept as a segment in the reader, and its log and trace are moved aside.
+    In adaptive mode (see `DMCReader`), the runner's walltime is also set for the continuation.
+    Returns:
+      str: 'continue', 'rerun' if the run can't be continued (e.g. the writer doesn't store walkers), 
+        or 'refused' if the continuation would cost too much.
+    '''
+    if self.writer.qmc_abr in ('variance','energy'):
+      return self._warm_start()
+    if not getattr(self.writer,'storeconfig',False):
+      return 'rerun'
+    configfile=self.writer.configfile(self.infile)
+    if not os.path.exists(self.path+configfile) or self.reader.last_segment is None:
+      return 'rerun'
+
+    nblock=self.reader.blocks_needed()
+    if self.reader.adaptive and not self._size_continuation(nblock):
+      return 'refused'
+
+    segment=len(self.reader.segments)
+    self.reader.checkpoint()
+    invalidate(self.reader)
+    for ext in ('log','trace'):
+      fname="%s.%s"%(self.infile,ext)
+      if os.path.exists(self.path+fname):
+        os.replace(self.path+fname,self.path+"%s.%d.%s"%(self.infile,segment,ext))
+
+    self.writer.readconfig=configfile
+    self.writer.nblock_continue=nblock
+    self.writer.qwalk_input(self.path+self.infile)
+    invalidate(self.writer)
+    return 'continue'
+
+  #------------------------------------------------
+  def _warm_start(self):
+    ''' Set up an optimization to restart from the wave function of the last attempt.
+    The attempt is kept in the reader, and its output and wave function are copied to `<infile>.<attempt>.*`.
+    Returns:
+      str: 'continue', or 'rerun' if the last attempt left no wave function (or the trial function
+        has no trialfunc section to replace).
+    '''
+    wfout="%s.wfout"%self.infile
+    if not os.path.exists(self.path+wfout) or getattr(self.reader,'last_segment',None) is None:
+      return 'rerun'
+
+    # Keep the system, and take the wave function from the last attempt.
+    lines=self.writer.trialfunc.split('\n')
+    for lidx,line in enumerate(lines):
+      if line.strip().startswith('trialfunc'):
+        break
+    else:
+      print(self.logname,": no trialfunc section to restart from; rerunning.")
+      return 'rerun'
+
+    attempt=len(self.reader.segments)
+    self.reader.checkpoint()
+    invalidate(self.reader)
+    start="%s.%d.wfout"%(self.infile,attempt)
+    sh.copy(self.path+wfout,self.path+start)
+    sh.copy(self.path+self.outfile,self.path+"%s.%d.o"%(self.infile,attempt))
 
-    os.chdir(cwd)
+    self.writer.trialfunc='\n'.join(lines[:lidx]+['trialfunc { include %s }'%start])
+    self.writer.qwalk_input(self.path+self.infile)
+    invalidate(self.writer)
+    print(self.logname,": restarting from %s."%start)
+    return 'continue'
+
+  #------------------------------------------------
+  def _size_continuation(self,nblock):
+    ''' Set the walltime for nblock more blocks, from the time per block of the last run.
+    Returns:
+      bool: False if the continuation would cost more than the reader's maxcorehours.
+    '''
+    stamps=runtimedb.read_stamp(self.path+self.stampfile)
+    if stamps is None or self.reader.last_segment['total blocks']==0:
+      print(self.logname,": time per block unknown, keeping walltime %s."%self.runner.walltime)
+      return True
+    perblock=(stamps[1]-stamps[0])/self.reader.last_segment['total blocks']
+    corehours=perblock*nblock*runtimedb.count_cores(self.runner.nn,self.runner.np)/3600.
+    print(self.logname,": %d more blocks needed, about %.1f core-hours."%(nblock,corehours))
+    if self.reader.maxcorehours is not None and corehours>self.reader.maxcorehours:
+      print(self.logname,": not continuing, since reaching errtol=%g would cost more than %g core-hours."%\
+          (self.reader.errtol,self.reader.maxcorehours))
+      return False
+    walltime=max(perblock*nblock*(1+self.reader.margin),600)
+    self.runner.walltime=seconds_walltime(60*np.ceil(walltime/60))
+    return True
 
   #------------------------------------------------
   def update_queueid(self,qid):
@@ -148,11 +286,11 @@ class QWalkManager:
       qid (str): new queue id from submitting a job. The Manager will check if this is running.
     '''
     self.runner.queueid.append(qid)
-    self._runready=False # After running, we won't run again without more analysis.
+    self._dirty=True
+    self.bundle_ready=False # After running, we won't run again without more analysis.
 
     # Update the file.
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    self.store.save(self)
 
   #----------------------------------------
   def status(self):
@@ -170,12 +308,14 @@ class QWalkManager:
     ''' Call the collect routine for readers.'''
     print(self.logname,": collecting results.")
     self.reader.collect(self.path+self.outfile)
+    invalidate(self.reader)
+    self._dirty=True
 
     # Update the file.
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    self.store.save(self)
 
   #----------------------------------------
+  @locked
   def export_qwalk(self):
     ''' Store resulting wave function into self.qwfiles['wfout']. Extract Jastrow and store in self.qwfiles['jastrow2']
     Returns:
@@ -183,7 +323,7 @@ class QWalkManager:
     # Theoretically more than just Jastrow can be provided, but practically that's the only type of wavefunction we tend to export.
 
     # Recover old data.
-    self.recover(pkl.load(open(self.path+self.pickle,'rb')))
+    self.recover(self.store.load(self.path,self.name))
 
     assert self.writer.qmc_abr!='dmc',"DMC doesn't provide a wave function."
 
@@ -192,15 +332,12 @@ class QWalkManager:
       if not self.completed:
         return False
       print(self.logname,": %s generating QWalk files."%self.name)
-      cwd=os.getcwd()
-      os.chdir(self.path)
       self.qwfiles['wfout']="%s.wfout"%self.infile
-      newjast=separate_jastrow(self.qwfiles['wfout'])
+      newjast=separate_jastrow(self.path+self.qwfiles['wfout'])
       self.qwfiles['jastrow2']="%s.jast"%self.infile
-      with open(self.qwfiles['jastrow2'],'w') as outf:
+      with open(self.path+self.qwfiles['jastrow2'],'w') as outf:
         outf.write(newjast)
-      os.chdir(cwd)
+      self._dirty=True
 
-    with open(self.path+self.pickle,'wb') as outf:
-      pkl.dump(self,outf)
+    self.store.save(self)
     return True
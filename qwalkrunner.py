@@ -6,6 +6,7 @@ import shutil
 import submitter
 
 from submitter import LocalSubmitter
+from schedulers import PBSScheduler
 
 ####################################################
 
@@ -56,10 +57,11 @@ class QWalkRunnerPBS:
     self.prefix=prefix
     self.postfix=postfix
     self.queueid=[]
+    self.scheduler=PBSScheduler()
 
   #-------------------------------------
   def check_status(self):
-    return submitter.check_PBS_stati(self.queueid)
+    return self.scheduler.status(self.queueid)
   #-------------------------------------
 
   def run(self,qwinps,qwouts,jobname=None):
@@ -72,12 +74,7 @@ class QWalkRunnerPBS:
       jobout=qwinp+".jobout"
       np_tot=self.np*self.nn
     
-      qsub="#PBS -q %s \n"%self.queue +\
-         "#PBS -l nodes=%i:ppn=%i\n"%(self.nn,self.np) +\
-         "#PBS -l walltime=%s\n"%self.walltime +\
-         "#PBS -j oe \n" +\
-         "#PBS -N %s \n"%jobname +\
-         "#PBS -o %s \n"%jobout +\
+      qsub='\n'.join(self.scheduler.header(jobname,self.queue,self.walltime,self.nn,self.np,jobout))+"\n" +\
          self.prefix+"\n" +\
          "cd ${PBS_O_WORKDIR}\n" +\
          "mpirun -np %i %s %s > %s \n"%(np_tot,self.exe,qwinp,qwinp+'.out') +\
@@ -85,6 +82,5 @@ class QWalkRunnerPBS:
       qsubfile=qwinp+".qsub"
       with open(qsubfile,'w') as f:
         f.write(qsub)
-      result = sub.check_output("qsub %s"%(qsubfile),shell=True)
-      self.queueid.append(result.decode().split()[0].split('.')[0])
+      self.queueid.append(self.scheduler.submit(qsubfile))
       print("Submitted as %s"%self.queueid)
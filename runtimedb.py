@@ -0,0 +1,384 @@
+''' Database of how long tasks took, for choosing the walltime and nodes of new tasks.
+
+Managers time each task they run (see `add_timed_task`): the job writes the start and end times
+to a stamp file next to the output. When the results are collected, `record_run` saves the runtime,
+the resources and some features of the system (see `features`) in the database.
+
+A runner with `autosize` set (a dict of options, see `RuntimeDB.suggest`) has its walltime and
+number of nodes chosen from the database before each submission (see `autosize`).
+Runtimes are modeled per kind of task as log-linear in the features and the number of cores:
+  log(runtime) = c + sum_i b_i log(feature_i) + b_cores log(cores)
+fitted on the previous runs of that kind. With too few runs to fit, the runtime is taken to be
+inversely proportional to the cores, scaled from the median of the previous runs.
+
+When np is 'allprocs', the number of cores isn't known, so nodes are used in its place.
+'''
+import os
+import re
+import sqlite3
+import time
+import numpy as np
+from contextlib import contextmanager
+from schedulers import walltime_seconds, seconds_walltime
+
+#######################################################################
+class RuntimeDB:
+  ''' Runtimes of previous tasks, kept in an SQLite database.
+
+  The database can be shared between projects (set AUTOGEN_RUNTIMES for the default one),
+  as long as the tasks run on the same kind of machine.
+  '''
+  def __init__(self,dbfile='runtimes.db',timeout=60.0):
+    '''
+    Args:
+      dbfile (str): database file. It's created on the first record.
+      timeout (float): seconds to wait on a database locked by another process.
+    '''
+    self.dbfile=os.path.abspath(dbfile)
+    self.timeout=timeout
+    # Tables are created once, here or by the first record, rather than on every connection.
+    self.created=False
+    if os.path.exists(self.dbfile):
+      self._create()
+
+  #------------------------------------------------
+  @contextmanager
+  def _connect(self):
+    ''' Connections are opened per operation, like in `statestore.SQLiteStore`.'''
+    conn=sqlite3.connect(self.dbfile,timeout=self.timeout)
+    try:
+      with conn:
+        yield conn
+    finally:
+      conn.close()
+
+  #------------------------------------------------
+  def _create(self):
+    ''' Create the tables if they don't exist yet.'''
+    with self._connect() as conn:
+      conn.executescript('''
+        create table if not exists runs (
+          kind text not null,
+          path text not null,
+          name text not null,
+          finished real not null,
+          runtime real not null,
+          nn integer,
+          np integer,
+          cores real not null,
+          predicted real,
+          features text not null,
+          primary key (path,name,kind,finished)
+        );
+        create index if not exists runs_kind on runs(kind);
+      ''')
+    self.created=True
+
+  #------------------------------------------------
+  def record(self,kind,features,runtime,nn,nproc,path='',name='',finished=None):
+    ''' Save the runtime of a task.
+    Args:
+      kind (str): kind of task (e.g. 'crystal', 'pyscf', 'qwalk:dmc').
+      features (dict): numerical features of the system.
+      runtime (float): seconds the task took.
+      nn (int): nodes the task used.
+      nproc (int or str): processors per node, or 'allprocs'.
+      path,name (str): manager the task belongs to.
+      finished (float): time the task finished (None implies now).
+    Returns:
+      float: runtime that was predicted for the task beforehand (None if there were no previous runs).
+    '''
+    if finished is None: finished=time.time()
+    cores=count_cores(nn,nproc)
+    predicted=self.predict(kind,features,cores)
+    if nproc=='allprocs': nproc=None
+    if not self.created:
+      self._create()
+    with self._connect() as conn:
+      conn.execute("insert or replace into runs "
+          "(kind,path,name,finished,runtime,nn,np,cores,predicted,features) values (?,?,?,?,?,?,?,?,?,?)",
+          (kind,path,name,finished,runtime,nn,nproc,cores,predicted,_encode(features)))
+    return predicted
+
+  #------------------------------------------------
+  def runs(self,kind=None):
+    ''' Previous runs.
+    Returns:
+      list: dicts with kind, path, name, runtime, nn, np, cores, predicted and features.
+    '''
+    sql="select kind,path,name,runtime,nn,np,cores,predicted,features from runs"
+    args=[]
+    if kind is not None:
+      sql+=" where kind=?"
+      args.append(kind)
+    if not os.path.exists(self.dbfile):
+      return []
+    with self._connect() as conn:
+      rows=conn.execute(sql+" order by finished",args).fetchall()
+    keys=('kind','path','name','runtime','nn','np','cores','predicted','features')
+    runs=[dict(zip(keys,row)) for row in rows]
+    for run in runs:
+      run['features']=_decode(run['features'])
+    return runs
+
+  #------------------------------------------------
+  def fit(self,kind,keys):
+    ''' Fit the log-linear model to the runs of this kind.
+    Args:
+      kind (str): kind of task.
+      keys (list): features to use. Features missing from some runs, or that are the same for all runs, are dropped.
+    Returns:
+      dict: 'keys' (features used), 'coef' (intercept, features, cores) and 'nruns'; None if there are no runs.
+    '''
+    runs=[run for run in self.runs(kind) if run['runtime']>0]
+    if len(runs)==0:
+      return None
+    logt=np.log([run['runtime'] for run in runs])
+    logc=np.log([run['cores'] for run in runs])
+
+    used=[]
+    for key in sorted(keys):
+      vals=[run['features'].get(key) for run in runs]
+      if any([v is None or v<=0 for v in vals]): continue
+      if np.ptp(np.log(vals))<1e-8: continue
+      used.append(key)
+    fitcores=np.ptp(logc)>1e-8
+
+    # Need more runs than parameters; drop the features that were added last until there are.
+    while len(used)+int(fitcores)+1>=len(runs) and len(used)>0:
+      used.pop()
+    if int(fitcores)+1>=len(runs):
+      fitcores=False
+
+    if len(used)==0 and not fitcores:
+      # Core-seconds are constant.
+      return {'keys':[],'coef':np.array([np.median(logt+logc),-1.0]),'nruns':len(runs)}
+
+    cols=[np.ones(len(runs))]+[np.log([run['features'][key] for run in runs]) for key in used]
+    if fitcores:
+      cols.append(logc)
+      design=np.array(cols).T
+      coef=np.linalg.lstsq(design,logt,rcond=None)[0]
+    else:
+      design=np.array(cols).T
+      coef=np.linalg.lstsq(design,logt+logc,rcond=None)[0]
+      coef=np.concatenate([coef,[-1.0]])
+    return {'keys':used,'coef':coef,'nruns':len(runs)}
+
+  #------------------------------------------------
+  def predict(self,kind,features,cores):
+    ''' Expected runtime of a task in seconds, or None if there are no previous runs of this kind.'''
+    model=self.fit(kind,[key for key,val in features.items() if val is not None and val>0])
+    if model is None:
+      return None
+    logt=model['coef'][0]+model['coef'][-1]*np.log(cores)
+    for key,coef in zip(model['keys'],model['coef'][1:-1]):
+      logt+=coef*np.log(features[key])
+    return float(np.exp(logt))
+
+  #------------------------------------------------
+  def suggest(self,kind,features,nproc='allprocs',margin=0.5,maxnodes=1,maxwalltime='48:00:00',
+      minwalltime='0:10:00'):
+    ''' Choose the number of nodes and walltime for a task.
+    The fewest nodes whose predicted runtime, plus the margin, fits in maxwalltime are used.
+    Args:
+      kind (str): kind of task.
+      features (dict): features of the system.
+      nproc (int or str): processors per node the task will use.
+      margin (float): walltime requested is the predicted runtime times (1+margin).
+      maxnodes (int): most nodes to request.
+      maxwalltime (str): longest walltime to request.
+      minwalltime (str): shortest walltime to request.
+    Returns:
+      tuple: (nn, walltime string), or None if there are no previous runs of this kind.
+    '''
+    maxtime=walltime_seconds(maxwalltime)
+    for nn in range(1,maxnodes+1):
+      predicted=self.predict(kind,features,count_cores(nn,nproc))
+      if predicted is None:
+        return None
+      if predicted*(1+margin)<=maxtime:
+        break
+    walltime=min(max(predicted*(1+margin),walltime_seconds(minwalltime)),maxtime)
+    # Round up to the minute.
+    return nn,seconds_walltime(60*np.ceil(walltime/60))
+
+  #------------------------------------------------
+  def report(self,kind=None):
+    ''' Print how the runtimes predicted before each task ran compare to the actual runtimes.'''
+    runs=self.runs(kind)
+    kinds=sorted(set([run['kind'] for run in runs]))
+    for kind in kinds:
+      kruns=[run for run in runs if run['kind']==kind]
+      print("#### %s: %d runs"%(kind,len(kruns)))
+      print("  %-40s %6s %12s %12s %8s"%("task","cores","actual","predicted","ratio"))
+      ratios=[]
+      for run in kruns:
+        if run['predicted'] is None:
+          predicted,ratio='-','-'
+        else:
+          ratios.append(run['predicted']/run['runtime'])
+          predicted,ratio=seconds_walltime(run['predicted']),"%.2f"%ratios[-1]
+        print("  %-40s %6g %12s %12s %8s"%(run['path']+run['name'],run['cores'],
+            seconds_walltime(run['runtime']),predicted,ratio))
+      if len(ratios)>0:
+        print("  predicted/actual: median %.2f, max %.2f"%(np.median(ratios),max(ratios)))
+
+#######################################################################
+def count_cores(nn,nproc):
+  ''' Cores used by nn nodes with nproc processors each (nodes if nproc is 'allprocs').'''
+  if nproc=='allprocs' or nproc is None: return float(nn)
+  return float(nn*nproc)
+
+def _encode(features):
+  return ' '.join(["%s=%r"%(key,float(val)) for key,val in sorted(features.items()) if val is not None])
+
+def _decode(text):
+  features={}
+  for item in text.split():
+    key,val=item.split('=')
+    features[key]=float(val)
+  return features
+
+#######################################################################
+def _crystal_features(mgr,outfile):
+  ''' Atoms and k-points from the input; basis functions and electrons from the output, if there is one.'''
+  features={}
+  writer=mgr.writer
+  if writer.struct is not None:
+    features['atoms']=len(writer.struct.get('sites',[]))
+  if writer.boundary=='3d':
+    features['kpoints']=int(np.prod(writer.kmesh))
+  else:
+    features['kpoints']=1
+  patterns=(('atoms',r'N\. OF ATOMS PER CELL\s+(\d+)'),
+            ('basis',r'NUMBER OF AO\s+(\d+)'),
+            ('electrons',r'N\. OF ELECTRONS PER CELL\s+(\d+)'))
+  if os.path.exists(outfile):
+    with open(outfile,'r') as inpf:
+      head=inpf.read(200000)
+    for key,pattern in patterns:
+      match=re.search(pattern,head)
+      if match is not None: features[key]=int(match.group(1))
+  return features
+
+def _pyscf_features(mgr):
+  features={}
+  writer=mgr.writer
+  atoms=[line for line in writer.xyz.split('\n') if len(line.split())>=4]
+  if len(atoms)>0: features['atoms']=len(atoms)
+  if hasattr(writer,'kpts'):
+    features['kpoints']=int(np.prod(writer.kpts))
+  if mgr.reader.completed and 'basis_labels' in mgr.reader.output:
+    features['basis']=len(mgr.reader.output['basis_labels'])
+  return features
+
+def _qwalk_features(mgr):
+  features={}
+  writer=mgr.writer
+  for key in ('nblock','timestep','iterations'):
+    if hasattr(writer,key): features[key]=getattr(writer,key)
+  # Electrons and atoms from the system file included in the trial function.
+  for line in writer.trialfunc.split('\n'):
+    spl=line.split()
+    if len(spl)==2 and spl[0]=='include' and os.path.exists(mgr.path+spl[1]):
+      with open(mgr.path+spl[1],'r') as inpf:
+        sysstr=inpf.read()
+      nspin=re.search(r'NSPIN\s*{\s*(\d+)\s+(\d+)',sysstr,re.IGNORECASE)
+      if nspin is not None:
+        features['electrons']=int(nspin.group(1))+int(nspin.group(2))
+        features['atoms']=len(re.findall(r'^\s*ATOM\s*{',sysstr,re.IGNORECASE|re.MULTILINE))
+  return features
+
+def features(mgr,kind):
+  ''' Numerical features of the system a manager's task works on.
+  Returns:
+    dict: some of atoms, electrons, basis (functions), kpoints, nblock, timestep and iterations.
+  '''
+  if kind=='crystal':
+    return _crystal_features(mgr,mgr.path+mgr.crysoutfn)
+  if kind=='properties':
+    return _crystal_features(mgr,mgr.path+mgr.crysoutfn)
+  if kind=='pyscf':
+    return _pyscf_features(mgr)
+  if kind.startswith('qwalk'):
+    return _qwalk_features(mgr)
+  return {}
+
+def task_kind(mgr):
+  ''' Kind of the task a manager's runner has to run, as its runtimes are recorded (see `record_run`).'''
+  if hasattr(mgr,'creader'):
+    if mgr.creader.completed: return 'properties'
+    return 'crystal'
+  if hasattr(mgr.writer,'qmc_abr'):
+    return 'qwalk:%s'%mgr.writer.qmc_abr
+  return 'pyscf'
+
+#######################################################################
+def add_timed_task(runner,exestr,stampfile):
+  ''' Add a task to the runner, recording when it starts and ends in stampfile.'''
+  runner.add_command("date +%%s > %s"%stampfile)
+  runner.add_task(exestr)
+  runner.add_command("date +%%s >> %s"%stampfile)
+
+#------------------------------------------------
+def add_conditional_task(runner,condition,exestr,stampfile,setup=()):
+  ''' Add a timed task that only runs if the shell command condition succeeds.
+  It's added as one command line (condition && setup && task), so it still holds together when
+  the lines of a job are run or bundled separately.
+  Args:
+    condition (str): shell command, e.g. "[ -f x.wfout ]".
+    setup (list): commands to run before the task, also only if condition succeeds.
+  '''
+  start=len(runner.exelines)
+  for cmdstr in setup:
+    runner.add_command(cmdstr)
+  add_timed_task(runner,exestr,stampfile)
+  lines=runner.exelines[start:]
+  if len(lines)==0:
+    return
+  del runner.exelines[start:]
+  runner.add_command(' && '.join([condition]+lines))
+
+#------------------------------------------------
+def read_stamp(fname):
+  ''' Start and end times written by a timed task.
+  Returns:
+    tuple: (start,end) in seconds, or None if the task hasn't finished (or wasn't timed).
+  '''
+  if not os.path.exists(fname):
+    return None
+  stamps=open(fname,'r').read().split()
+  if len(stamps)!=2:
+    return None
+  return float(stamps[0]),float(stamps[1])
+
+#------------------------------------------------
+def record_run(mgr,runner,kind,stampfile,db=None):
+  ''' Save the runtime of a manager's task, if it was timed. The stamp file is removed so it's only saved once.'''
+  if db is None: db=default_db
+  stamps=read_stamp(mgr.path+stampfile)
+  if os.path.exists(mgr.path+stampfile):
+    os.remove(mgr.path+stampfile)
+  if stamps is None:
+    return
+  start,end=stamps
+  predicted=db.record(kind,features(mgr,kind),end-start,runner.nn,runner.np,mgr.path,mgr.name,end)
+  if predicted is not None:
+    print(mgr.logname,": %s took %s (predicted %s)."%(kind,seconds_walltime(end-start),seconds_walltime(predicted)))
+
+#------------------------------------------------
+def autosize(mgr,runner,kind,db=None):
+  ''' If runner.autosize is set, choose the runner's nodes and walltime from previous runs.'''
+  options=getattr(runner,'autosize',None)
+  if options is None or len(runner.exelines)==0:
+    return
+  if db is None: db=default_db
+  suggestion=db.suggest(kind,features(mgr,kind),runner.np,**options)
+  if suggestion is None:
+    return
+  runner.nn,runner.walltime=suggestion
+  print(mgr.logname,": %s sized to %d nodes for %s."%(kind,runner.nn,runner.walltime))
+
+# Shared by the managers in this process.
+default_db=RuntimeDB(os.environ.get('AUTOGEN_RUNTIMES','runtimes.db'))
@@ -0,0 +1,286 @@
+''' Backends for batch schedulers.
+
+A scheduler knows how to talk to one queueing system:
+  header(jobname,queue,walltime,nn,np,jobout): directives at the top of a job script.
+  submit(scriptfile,cwd): submit a job script, returning its queue id.
+  status(queueids): 'running' if any of the jobs is queued or running, otherwise 'unknown'.
+  cancel(queueids): remove jobs from the queue.
+  array_submit(scriptfile,njobs,cwd): submit njobs copies of a script as one array job.
+    In the script, `array_index` expands to the index (0 to njobs-1) of the copy.
+  array_element(queueid,index): queue id of one copy of an array job, which `status` understands.
+    Elements are looked up one by one; the array as a whole only stands in for an element
+    when the queue snapshot doesn't list any of its elements (e.g. just after it was submitted).
+Runners take a scheduler (see `autorunner.py`), so the same managers can run on PBS or Slurm.
+`walltime_seconds` and `seconds_walltime` convert between walltime strings and seconds.
+
+LocalScheduler runs the job scripts as subprocesses after a simulated queue delay,
+which is useful for testing and benchmarking the workflow without a cluster.
+
+Schedulers are pickled with the runners, so the queue snapshots and local job
+table they use are kept at module level rather than in the objects.
+'''
+import os
+import math
+import subprocess as sub
+import time
+import itertools
+import submitter
+from submitter import QueueStatusCache
+
+#######################################################################
+def walltime_seconds(walltime):
+  ''' Convert a walltime string like '1:30:00' (or '30:00', '90') to seconds.'''
+  seconds=0
+  for part in str(walltime).split(':'):
+    seconds=seconds*60+float(part)
+  return seconds
+
+def seconds_walltime(seconds):
+  ''' Convert seconds to a walltime string like '1:30:00'.'''
+  seconds=int(math.ceil(seconds))
+  return "%d:%02d:%02d"%(seconds//3600,(seconds%3600)//60,seconds%60)
+
+#######################################################################
+def parse_squeue(out):
+  ''' Job states from `squeue -h -r -o "%i %t"`.
+  Without -r, pending array tasks are listed together (123_[4-9,12%2]); they're expanded here.
+  Returns:
+    dict: job id to state. Array tasks (id_index) are also listed under the array's id.
+  '''
+  jobs={}
+  for line in out.strip().split('\n'):
+    spl=line.split()
+    if len(spl)<2: continue
+    jobid,state=spl[0],spl[1]
+    if '_[' in jobid:
+      arrayid,ranges=jobid.rstrip(']').split('_[')
+      for rng in ranges.split('%')[0].split(','):
+        first,last=(rng.split('-')+[rng])[:2]
+        for index in range(int(first),int(last)+1):
+          jobs["%s_%d"%(arrayid,index)]=state
+    else:
+      jobs[jobid]=state
+    if '_' in jobid:
+      jobs.setdefault(jobid.split('_')[0],state)
+  return jobs
+
+slurm_cache=QueueStatusCache(command='squeue -h -r -o "%i %t"',parser=parse_squeue)
+
+#######################################################################
+def element_state(cache,queueid,arrayid,element_prefix):
+  ''' Queue state of a job or array element, or None if it's not in the queue.
+  An element that isn't listed has finished, unless none of its array's elements are listed:
+  then the array's entry (e.g. from `submitted`, before the next snapshot) stands in for it.
+  Args:
+    cache (QueueStatusCache): snapshot to look in.
+    queueid (str): id of the job or element.
+    arrayid (str): id of the element's array as a whole (None if queueid isn't an element).
+    element_prefix (str): start of the ids of the array's elements.
+  '''
+  state=cache.state(queueid)
+  if state is not None or arrayid is None:
+    return state
+  if len([jobid for jobid in cache.listed(element_prefix) if jobid!=arrayid])>0:
+    return None
+  return cache.state(arrayid)
+
+#######################################################################
+class PBSScheduler:
+  ''' Torque/PBS. Status comes from `submitter.queue_cache`.'''
+  running_states=('R','Q')
+  array_index='${PBS_ARRAYID}'
+
+  #------------------------------------------------
+  def header(self,jobname,queue,walltime,nn=1,np='allprocs',jobout=None):
+    if np=='allprocs':
+      nodes="#PBS -l nodes=%i,flags=allprocs"%nn
+    else:
+      nodes="#PBS -l nodes=%i:ppn=%i"%(nn,np)
+    lines=[
+        "#PBS -q %s"%queue,
+        nodes,
+        "#PBS -l walltime=%s"%walltime,
+        "#PBS -j oe",
+        "#PBS -N %s"%jobname,
+      ]
+    if jobout is not None:
+      lines.append("#PBS -o %s"%jobout)
+    return lines
+
+  #------------------------------------------------
+  def _qsub(self,command,cwd):
+    result=sub.check_output(command,shell=True,cwd=cwd)
+    queueid=result.decode().split()[0].split('.')[0]
+    submitter.queue_cache.submitted(queueid)
+    return queueid
+
+  #------------------------------------------------
+  def submit(self,scriptfile,cwd=None):
+    return self._qsub("qsub %s"%scriptfile,cwd)
+
+  #------------------------------------------------
+  def array_submit(self,scriptfile,njobs,cwd=None):
+    # Torque reports array ids as 123[]; the queue lists them under 123.
+    queueid=self._qsub("qsub -t 0-%d %s"%(njobs-1,scriptfile),cwd).split('[')[0]
+    submitter.queue_cache.submitted(queueid+'[]')
+    return queueid
+
+  #------------------------------------------------
+  def array_element(self,queueid,index):
+    return "%s[%d]"%(queueid,index)
+
+  #------------------------------------------------
+  def status(self,queueids):
+    for qid in queueids:
+      qid=str(qid)
+      arrayid=None
+      if '[' in qid and not qid.endswith('[]'): arrayid=qid.split('[')[0]+'[]'
+      if element_state(submitter.queue_cache,qid,arrayid,qid.split('[')[0]+'[') in self.running_states:
+        return 'running'
+    return 'unknown'
+
+  #------------------------------------------------
+  def cancel(self,queueids):
+    for qid in queueids:
+      sub.call("qdel %s"%qid,shell=True)
+
+#######################################################################
+class SlurmScheduler:
+  ''' Slurm. Status comes from one `squeue` call per TTL, shared like the PBS snapshot.'''
+  running_states=('R','PD','CF','CG','S')
+  array_index='${SLURM_ARRAY_TASK_ID}'
+
+  #------------------------------------------------
+  def header(self,jobname,queue,walltime,nn=1,np='allprocs',jobout=None):
+    lines=[
+        "#!/bin/bash",
+        "#SBATCH -p %s"%queue,
+        "#SBATCH -N %i"%nn,
+      ]
+    if np=='allprocs':
+      lines.append("#SBATCH --exclusive")
+    else:
+      lines.append("#SBATCH --ntasks-per-node=%i"%np)
+    lines+=[
+        "#SBATCH -t %s"%walltime,
+        "#SBATCH -J %s"%jobname,
+      ]
+    if jobout is not None:
+      lines.append("#SBATCH -o %s"%jobout)
+    return lines
+
+  #------------------------------------------------
+  def _sbatch(self,command,cwd):
+    result=sub.check_output(command,shell=True,cwd=cwd)
+    # --parsable prints "id" or "id;cluster".
+    queueid=result.decode().strip().split(';')[0]
+    slurm_cache.submitted(queueid,'PD')
+    return queueid
+
+  #------------------------------------------------
+  def submit(self,scriptfile,cwd=None):
+    return self._sbatch("sbatch --parsable %s"%scriptfile,cwd)
+
+  #------------------------------------------------
+  def array_submit(self,scriptfile,njobs,cwd=None):
+    return self._sbatch("sbatch --parsable --array=0-%d %s"%(njobs-1,scriptfile),cwd)
+
+  #------------------------------------------------
+  def array_element(self,queueid,index):
+    return "%s_%d"%(queueid,index)
+
+  #------------------------------------------------
+  def status(self,queueids):
+    for qid in queueids:
+      qid=str(qid)
+      arrayid=None
+      if '_' in qid: arrayid=qid.split('_')[0]
+      if element_state(slurm_cache,qid,arrayid,qid.split('_')[0]+'_') in self.running_states:
+        return 'running'
+    return 'unknown'
+
+  #------------------------------------------------
+  def cancel(self,queueids):
+    for qid in queueids:
+      sub.call("scancel %s"%qid,shell=True)
+
+#######################################################################
+# Jobs started by LocalScheduler in this process: id to subprocess.
+_local_jobs={}
+_local_ids=itertools.count(1)
+
+class LocalScheduler:
+  ''' Emulates a queue by running job scripts as local subprocesses.
+
+  Each job waits `delay` seconds (the simulated time in the queue) before its script runs.
+  Jobs only live as long as the driver process that started them.
+  '''
+  array_index='${AG_ARRAY_INDEX}'
+
+  def __init__(self,delay=0.0):
+    '''
+    Args:
+      delay (float): seconds each job waits before it starts.
+    '''
+    self.delay=delay
+
+  #------------------------------------------------
+  def header(self,jobname,queue,walltime,nn=1,np='allprocs',jobout=None):
+    return ["#!/bin/bash","# Local job %s (queue %s, walltime %s, nodes %s)"%(jobname,queue,walltime,nn)]
+
+  #------------------------------------------------
+  def _start(self,scriptfile,cwd,env=None):
+    queueid="local%d"%next(_local_ids)
+    command="sleep %g; bash %s"%(self.delay,scriptfile)
+    # Like PBS_JOBID or SLURM_JOB_ID, so a job can tell its own id.
+    if env is None: env=os.environ
+    env=dict(env,AG_JOBID=queueid)
+    _local_jobs[queueid]=sub.Popen(command,shell=True,cwd=cwd,env=env,
+        stdout=sub.DEVNULL,stderr=sub.DEVNULL)
+    return queueid
+
+  #------------------------------------------------
+  def submit(self,scriptfile,cwd=None):
+    return self._start(scriptfile,cwd)
+
+  #------------------------------------------------
+  def array_submit(self,scriptfile,njobs,cwd=None):
+    ''' Each copy is its own subprocess; they share the returned id.'''
+    queueid="local%d"%next(_local_ids)
+    for index in range(njobs):
+      env=dict(os.environ,AG_ARRAY_INDEX=str(index))
+      _local_jobs["%s_%d"%(queueid,index)]=_local_jobs[self._start(scriptfile,cwd,env)]
+    return queueid
+
+  #------------------------------------------------
+  def array_element(self,queueid,index):
+    return "%s_%d"%(queueid,index)
+
+  #------------------------------------------------
+  def _running(self,qid):
+    procs=[proc for key,proc in list(_local_jobs.items()) if key==qid or key.startswith(qid+'_')]
+    return any([proc.poll() is None for proc in procs])
+
+  #------------------------------------------------
+  def status(self,queueids):
+    for qid in queueids:
+      if self._running(qid):
+        return 'running'
+    return 'unknown'
+
+  #------------------------------------------------
+  def cancel(self,queueids):
+    for qid in queueids:
+      for key,proc in list(_local_jobs.items()):
+        if (key==qid or key.startswith(qid+'_')) and proc.poll() is None:
+          proc.terminate()
+
+  #------------------------------------------------
+  def wait(self,queueids,timeout=None):
+    ''' Block until the jobs finish (for tests and benchmarks).'''
+    start=time.time()
+    while self.status(queueids)=='running':
+      if timeout is not None and time.time()-start>timeout:
+        return False
+      time.sleep(0.05)
+    return True
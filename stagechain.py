@@ -0,0 +1,165 @@
+''' Run consecutive QWalk stages (e.g. variance -> linear -> DMC) in one job.
+
+Normally each stage waits in the queue on its own, since its input can only be written once
+the previous stage has finished. The inputs can be written ahead of time instead, if each stage
+includes the Jastrow file that the previous stage's `export_qwalk` will produce (see
+`SlaterJastrow.export_chained`). The job then runs the stages back to back, separating the
+Jastrow from each stage's wave function on the compute node before the next stage starts.
+A stage only runs if the one before it converged, as judged by a copy of that stage's reader
+(saved next to its input as `<infile>.reader`), so an unconverged optimization doesn't feed the
+rest of the chain.
+
+Afterwards, `update` advances the managers in order, so they collect their results as if they
+had run on their own. If a stage didn't converge, it takes over from there with its usual restarts,
+and the later stages are reset to run normally once it's done.
+'''
+import os
+import pickle
+import manager_tools
+from schedulers import walltime_seconds, seconds_walltime
+import runtimedb
+from autopaths import paths
+
+#######################################################################
+class StageChain:
+  ''' Consecutive QWalk stages run in one job.'''
+  def __init__(self,stages,jobname=None,walltime=None):
+    '''
+    Args:
+      stages (list): QWalkManagers in order. They run in the same directory, and the trial function of
+        each stage after the first is a SlaterJastrow whose jastman is the stage before it.
+        The job uses the runner of the first stage.
+      jobname (str): name of the job (None implies one based on the path).
+      walltime (str): walltime for the whole chain (None implies the sum of the stages' walltimes).
+    '''
+    assert len(stages)>0, "Need at least one stage."
+    path=stages[0].path
+    for prev,stage in zip(stages[:-1],stages[1:]):
+      assert stage.path==path, "Stages must run in the same directory."
+      assert stage.trialfunc.jastman is prev, "%s should take its Jastrow from %s."%(stage.name,prev.name)
+      assert prev.writer.qmc_abr!='dmc', "DMC doesn't provide a wave function for the next stage."
+    self.stages=stages
+    self.path=path
+    if jobname is None: jobname=path.replace('/','-')+'chain'
+    self.jobname=jobname
+    if walltime is None:
+      walltime=seconds_walltime(sum([walltime_seconds(stage.runner.walltime) for stage in stages]))
+    self.walltime=walltime
+    self.queueid=None
+
+  #------------------------------------------------
+  def _started(self):
+    return any([stage.completed or os.path.exists(stage.path+stage.outfile) for stage in self.stages])
+
+  #------------------------------------------------
+  def _converged(self,stage,autogen):
+    ''' Shell command that succeeds if the stage's run meets the tolerances of its reader.'''
+    with open(stage.path+stage.infile+'.reader','wb') as f:
+      pickle.dump(stage.reader,f)
+    return ("python3 -c \"import sys,pickle; sys.path.insert(0,'%s'); "
+        "reader=pickle.load(open('%s.reader','rb')); sys.exit(reader.collect('%s')!='ok')\""%\
+        (autogen,stage.infile,stage.outfile))
+
+  #------------------------------------------------
+  def _write_inputs(self):
+    ''' Write the input of every stage.
+    Returns:
+      bool: False if the first stage's trial function isn't ready.
+    '''
+    for sidx,stage in enumerate(self.stages):
+      stage.recover(stage.store.load(stage.path,stage.name))
+      if sidx==0:
+        trialfunc=stage.trialfunc.export(stage.path)
+      else:
+        trialfunc=stage.trialfunc.export_chained(stage.path)
+      if trialfunc=='':
+        return False
+      stage.writer.trialfunc=trialfunc
+      stage.writer.qwalk_input(stage.path+stage.infile)
+      stage._dirty=True
+    return True
+
+  #------------------------------------------------
+  def submit(self):
+    ''' Write the inputs and submit the chain, if none of the stages has started yet.
+    The chain is submitted with the first stage's runner even if the stages have bundle set,
+    since a bundler would only tell the first stage its queue id.
+    Returns:
+      str: queue id, or None if nothing was submitted.
+    '''
+    if self._started():
+      print(self.__class__.__name__,": stages already started; advance them with update().")
+      return None
+    if not self._write_inputs():
+      print(self.__class__.__name__,": trial function of %s is not ready."%self.stages[0].name)
+      return None
+
+    runner=self.stages[0].runner
+    # Wave functions left by earlier runs would let a later stage start without its Jastrow.
+    runner.add_command("rm -f "+' '.join(["%s.wfout"%stage.infile for stage in self.stages[:-1]]))
+    # On the node, separate the Jastrow with the same code export_qwalk uses.
+    autogen=os.path.dirname(os.path.abspath(manager_tools.__file__))
+    # Each later stage is one guarded command line. Its guard is enough, since a stage only runs
+    # (and leaves a wave function) if the stages before it converged.
+    for sidx,stage in enumerate(self.stages):
+      exestr="%s %s &> %s"%(paths['qwalk'],stage.infile,stage.stdout)
+      if sidx==0:
+        runtimedb.add_timed_task(runner,exestr,stage.stampfile)
+      else:
+        prev=self.stages[sidx-1]
+        separate=("python3 -c \"import sys; sys.path.insert(0,'%s'); "
+            "from manager_tools import separate_jastrow; "
+            "open('%s.jast','w').write(separate_jastrow('%s.wfout'))\""%(autogen,prev.infile,prev.infile))
+        converged="[ -f %s.wfout ] && %s"%(prev.infile,self._converged(prev,autogen))
+        runtimedb.add_conditional_task(runner,converged,exestr,stage.stampfile,setup=[separate])
+
+    walltime=runner.walltime
+    runner.walltime=self.walltime
+    nqueued=len(runner.queueid)
+    try:
+      runner.submit(self.jobname,cwd=self.path)
+    finally:
+      runner.walltime=walltime
+    if len(runner.queueid)==nqueued:
+      return None
+    self.queueid=runner.queueid[-1]
+
+    self.stages[0]._dirty=True
+    self.stages[0].store.save(self.stages[0])
+    for stage in self.stages[1:]:
+      stage.update_queueid(self.queueid)
+    print(self.__class__.__name__,": %s submitted as %s."%(' -> '.join([s.name for s in self.stages]),self.queueid))
+    return self.queueid
+
+  #------------------------------------------------
+  def update(self):
+    ''' Advance the stages in order, collecting what the chain produced.
+    Stages after one that isn't completed are reset, so they run on their own once it is.
+    Returns:
+      bool: whether all the stages are completed.
+    '''
+    for sidx,stage in enumerate(self.stages):
+      stage.nextstep()
+      if not stage.completed:
+        for later in self.stages[sidx+1:]:
+          self._reset(later)
+        return False
+      if sidx+1<len(self.stages):
+        stage.export_qwalk()
+    return True
+
+  #------------------------------------------------
+  def _reset(self,stage):
+    ''' Discard a stage's chained run, and have it export its trial function normally.'''
+    if stage.completed or stage.writer.trialfunc=='' or stage.runner.check_status()=='running':
+      return
+    print(self.__class__.__name__,": resetting %s, since an earlier stage isn't done."%stage.name)
+    stage.recover(stage.store.load(stage.path,stage.name))
+    for fname in (stage.outfile,"%s.wfout"%stage.infile,"%s.log"%stage.infile,stage.stampfile):
+      if os.path.exists(stage.path+fname):
+        os.remove(stage.path+fname)
+    stage.writer.trialfunc=''
+    stage.writer.completed=False
+    stage.reader.completed=False
+    stage._dirty=True
+    stage.store.save(stage)
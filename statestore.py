@@ -0,0 +1,225 @@
+''' Backends for saving and reloading the state of managers.
+
+A store has the interface:
+  exists(path,name): whether a manager has saved state.
+  load(path,name): return the saved manager.
+  save(mgr,force=False): save the manager (keyed on mgr.path and mgr.name) if it has changed.
+  remove(path,name): delete saved state.
+
+Managers set `mgr._dirty=True` whenever their state changes, and `save` skips the
+write when nothing changed since the last save. Dirty managers are always written, with a
+fingerprint (see `manager_tools.fingerprint`) of the saved state, which lets the next load
+skip comparing unchanged attributes. The number of writes made and avoided are counted in
+`store.stats()`.
+
+PickleStore is the original one-file-per-manager layout (`<path>/<name>.pkl`).
+SQLiteStore keeps all the managers of a project in one database, which is much
+cheaper on a parallel filesystem when there are many managers.
+'''
+import os
+import pickle as pkl
+import sqlite3
+import time
+import tempfile
+import threading
+from contextlib import contextmanager
+from manager_tools import fingerprint
+
+# The write counters are updated by managers saved from several threads at once.
+_counter_lock=threading.Lock()
+
+#######################################################################
+def _manager_fields(mgr):
+  ''' Columns that are indexed for searching.
+  Returns:
+    tuple: (kind,status,completed,queueid) for the manager. The status is what
+      `manager_tools.resolve_status` gave at the end of the manager's last step
+      ('done', 'running', 'not_started' or 'ready_for_analysis'), or None before its first step.
+  '''
+  completed=bool(getattr(mgr,'completed',False))
+  status=getattr(mgr,'run_status',None)
+  queueid=getattr(getattr(mgr,'runner',None),'queueid',None)
+  if isinstance(queueid,(list,tuple)):
+    if len(queueid)>0: queueid=str(queueid[-1])
+    else:              queueid=None
+  elif queueid is not None:
+    queueid=str(queueid)
+  return mgr.__class__.__name__,status,int(completed),queueid
+
+#######################################################################
+class StateStore:
+  ''' Common bookkeeping for stores. Child classes must define exists, load, remove, and _write(mgr).'''
+  writes=0
+  writes_avoided=0
+
+  #------------------------------------------------
+  def save(self,mgr,force=False):
+    ''' Save the manager if it's marked as changed.
+    Args:
+      mgr (Manager): manager to save.
+      force (bool): write even if the manager isn't marked as changed.
+    Returns:
+      bool: whether a write was made.
+    '''
+    if not force and not getattr(mgr,'_dirty',True):
+      with _counter_lock:
+        self.writes_avoided+=1
+      return False
+    # The fingerprint is pickled with the manager, which lets the next load skip comparisons.
+    # Only values that were replaced or invalidated since they were last digested are hashed.
+    newprint=fingerprint(mgr)
+    self._write(mgr)
+    mgr._dirty=False
+    mgr._saved_fingerprint=newprint
+    with _counter_lock:
+      self.writes+=1
+    return True
+
+  #------------------------------------------------
+  def stats(self):
+    ''' Number of writes made and avoided since the last `reset_stats()`.'''
+    return {'writes':self.writes,'writes_avoided':self.writes_avoided}
+
+  #------------------------------------------------
+  def reset_stats(self):
+    ''' Start counting for a new pass over the managers.'''
+    self.writes=0
+    self.writes_avoided=0
+
+#######################################################################
+class PickleStore(StateStore):
+  ''' Store each manager in its own pickle file, `path+name.pkl`.'''
+  def fname(self,path,name):
+    return path+"%s.pkl"%name
+
+  #------------------------------------------------
+  def exists(self,path,name):
+    return os.path.exists(self.fname(path,name))
+
+  #------------------------------------------------
+  def load(self,path,name):
+    with open(self.fname(path,name),'rb') as inpf:
+      return pkl.load(inpf)
+
+  #------------------------------------------------
+  def _write(self,mgr):
+    ''' Write the pickle to a temporary file first so an interrupted write doesn't corrupt the old state.'''
+    fname=self.fname(mgr.path,mgr.name)
+    # A unique temporary name, so concurrent saves of a manager don't write the same file.
+    fd,tmpname=tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)),prefix=os.path.basename(fname),suffix='.tmp')
+    try:
+      with os.fdopen(fd,'wb') as outf:
+        pkl.dump(mgr,outf)
+      if os.path.exists(fname): os.chmod(tmpname,os.stat(fname).st_mode&0o777)
+      else:                     os.chmod(tmpname,0o644)
+      os.replace(tmpname,fname)
+    except BaseException:
+      if os.path.exists(tmpname): os.remove(tmpname)
+      raise
+
+  #------------------------------------------------
+  def remove(self,path,name):
+    if self.exists(path,name):
+      os.remove(self.fname(path,name))
+
+#######################################################################
+class SQLiteStore(StateStore):
+  ''' Store all managers of a project in one SQLite database.
+
+  Rows are keyed by (path,name), where path is relative to the directory of the database,
+  so the project can be moved and the driver can be run from anywhere.
+  Each save is one transaction, so a manager's state is never partially written.
+  '''
+  def __init__(self,dbfile='autogen.db',timeout=60.0):
+    '''
+    Args:
+      dbfile (str): database file; one per project.
+      timeout (float): seconds to wait on a database locked by another process.
+    '''
+    self.dbfile=os.path.abspath(dbfile)
+    self.timeout=timeout
+    with self._connect() as conn:
+      conn.executescript('''
+        create table if not exists managers (
+          path text not null,
+          name text not null,
+          kind text,
+          status text,
+          completed integer,
+          queueid text,
+          updated real,
+          state blob not null,
+          primary key (path,name)
+        );
+        create index if not exists managers_status on managers(status);
+        create index if not exists managers_completed on managers(completed);
+        create index if not exists managers_queueid on managers(queueid);
+      ''')
+
+  #------------------------------------------------
+  @contextmanager
+  def _connect(self):
+    ''' Connections are opened per operation so that the store can be pickled with the managers
+    and used from several threads or processes.'''
+    conn=sqlite3.connect(self.dbfile,timeout=self.timeout)
+    try:
+      with conn:
+        yield conn
+    finally:
+      conn.close()
+
+  #------------------------------------------------
+  def key(self,path):
+    return os.path.relpath(os.path.abspath(path),os.path.dirname(self.dbfile))
+
+  #------------------------------------------------
+  def exists(self,path,name):
+    with self._connect() as conn:
+      row=conn.execute("select 1 from managers where path=? and name=?",
+          (self.key(path),name)).fetchone()
+    return row is not None
+
+  #------------------------------------------------
+  def load(self,path,name):
+    with self._connect() as conn:
+      row=conn.execute("select state from managers where path=? and name=?",
+          (self.key(path),name)).fetchone()
+    if row is None:
+      raise KeyError("No state saved for %s in %s."%(path+name,self.dbfile))
+    return pkl.loads(row[0])
+
+  #------------------------------------------------
+  def _write(self,mgr):
+    kind,status,completed,queueid=_manager_fields(mgr)
+    state=pkl.dumps(mgr)
+    with self._connect() as conn:
+      conn.execute("insert or replace into managers "
+          "(path,name,kind,status,completed,queueid,updated,state) values (?,?,?,?,?,?,?,?)",
+          (self.key(mgr.path),mgr.name,kind,status,completed,queueid,time.time(),sqlite3.Binary(state)))
+
+  #------------------------------------------------
+  def remove(self,path,name):
+    with self._connect() as conn:
+      conn.execute("delete from managers where path=? and name=?",(self.key(path),name))
+
+  #------------------------------------------------
+  def query(self,status=None,completed=None,queueid=None,kind=None):
+    ''' Find managers using the indexed columns without unpickling anything.
+    Returns:
+      list: (path,name,kind,status,completed,queueid) for each matching manager.
+    '''
+    where=[]
+    args=[]
+    for col,val in (('status',status),('completed',completed),('queueid',queueid),('kind',kind)):
+      if val is not None:
+        where.append("%s=?"%col)
+        args.append(int(val) if col=='completed' else val)
+    sql="select path,name,kind,status,completed,queueid from managers"
+    if len(where)>0:
+      sql+=" where "+" and ".join(where)
+    with self._connect() as conn:
+      rows=conn.execute(sql+" order by path,name",args).fetchall()
+    return [(os.path.join(os.path.dirname(self.dbfile),r[0])+'/',)+tuple(r[1:]) for r in rows]
+
+# Store shared by managers that aren't given one, so that write counts cover the whole pass.
+default_store=PickleStore()
@@ -4,6 +4,19 @@ import os
 import shutil
 import sys
 import time
+import threading
+import json
+import pickle
+from contextlib import contextmanager
+try:
+  import fcntl
+except ImportError:
+  # No file locking (e.g. on Windows): processes shouldn't share a statefile.
+  fcntl=None
+import signal
+import socket
+import tempfile
+from xml.etree import ElementTree
 
 #####################################################################################
 class LocalSubmitter:
@@ -39,15 +52,570 @@ class LocalSubmitter:
     return []
 
 #-------------------------------------------------------
+class QueueStatusCache:
+  """Snapshot of the queue, shared by all the runners in a process.
 
+  The queue is read with one qstat call, and the snapshot is reused until it's `ttl` seconds old.
+  Jobs are indexed by id (without the server name), so each lookup is a dictionary access.
+  The output of qstat is parsed as XML (Torque `qstat -x`), JSON (PBS Pro `qstat -f -F json`),
+  or the plain table (`qstat`), depending on what it looks like.
+  With -t, the elements of array jobs (123[4]) are listed, not just the array as a whole (123[]).
+  """
+  def __init__(self,ttl=30.0,command="qstat -x -t",parser=None):
+    """
+    Args:
+      ttl (float): seconds before the snapshot is refreshed.
+      command (str): command that lists the jobs in the queue.
+      parser (function): maps the output of command to {job id: state} (None implies `parse_qstat`).
+    """
+    self.ttl=ttl
+    self.command=command
+    if parser is None: self.parser=parse_qstat
+    else:              self.parser=parser
+    self.jobs={}
+    self.fetched=None
+    self.nqueries=0
+    self.lock=threading.Lock()
+
+  #-------------------------------------------------------
+  def refresh(self,force=False):
+    """Read the queue if the snapshot is older than the TTL (or force).
+    If the queue can't be read, the previous snapshot (with the jobs recorded by `submitted`)
+    is kept, and the queue is read again on the next call."""
+    with self.lock:
+      if not force and self.fetched is not None and time.time()-self.fetched < self.ttl:
+        return
+      self.nqueries+=1
+      try:
+        out=sub.check_output(self.command, stderr=sub.STDOUT, shell=True).decode()
+        self.jobs=self.parser(out)
+      except (sub.CalledProcessError,ValueError) as err:
+        print(self.__class__.__name__,": could not read the queue; keeping the last snapshot.\n\t{0}".format(err))
+        return
+      self.fetched=time.time()
+
+  #-------------------------------------------------------
+  def state(self,queueid):
+    """Queue state (e.g. 'Q', 'R', 'C') of a job, or None if it's not in the queue."""
+    self.refresh()
+    return self.jobs.get(_short_id(queueid))
+
+  #-------------------------------------------------------
+  def listed(self,prefix):
+    """Ids in the snapshot that start with prefix, e.g. the elements of an array job."""
+    self.refresh()
+    with self.lock:
+      return [jobid for jobid in self.jobs if jobid.startswith(prefix)]
+
+  #-------------------------------------------------------
+  def submitted(self,queueid,state='Q'):
+    """Record a job that was just submitted, so it shows as queued before the next refresh."""
+    with self.lock:
+      self.jobs[_short_id(queueid)]=state
+
+def _short_id(queueid):
+  return str(queueid).strip().split('.')[0]
+
+#-------------------------------------------------------
+def parse_qstat(out):
+  """Job states from qstat output.
+  Returns:
+    dict: job id (without server name) to state letter.
+  """
+  text=out.strip()
+  jobs={}
+  if text=='':
+    return jobs
+  if text.startswith('<'):
+    root=ElementTree.fromstring(text)
+    for job in root.iter('Job'):
+      jobid=job.findtext('Job_Id')
+      if jobid is not None:
+        jobs[_short_id(jobid)]=job.findtext('job_state','').strip()
+  elif text.startswith('{'):
+    for jobid,info in json.loads(text).get('Jobs',{}).items():
+      jobs[_short_id(jobid)]=info.get('job_state','')
+  else:
+    for line in text.split('\n'):
+      spl=line.split()
+      if len(spl) > 4 and spl[0][0].isdigit():
+        jobs[_short_id(spl[0])]=spl[4]
+  return jobs
+
+# Shared by every runner (and the Bundler) in this process.
+queue_cache=QueueStatusCache()
+
+#-------------------------------------------------------
+class LocalPool:
+  """Runs local jobs in the background on a budget of cores, so local runs behave like queued ones.
+
+  A job is a list of shell commands, written to one script (so `cd`, `export` and the like
+  carry over to the later commands) that stops at the first command that fails.
+  Jobs start as soon as enough cores are free, so a small job may start ahead of a larger one
+  that's waiting for cores.
+  Job states follow the queue letters: 'Q' waiting for cores, 'R' running, 'C' completed, 'E' failed.
+
+  Each job has a script `<id>.sh` and a record `<id>.json` (state, pid, host) in `statedir`,
+  and its exit code is written to `<id>.exit` when it ends, so a later driver process can tell
+  whether a job started by an earlier one is still running. Started jobs outlive the driver;
+  jobs still waiting for cores when the driver exits are never started, and end up 'E'.
+  """
+  def __init__(self,ncores=None,statedir='local_jobs'):
+    """
+    Args:
+      ncores (int): cores available to local jobs (None implies all the cores of the machine).
+      statedir (str): directory for the job scripts and records.
+    """
+    if ncores is None: ncores=os.cpu_count()
+    self.ncores=ncores
+    self.free=ncores
+    self.statedir=os.path.abspath(statedir)
+    self.jobs={}
+    self.cond=threading.Condition()
+
+  #-------------------------------------------------------
+  def _path(self,queueid,ext):
+    return os.path.join(self.statedir,queueid+ext)
+
+  #-------------------------------------------------------
+  def _read(self,queueid):
+    try:
+      with open(self._path(queueid,'.json')) as f:
+        return json.load(f)
+    except (IOError,OSError,ValueError):
+      return None
+
+  #-------------------------------------------------------
+  def _write(self,queueid,record):
+    fd,tmpname=tempfile.mkstemp(dir=self.statedir,suffix='.tmp')
+    with os.fdopen(fd,'w') as f:
+      json.dump(record,f)
+    os.replace(tmpname,self._path(queueid,'.json'))
+
+  #-------------------------------------------------------
+  def submit(self,lines,ncores=None,cwd=None,env=None):
+    """Start a job in the background.
+    Args:
+      lines (list): shell commands, run in order until one fails.
+      ncores (int): cores the job uses (None implies all of them).
+      cwd (str): directory to run in.
+      env (dict): environment of the commands (None implies this process's).
+    Returns:
+      str: queue id of the job.
+    """
+    if ncores is None or ncores>self.ncores: ncores=self.ncores
+    if not os.path.isdir(self.statedir): os.makedirs(self.statedir,exist_ok=True)
+    fd,scriptfile=tempfile.mkstemp(prefix='pool',suffix='.sh',dir=self.statedir)
+    queueid=os.path.basename(scriptfile)[:-len('.sh')]
+    with os.fdopen(fd,'w') as f:
+      f.write('\n'.join(['set -e']+list(lines))+'\n')
+    with self.cond:
+      self.jobs[queueid]='Q'
+      self._write(queueid,{'state':'Q','owner':os.getpid(),'host':socket.gethostname(),'pid':None,'ncores':ncores})
+    thread=threading.Thread(target=self._run,args=(queueid,ncores,cwd,env))
+    thread.daemon=True
+    thread.start()
+    return queueid
+
+  #-------------------------------------------------------
+  def _run(self,queueid,ncores,cwd,env):
+    with self.cond:
+      while ncores>self.free and self.jobs[queueid]=='Q':
+        self.cond.wait()
+      if self.jobs[queueid]!='Q':
+        return
+      self.free-=ncores
+      # The exit code is written by the job's own shell, so it's recorded even if this process is gone.
+      exitfile=self._path(queueid,'.exit')
+      proc=sub.Popen(['bash','-c','bash "$0"; echo $? > "$1.tmp"; mv "$1.tmp" "$1"',
+          self._path(queueid,'.sh'),exitfile],cwd=cwd,env=env,stdout=sub.DEVNULL,start_new_session=True)
+      self.jobs[queueid]='R'
+      record=self._read(queueid)
+      record.update(state='R',pid=proc.pid)
+      self._write(queueid,record)
+
+    proc.wait()
+    with self.cond:
+      state=self._finished(queueid)
+      if state is None:
+        state='E'
+      if state=='E' and self.jobs[queueid]=='R':
+        print(self.__class__.__name__,": %s failed."%queueid)
+      if self.jobs[queueid]=='R': self.jobs[queueid]=state
+      record=self._read(queueid)
+      record['state']=self.jobs[queueid]
+      self._write(queueid,record)
+      self.free+=ncores
+      self.cond.notify_all()
+
+  #-------------------------------------------------------
+  def _finished(self,queueid):
+    """'C' or 'E' from the exit code of a job that ended, None if it didn't write one."""
+    try:
+      with open(self._path(queueid,'.exit')) as f:
+        code=f.read().strip()
+    except (IOError,OSError):
+      return None
+    if code=='0': return 'C'
+    return 'E'
+
+  #-------------------------------------------------------
+  def state(self,queueid):
+    """Queue state of a job, or None if the pool has no record of it."""
+    with self.cond:
+      if self.jobs.get(queueid) in ('Q','R'):
+        return self.jobs[queueid]
+    record=self._read(queueid)
+    if record is None:
+      return None
+    if record['state'] in ('C','E'):
+      return record['state']
+    state=self._finished(queueid)
+    if state is not None:
+      return state
+    if record['host']!=socket.gethostname():
+      # Can't look at processes on another machine; the exit file shows when it's done.
+      return record['state']
+    if record['state']=='R':
+      pid=record['pid']
+    else:
+      # Waiting for cores in another driver, which has to still be running to start it.
+      pid=record['owner']
+    if _alive(pid):
+      return record['state']
+    return 'E'
+
+  #-------------------------------------------------------
+  def status(self,queueids):
+    """'running' if any of the jobs is waiting or running, 'done' if they all ended,
+    and 'unknown' if the pool has no record of any of them."""
+    known=False
+    for qid in queueids:
+      state=self.state(qid)
+      if state in ('Q','R'):
+        return 'running'
+      known=known or state is not None
+    if known:
+      return 'done'
+    return 'unknown'
+
+  #-------------------------------------------------------
+  def cancel(self,queueids):
+    with self.cond:
+      for qid in queueids:
+        state=self.state(qid)
+        if state not in ('Q','R'):
+          continue
+        if self.jobs.get(qid) in ('Q','R'):
+          self.jobs[qid]='E'
+        record=self._read(qid)
+        if state=='R' and record['pid'] is not None:
+          try:
+            os.killpg(record['pid'],signal.SIGTERM)
+          except OSError:
+            pass
+        record['state']='E'
+        self._write(qid,record)
+      self.cond.notify_all()
+
+  #-------------------------------------------------------
+  def wait(self,queueids,timeout=None):
+    """Block until the jobs finish. Returns False if the timeout ran out first."""
+    start=time.time()
+    while self.status(queueids)=='running':
+      if timeout is not None and time.time()-start>timeout:
+        return False
+      time.sleep(0.05)
+    return True
+
+def _alive(pid):
+  """Whether a process of this machine exists."""
+  if pid is None:
+    return False
+  try:
+    os.kill(pid,0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    return True
+  return True
+
+# Shared by every local runner in this process, so together they stay within the cores of the machine.
+local_pool=LocalPool(statedir=os.environ.get('AUTOGEN_LOCALJOBS','local_jobs'))
+
+#-------------------------------------------------------
+class SubmissionError(RuntimeError):
+  """A job script couldn't be submitted, even after retrying."""
+  pass
+
+#-------------------------------------------------------
+class SubmissionGovernor:
+  """Submits job scripts for all the runners (and bundlers), keeping the queue within a limit.
+
+  At most `maxjobs` of the jobs it submitted are queued or running at once. Submissions past
+  the limit wait in a pending queue, highest priority first (then oldest first), and get an id
+  'pending:N' instead of a queue id. Failed submissions (e.g. qsub refusing past a per-user
+  limit) also wait there, and are retried after a backoff that doubles with each failure.
+  After `maxattempts` failures the submission is dropped, and `status` raises a
+  SubmissionError for it (once), so the manager reports the error and can submit again.
+  Pending submissions are sent whenever the governor is used and there's room, and
+  `status` reports 'running' for them until their job is done, so managers wait for them.
+  Job arrays are submitted the same way (with `njobs`), and each of their elements counts
+  towards maxjobs; `array_element` gives ids for the elements even while the array is pending.
+
+  The pending queue, and the queue ids that pending submissions ended up with, are kept in
+  `statefile` so they outlast the driver script, and so processes sharing it (e.g. the workers
+  of `executor.ManagerExecutor(processes=True)`) see each other's submissions. The file is
+  reread on every operation, under a lock (`statefile.lock`, with fcntl.flock). It's only
+  written once something had to wait or maxjobs is set.
+  """
+  def __init__(self,maxjobs=None,statefile='pending_submissions.pkl',backoff=60.0,maxbackoff=3600.0,maxattempts=8):
+    """
+    Args:
+      maxjobs (int): most jobs queued or running at once (None implies no limit).
+      statefile (str): file to keep the pending queue in.
+      backoff (float): seconds before retrying a failed submission the first time.
+      maxbackoff (float): longest wait between retries.
+      maxattempts (int): failed submissions before a submission is dropped.
+    """
+    self.maxjobs=maxjobs
+    self.statefile=os.path.abspath(statefile)
+    self.backoff=backoff
+    self.maxbackoff=maxbackoff
+    self.maxattempts=maxattempts
+    self.lock=threading.RLock()
+    self.depth_held=0
+    self.pending=[]
+    self.active=[]
+    self.resolved={}
+    self.failed={}
+    self.count=0
+
+  #-------------------------------------------------------
+  def _load(self):
+    if os.path.exists(self.statefile):
+      with open(self.statefile,'rb') as f:
+        state=pickle.load(f)
+      self.pending=state['pending']
+      self.active=state['active']
+      self.resolved=state['resolved']
+      self.failed=state.get('failed',{})
+      self.count=state['count']
+    else:
+      self.pending=[]
+      self.active=[]
+      self.resolved={}
+      self.failed={}
+
+  #-------------------------------------------------------
+  def _save(self):
+    if self.maxjobs is None and len(self.pending)==0 and len(self.resolved)==0 and len(self.failed)==0 \
+        and not os.path.exists(self.statefile):
+      return
+    fd,tmpname=tempfile.mkstemp(dir=os.path.dirname(self.statefile),suffix='.tmp')
+    with os.fdopen(fd,'wb') as f:
+      pickle.dump({'pending':self.pending,'active':self.active,'resolved':self.resolved,
+          'failed':self.failed,'count':self.count},f)
+    os.replace(tmpname,self.statefile)
+
+  #-------------------------------------------------------
+  @contextmanager
+  def _transaction(self):
+    """Hold the state (reread from statefile) for an operation, and save it afterwards.
+    Operations nest; only the outermost one reads, locks, and writes the file."""
+    with self.lock:
+      if self.depth_held>0:
+        self.depth_held+=1
+        try:
+          yield
+        finally:
+          self.depth_held-=1
+        return
+      lockf=None
+      # Without maxjobs, there's nothing to share until something has had to wait.
+      shared=self.maxjobs is not None or os.path.exists(self.statefile)
+      if fcntl is not None and shared:
+        lockf=open(self.statefile+'.lock','a')
+        fcntl.flock(lockf,fcntl.LOCK_EX)
+      self.depth_held=1
+      try:
+        self._load()
+        yield
+        self._save()
+      finally:
+        self.depth_held=0
+        if lockf is not None:
+          fcntl.flock(lockf,fcntl.LOCK_UN)
+          lockf.close()
+
+  #-------------------------------------------------------
+  def depth(self):
+    """Number of the governor's jobs that are queued or running."""
+    with self._transaction():
+      self.active=[(scheduler,qid) for scheduler,qid in self.active if scheduler.status([qid])=='running']
+      return len(self.active)
+
+  #-------------------------------------------------------
+  def _send(self,entry):
+    """Try to submit a pending entry. Returns whether it was submitted (or dropped after too many attempts)."""
+    scheduler=entry['scheduler']
+    njobs=entry.get('njobs')
+    try:
+      if njobs is None:
+        queueid=scheduler.submit(entry['scriptfile'],entry['cwd'])
+      else:
+        queueid=scheduler.array_submit(entry['scriptfile'],njobs,entry['cwd'])
+    except sub.CalledProcessError as err:
+      entry['attempts']+=1
+      if entry['attempts']>=self.maxattempts:
+        message="Giving up on %s after %d failed submissions.\n\t{0}".format(err)%(entry['scriptfile'],entry['attempts'])
+        print(self.__class__.__name__,": "+message)
+        self.failed[entry['id']]=message
+        return True
+      wait=min(self.backoff*2**(entry['attempts']-1),self.maxbackoff)
+      entry['retry']=time.time()+wait
+      print(self.__class__.__name__,": Error submitting %s (attempt %d); retrying in %g seconds.\n\t{0}".format(err)%\
+          (entry['scriptfile'],entry['attempts'],wait))
+      return False
+    self.resolved[entry['id']]=queueid
+    if self.maxjobs is not None and njobs is None:
+      self.active.append((scheduler,queueid))
+    elif self.maxjobs is not None:
+      self.active+=[(scheduler,scheduler.array_element(queueid,index)) for index in range(njobs)]
+    if entry['attempts']>0 or entry['queued']:
+      print(self.__class__.__name__,": Submitted %s as %s"%(entry['id'],queueid))
+    return True
+
+  #-------------------------------------------------------
+  def flush(self):
+    """Submit pending jobs, highest priority first, while there's room in the queue.
+    Returns:
+      int: number of jobs still pending.
+    """
+    with self._transaction():
+      if len(self.pending)==0:
+        return 0
+      room=None
+      if self.maxjobs is not None: room=self.maxjobs-self.depth()
+      now=time.time()
+      for entry in sorted(self.pending,key=lambda entry:(-entry['priority'],entry['number'])):
+        if room is not None and room<=0:
+          break
+        if entry['retry']>now:
+          continue
+        if self._send(entry):
+          self.pending.remove(entry)
+          if room is not None and entry['id'] in self.resolved: room-=entry.get('njobs') or 1
+      return len(self.pending)
+
+  #-------------------------------------------------------
+  def submit(self,scheduler,scriptfile,cwd=None,priority=0,njobs=None):
+    """Submit a job script now if there's room, otherwise keep it pending.
+    Args:
+      scheduler (scheduler object): where to submit (see `schedulers.py`).
+      scriptfile (str): job script, relative to cwd.
+      cwd (str): directory to submit from (None implies the current directory).
+      priority (float): higher priorities are submitted first.
+      njobs (int): submit a job array of this many elements (None submits a single job).
+    Returns:
+      str: queue id, or 'pending:N' if the job is waiting to be submitted.
+    """
+    if cwd is None: cwd=os.getcwd()
+    with self._transaction():
+      self.flush()
+      self.count+=1
+      entry={'id':"pending:%d"%self.count,'number':self.count,'scheduler':scheduler,'scriptfile':scriptfile,
+          'cwd':cwd,'priority':priority,'njobs':njobs,'attempts':0,'retry':0.0,'queued':False}
+      room=self.maxjobs is None or self.depth()<self.maxjobs
+      # Jobs with higher priority that are waiting go first.
+      ahead=[other for other in self.pending if other['priority']>=priority]
+      if room and len(ahead)==0 and self._send(entry):
+        if entry['id'] in self.resolved:
+          return self.resolved.pop(entry['id'])
+        return entry['id']
+      entry['queued']=entry['attempts']==0
+      if entry['queued']:
+        print(self.__class__.__name__,": %s waits for room in the queue (priority %g) as %s."%\
+            (scriptfile,priority,entry['id']))
+      self.pending.append(entry)
+      return entry['id']
+
+  #-------------------------------------------------------
+  def array_element(self,scheduler,queueid,index):
+    """Id of element index of an array from `submit(...,njobs=...)`, like `scheduler.array_element`.
+    For a pending array it's 'pending:N:index', which `status` and `cancel` resolve once the array is submitted."""
+    if str(queueid).startswith('pending:'):
+      return "%s:%d"%(queueid,index)
+    return scheduler.array_element(queueid,index)
+
+  #-------------------------------------------------------
+  def _resolve(self,scheduler,qid):
+    """Pending id (of a job or array element) that qid refers to, and the queue id it was submitted as (or None)."""
+    parts=str(qid).split(':')
+    pendingid=':'.join(parts[:2])
+    if pendingid not in self.resolved:
+      return pendingid,None
+    if len(parts)==3:
+      return pendingid,scheduler.array_element(self.resolved[pendingid],int(parts[2]))
+    return pendingid,self.resolved[pendingid]
+
+  #-------------------------------------------------------
+  def status(self,scheduler,queueids):
+    """Like `scheduler.status`, but pending jobs count as running, and resolve to their queue ids once submitted.
+    Raises a SubmissionError for a submission that was dropped after failing maxattempts times."""
+    ids=[]
+    pendingids=[qid for qid in queueids if str(qid).startswith('pending:')]
+    if len(pendingids)==0:
+      return scheduler.status(queueids)
+    error=None
+    with self._transaction():
+      self.flush()
+      waiting=[entry['id'] for entry in self.pending]
+      for qid in queueids:
+        if qid in pendingids:
+          pendingid,queueid=self._resolve(scheduler,qid)
+          if pendingid in waiting:
+            return 'running'
+          if pendingid in self.failed:
+            # Forgotten (and saved) before raising, so the error is only raised once.
+            error=self.failed.pop(pendingid)
+            break
+          # Ids missing from both were dropped, so there's nothing to wait for.
+          if queueid is None:
+            continue
+          qid=queueid
+        ids.append(qid)
+    if error is not None:
+      raise SubmissionError(error)
+    return scheduler.status(ids)
+
+  #-------------------------------------------------------
+  def cancel(self,scheduler,queueids):
+    """Drop pending jobs and cancel submitted ones."""
+    ids=[]
+    with self._transaction():
+      for qid in queueids:
+        if not str(qid).startswith('pending:'):
+          ids.append(qid)
+          continue
+        pendingid,queueid=self._resolve(scheduler,qid)
+        if queueid is not None:
+          ids.append(queueid)
+        elif pendingid==qid:
+          self.pending=[entry for entry in self.pending if entry['id']!=qid]
+          self.failed.pop(qid,None)
+        # An element of a pending array can't be dropped without its siblings.
+    scheduler.cancel(ids)
+
+# Shared by every runner in this process.
+governor=SubmissionGovernor(statefile=os.environ.get('AUTOGEN_PENDING','pending_submissions.pkl'))
+
+#-------------------------------------------------------
 def check_PBS_status(queueid):
   """Utility function to determine the status of a PBS job."""
-  try:
-    qstat = sub.check_output(
-        "qstat %s"%queueid, stderr=sub.STDOUT, shell=True
-      ).decode().split('\n')[-2].split()[4]
-  except sub.CalledProcessError:
-    return "unknown"
+  if queueid is None:
+    return 'unknown'
+  qstat=queue_cache.state(queueid)
   if qstat == "R" or qstat == "Q":
     return "running"
   if qstat == "C" or qstat == "E":
@@ -57,20 +625,9 @@ def check_PBS_status(queueid):
 #-------------------------------------------------------
 def check_PBS_stati(queueid):
   """Utility function to determine the status of a set PBS job.
-  Can be done with one qstat call which can improve speed."""
-  try:
-    qstat = sub.check_output(
-        "qstat ", stderr=sub.STDOUT, shell=True
-      ).decode()
-  except sub.CalledProcessError:
-    return "unknown"
-  qstat=qstat.split('\n')
+  Uses the shared queue snapshot, so it doesn't call qstat each time."""
   for qid in queueid:
-    for line in qstat:
-      spl=line.split()
-      if qid in line and len(spl) > 4:
-        stat=line.split()[4]
-        if stat == "R" or stat == "Q":
-          return "running"
+    stat=queue_cache.state(qid)
+    if stat == "R" or stat == "Q":
+      return "running"
   return 'unknown'
-
@@ -0,0 +1,291 @@
+''' Run the scripts of many managers inside one allocation, handing out nodes as they free up.
+
+`Bundler` starts every script of a bundle at once (or in fixed lanes), so nodes sit idle once the
+short jobs finish. A task farm instead submits one job that runs this module as a launcher:
+  python3 taskfarm.py <taskfile>
+The launcher keeps a queue of the managers' scripts, longest first, and starts the next one that
+fits whenever nodes or cores free up, so short tasks backfill around long ones. Tasks that
+are expected to run past the walltime aren't started, so their managers resubmit them later.
+
+For each task, the launcher writes a record next to the script (`<scriptfile>.farm`, see
+`read_record`) with the farm's queue id, the state ('R' running, 'C' completed, 'E' failed),
+the exit code, start and stop times, and the hosts it ran on. Tasks that aren't started get a
+failed record with `skipped` set. `manager_tools.resolve_status` reads the record, so managers
+don't need to ask the queue about a task that finished (or was skipped). A running record is only
+believed while the farm job is in the queue, since a farm that's killed can't update it.
+Each task also gets a hostfile with its share of the allocation, in `$AG_HOSTFILE`
+(one line per core, like `$PBS_NODEFILE`), for mpirun commands in the runners' prefixes.
+'''
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import signal
+import subprocess as sub
+import submitter
+from bundler import Bundler
+from schedulers import walltime_seconds, seconds_walltime
+
+#######################################################################
+def read_record(scriptfile):
+  ''' Farm record of a manager's script.
+  Args:
+    scriptfile (str): path of the script.
+  Returns:
+    dict: the record, or None if the script hasn't been run by a task farm.
+  '''
+  try:
+    with open(scriptfile+'.farm','r') as f:
+      return json.load(f)
+  except (IOError,OSError,ValueError):
+    return None
+
+#----------------------------------------------------------------------
+def write_record(scriptfile,record):
+  # Written to a temporary file first, so the driver never reads half a record.
+  with open(scriptfile+'.farm.tmp','w') as f:
+    json.dump(record,f)
+  os.rename(scriptfile+'.farm.tmp',scriptfile+'.farm')
+
+#----------------------------------------------------------------------
+def farm_queueid():
+  ''' Queue id of the current job, as the submitting scheduler reports it.'''
+  for key in ('AG_JOBID','PBS_JOBID','SLURM_JOB_ID'):
+    if key in os.environ:
+      return os.environ[key].strip().split('.')[0]
+  return None
+
+#----------------------------------------------------------------------
+def allocation_hosts(nodes=1):
+  ''' Hosts of the current allocation, one entry per node.'''
+  if 'PBS_NODEFILE' in os.environ:
+    hosts=[]
+    for line in open(os.environ['PBS_NODEFILE'],'r'):
+      if line.strip()!='' and line.strip() not in hosts:
+        hosts.append(line.strip())
+    return hosts
+  if 'SLURM_JOB_NODELIST' in os.environ:
+    out=sub.check_output("scontrol show hostnames %s"%os.environ['SLURM_JOB_NODELIST'],shell=True)
+    return out.decode().split()
+  return ['localhost']*nodes
+
+#######################################################################
+class TaskFarm(Bundler):
+  ''' Submits the scripts of managers as one job that runs them as a task farm.
+
+  Use like a `Bundler`: managers are run with bundle=True and added with `add_job`, then `submit`
+  sends one job of up to `npb` nodes with `ppn` cores each. Runtime estimates (used to order the
+  tasks and to avoid starting tasks that can't finish) come from the runtime database, like in `Bundler`.
+  '''
+  def __init__(self,queue='normal',
+                    walltime='48:00:00',
+                    jobname='AGTaskFarm',
+                    npb=16,ppn=32,
+                    prefix=None,
+                    postfix=None,
+                    scheduler=None,
+                    estimates=None,
+                    db=None,
+                    path='./',
+                    poll=5.0
+                    ):
+    '''
+    Args:
+      npb (int): maximum number of nodes of the farm job.
+      ppn (int): cores per node.
+      path (str): directory to write the task list and the job script to.
+      poll (float): seconds between the launcher's checks on its tasks.
+      Other arguments are as for `Bundler`.
+    '''
+    Bundler.__init__(self,queue,walltime,jobname,npb,ppn,prefix,postfix,scheduler,estimates,db)
+    self.path=path
+    self.poll=poll
+
+  #------------------------------------------------
+  def tasks(self):
+    ''' Task list of the added managers, longest first.'''
+    tasks=[]
+    for mgr in self.jobs:
+      assert mgr.bundle_ready, "One of the Managers is not prepped for run."
+      runner=mgr.runner
+      if runner.np=='allprocs': cores=self.ppn
+      else:                     cores=min(runner.np,self.ppn)
+      tasks.append({
+          'path':os.path.abspath(mgr.path),
+          'script':mgr.scriptfile,
+          'name':mgr.path+mgr.name,
+          'nodes':runner.nn,
+          'cores':cores,
+          'estimate':self.estimate(mgr),
+        })
+    tasks.sort(key=lambda task:-task['estimate']*task['nodes']*task['cores'])
+    return tasks
+
+  #------------------------------------------------
+  def submit(self,jobname=None):
+    ''' Submit all the jobs of the added managers as one task farm.
+    Returns:
+      str: queue id of the farm, or None if nothing was submitted.
+    '''
+    if jobname is None: jobname=self.jobname
+    if len(self.jobs)==0: return None
+
+    tasks=self.tasks()
+    nodes=min(self.npb,sum([task['nodes'] for task in tasks]))
+    nodes=max([nodes]+[task['nodes'] for task in tasks])
+    work=sum([task['estimate']*task['nodes']*task['cores'] for task in tasks])
+    print(self.__class__.__name__,": %d tasks on %d nodes, predicted %s of %s node-hours."%\
+        (len(tasks),nodes,"%.1f"%(work/self.ppn/3600),"%.1f"%(nodes*walltime_seconds(self.walltime)/3600)))
+    if nodes>self.npb:
+      print(self.__class__.__name__,": Warning: a task needs %d nodes, more than npb=%d."%(nodes,self.npb))
+
+    # Records of earlier runs would be mistaken for this one.
+    for task in tasks:
+      for fname in ('.farm','.farm.tmp'):
+        if os.path.exists(os.path.join(task['path'],task['script']+fname)):
+          os.remove(os.path.join(task['path'],task['script']+fname))
+
+    taskfile=os.path.abspath(os.path.join(self.path,jobname+".tasks"))
+    with open(taskfile,'w') as f:
+      json.dump({
+          'nodes':nodes,
+          'ppn':self.ppn,
+          'walltime':walltime_seconds(self.walltime),
+          'poll':self.poll,
+          'tasks':tasks
+        },f,indent=1)
+
+    lines=self.scheduler.header(jobname,self.queue,self.walltime,nodes,self.ppn,jobname+".out")
+    lines+=self.prefix
+    lines+=["python3 %s %s"%(os.path.abspath(__file__),taskfile)]
+    lines+=self.postfix
+    farmfile=os.path.join(self.path,jobname+".farmjob")
+    with open(farmfile,'w') as f:
+      f.write('\n'.join(lines))
+    queueid=submitter.governor.submit(self.scheduler,os.path.basename(farmfile),self.path,self.priority(self.jobs))
+    print(self.__class__.__name__,": Submitted as %s"%queueid)
+    self.queueid.append(queueid)
+
+    for mgr in self.jobs:
+      mgr.update_queueid(queueid)
+    self.jobs=[]
+    return queueid
+
+#######################################################################
+class Launcher:
+  ''' Runs the tasks of a task list inside the allocation (see the module documentation).'''
+  def __init__(self,taskfile):
+    with open(taskfile,'r') as f:
+      spec=json.load(f)
+    self.taskfile=taskfile
+    self.tasks=spec['tasks']
+    self.ppn=spec['ppn']
+    self.walltime=spec['walltime']
+    self.poll=spec['poll']
+    self.queueid=farm_queueid()
+    hosts=allocation_hosts(spec['nodes'])
+    # Free cores on each node.
+    self.free=[[host,self.ppn] for host in hosts]
+    self.running=[]
+    self.start=time.time()
+
+  #------------------------------------------------
+  def _place(self,task):
+    ''' Nodes for a task, or None if it doesn't fit yet.
+    Tasks on one node go to the fullest node they fit on, which keeps whole nodes free for wider tasks.'''
+    fits=[idx for idx,(host,free) in enumerate(self.free) if free>=task['cores']]
+    if len(fits)<task['nodes']:
+      return None
+    fits.sort(key=lambda idx:self.free[idx][1])
+    return fits[:task['nodes']]
+
+  #------------------------------------------------
+  def _launch(self,task,nodes):
+    scriptfile=os.path.join(task['path'],task['script'])
+    hosts=[self.free[idx][0] for idx in nodes]
+    for idx in nodes:
+      self.free[idx][1]-=task['cores']
+    with open(scriptfile+'.hosts','w') as f:
+      f.write(''.join(["%s\n"%host for host in hosts for core in range(task['cores'])]))
+    env=dict(os.environ,AG_HOSTFILE=scriptfile+'.hosts',AG_NODES=str(len(hosts)),AG_CORES=str(task['cores']))
+    task['record']={'queueid':self.queueid,'state':'R','exit':None,
+        'start':time.time(),'stop':None,'hosts':hosts}
+    write_record(scriptfile,task['record'])
+    task['proc']=sub.Popen("bash %s"%task['script'],shell=True,cwd=task['path'],env=env)
+    task['nodeidx']=nodes
+    self.running.append(task)
+    print("Launcher: started %s on %s"%(task['name'],','.join(hosts)))
+    if task['estimate']>self.walltime:
+      print("Launcher: %s is expected to take longer than the walltime."%task['name'])
+    sys.stdout.flush()
+
+  #------------------------------------------------
+  def _finish(self,task):
+    scriptfile=os.path.join(task['path'],task['script'])
+    record=task['record']
+    record['exit']=task['proc'].returncode
+    record['stop']=time.time()
+    if record['exit']==0: record['state']='C'
+    else:                 record['state']='E'
+    write_record(scriptfile,record)
+    for idx in task['nodeidx']:
+      self.free[idx][1]+=task['cores']
+    self.running.remove(task)
+    runtime=record['stop']-record['start']
+    print("Launcher: %s finished with exit code %d after %s"%(task['name'],record['exit'],seconds_walltime(runtime)))
+    sys.stdout.flush()
+
+  #------------------------------------------------
+  def _terminate(self,signum,frame):
+    ''' Mark the running tasks as failed when the queue stops the farm (it sends SIGTERM before killing it).'''
+    for task in list(self.running):
+      record=task['record']
+      record['state']='E'
+      record['stop']=time.time()
+      write_record(os.path.join(task['path'],task['script']),record)
+      task['proc'].terminate()
+    print("Launcher: stopped by signal %d with %d tasks running."%(signum,len(self.running)))
+    sys.exit(1)
+
+  #------------------------------------------------
+  def run(self):
+    ''' Run the tasks until all have finished or none of the rest can finish in time.
+    Returns:
+      int: number of tasks that failed or weren't started.
+    '''
+    signal.signal(signal.SIGTERM,self._terminate)
+    pending=list(self.tasks)
+    nfailed=0
+    while len(pending)>0 or len(self.running)>0:
+      for task in list(self.running):
+        if task['proc'].poll() is not None:
+          self._finish(task)
+          if task['record']['exit']!=0: nfailed+=1
+
+      remaining=self.walltime-(time.time()-self.start)
+      for task in list(pending):
+        # Tasks expected to take longer than the whole walltime are started anyway, like in a bundle
+        # (they'd never run otherwise). If the farm is killed, their managers find out from the queue.
+        late=task['estimate']>remaining and task['estimate']<=self.walltime
+        if task['nodes']>len(self.free) or late:
+          print("Launcher: not starting %s, which would not fit in the allocation."%task['name'])
+          pending.remove(task)
+          task['record']={'queueid':self.queueid,'state':'E','exit':None,
+              'start':None,'stop':time.time(),'hosts':[],'skipped':True}
+          write_record(os.path.join(task['path'],task['script']),task['record'])
+          nfailed+=1
+          continue
+        nodes=self._place(task)
+        if nodes is not None:
+          pending.remove(task)
+          self._launch(task,nodes)
+
+      if len(self.running)>0:
+        time.sleep(self.poll)
+    return nfailed
+
+#######################################################################
+if __name__=='__main__':
+  nfailed=Launcher(sys.argv[1]).run()
+  print("Launcher: done, %d tasks failed or were not started."%nfailed)
@@ -0,0 +1,203 @@
+'''
+Benchmark reading GRED.DAT with `crystal2qmc.read_gred` against the parser it replaced,
+which split the file into a list of words and converted each section from strings.
+
+Synthetic GRED files with the layout read_gred expects are written for systems of increasing
+size, with Fortran-style glued negative numbers. Like real files, they end with sections that
+read_gred doesn't use (standing in for the density matrix), which the new parser never converts.
+Both parsers must give the same results. Memory is the peak traced by tracemalloc.
+
+Run from this directory: python3 gred_bench.py
+'''
+import sys
+sys.path.append('../..')
+import os
+import time
+import tracemalloc
+import tempfile
+import numpy as np
+from crystal2qmc import read_gred
+from synthetic_crystal import write_gred
+
+#------------------------------------------------
+# read_gred before it read the file into one array of numbers.
+def legacy_read_gred(gred="GRED.DAT"):
+  lat_parm = {}
+  ions = {}
+  basis = {}
+  pseudo = {}
+
+  gred = open(gred,'r').read()
+
+  # Fix numbers with no space between them.
+  gred = gred.replace("-"," -")
+  gred = gred.replace("E -","E-") 
+
+  gred_words = gred.split()
+  nparms = [int(w) for w in gred_words[1:4]]
+  cursor = 4
+
+  # These follow naming of cryapi_inp (but "inf" -> "info").
+  info = [int(w) for w in gred_words[cursor          :cursor+nparms[0]]]
+  itol = [int(w) for w in gred_words[cursor+nparms[0]:cursor+nparms[1]]]
+  par  = [int(w) for w in gred_words[cursor+nparms[1]:cursor+nparms[2]]]
+  cursor += sum(nparms)
+
+  lat_parm['struct_dim'] = int(info[9])
+
+  # Lattice parameters.
+  lat_parm['latvecs'] = \
+      np.array(gred_words[cursor:cursor+9],dtype=float).reshape(3,3).T.round(15)
+  if (lat_parm['latvecs'] > 100).any():
+    print("Lattice parameter larger than 100 A! Reducing to 100.")
+    print("If this is a dimension < 3 system, there is no cause for alarm.")
+    print("Otherwise if this is a problem for you, please generalize crystal2qmc.")
+    lat_parm['latvecs'][lat_parm['latvecs']>100] = 100.
+  cursor += 9
+  prim_trans= np.array(gred_words[cursor:cursor+9],dtype=float).reshape(3,3)
+  cursor += 9
+  lat_parm['conv_cell'] = prim_trans.dot(lat_parm['latvecs'])
+  cursor += info[1] + 48*48 + 9*info[1] + 3*info[1] # Skip symmetry part.
+
+  # Lattice "stars" (?) skipped.
+  cursor += info[4]+1 + info[78]*3 + info[4]+1 + info[4]+1 + info[78] + info[78]*3
+
+  # Some of ion information.
+  natoms = info[23]
+  ions['charges'] = [float(w) for w in gred_words[cursor:cursor+natoms]]
+  cursor += natoms
+  # Atom positions.
+  atom_poss = np.array(gred_words[cursor:cursor+3*natoms],dtype=float)
+  ions['positions'] = atom_poss.reshape(natoms,3)
+  cursor += 3*natoms
+
+  # Basis information (some ion information mixed in).
+  nshells = info[19]
+  nprim   = info[74]
+  # Formal charge of shell.
+  basis['charges'] = np.array(gred_words[cursor:cursor+nshells],dtype=float)
+  cursor += nshells
+  # "Adjoined gaussian" of shells.
+  basis['adj_gaus'] = np.array(gred_words[cursor:cursor+nshells],dtype=float)
+  cursor += nshells
+  # Position of shell.
+  shell_poss = np.array(gred_words[cursor:cursor+3*nshells],dtype=float)
+  basis['positions'] = shell_poss.reshape(nshells,3)
+  cursor += 3*nshells
+  # Primitive gaussian exponents.
+  basis['prim_gaus'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  cursor += nprim
+  # Coefficients of s, p, d, and (?).
+  basis['coef_s'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  cursor += nprim
+  basis['coef_p'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  cursor += nprim
+  basis['coef_dfg'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  cursor += nprim
+  basis['coef_max'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  cursor += nprim
+  # Skip "old normalization"
+  cursor += 2*nprim
+  # Atomic numbers.
+  ions['atom_nums'] = np.array(gred_words[cursor:cursor+natoms],dtype=int)
+  cursor += natoms
+  # First shell of each atom (skip extra number after).
+  basis['first_shell'] = np.array(gred_words[cursor:cursor+natoms],dtype=int)
+  cursor += natoms + 1
+  # First primitive of each shell (skips an extra number after).
+  basis['first_prim'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  cursor += nshells + 1
+  # Number of prims per shell.
+  basis['prim_shell'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  cursor += nshells
+  # Type of shell: 0=s,1=sp,2=p,3=d,4=f.
+  basis['shell_type'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  cursor += nshells
+  # Number of atomic orbtials per shell.
+  basis['nao_shell'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  cursor += nshells
+  # First atomic orbtial per shell (skip extra number after).
+  basis['first_ao'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  cursor += nshells + 1
+  # Atom to which each shell belongs.
+  basis['atom_shell'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  cursor += nshells
+
+  # Pseudopotential information.
+  # Pseudopotential for each element.
+  pseudo_atom = np.array(gred_words[cursor:cursor+natoms],dtype=int)
+  cursor += natoms
+  cursor += 1 # skip INFPOT
+  ngauss = int(gred_words[cursor])
+  cursor += 1
+  headlen = int(gred_words[cursor])
+  cursor += 1
+  # Number of pseudopotentials.
+  numpseudo = int(gred_words[cursor])
+  cursor += 1
+  # Exponents of r^l prefactor.
+  r_exps = -1*np.array(gred_words[cursor:cursor+ngauss],dtype=int)
+  cursor += ngauss
+  # Number of Gaussians for angular momenutum j
+  n_per_j = np.array(gred_words[cursor:cursor+headlen],dtype=int)
+  cursor += headlen
+  # index of first n_per_j for each pseudo.
+  pseudo_start = np.array(gred_words[cursor:cursor+numpseudo],dtype=int)
+  cursor += numpseudo + 1
+  # Actual floats of pseudopotential.
+  exponents = np.array(gred_words[cursor:cursor+ngauss],dtype=float)
+  cursor += ngauss
+  prefactors = np.array(gred_words[cursor:cursor+ngauss],dtype=float)
+  cursor += ngauss
+  # Store information nicely.
+  npjlen = int(headlen / len(pseudo_start))
+  for aidx,atom in enumerate(ions['atom_nums']):
+    psidx = pseudo_atom[aidx]-1
+    start = pseudo_start[psidx]
+    if psidx+1 >= len(pseudo_start): end = ngauss
+    else                           : end = pseudo_start[psidx+1]
+    if atom not in pseudo.keys():
+      pseudo[atom] = {}
+      pseudo[atom]['prefactors'] = prefactors[start:end]
+      pseudo[atom]['r_exps'] = r_exps[start:end]
+      pseudo[atom]['n_per_j'] = n_per_j[npjlen*psidx:npjlen*(psidx+1)]
+      pseudo[atom]['exponents'] = exponents[start:end]
+  return info, lat_parm, ions, basis, pseudo
+
+#------------------------------------------------
+def same(a,b):
+  if isinstance(a,dict):
+    return a.keys()==b.keys() and all([same(a[k],b[k]) for k in a])
+  if isinstance(a,(list,tuple)) and not isinstance(b,np.ndarray):
+    return len(a)==len(b) and all([same(x,y) for x,y in zip(a,b)])
+  return np.array_equal(np.asarray(a),np.asarray(b))
+
+def measure(func,fname,nrep=3):
+  ''' Best time and peak traced memory of reading fname.'''
+  best=np.inf
+  for rep in range(nrep):
+    start=time.perf_counter()
+    func(fname)
+    best=min(best,time.perf_counter()-start)
+  tracemalloc.start()
+  result=func(fname)
+  peak=tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return best,peak,result
+
+def run_benchmark(sizes=(8,32,128,512)):
+  print("%8s %10s %12s %12s %10s %12s %12s"%("atoms","file (MB)","legacy (s)","new (s)","speedup","legacy (MB)","new (MB)"))
+  tmpdir=tempfile.mkdtemp()
+  for natoms in sizes:
+    fname=os.path.join(tmpdir,"GRED.DAT")
+    write_gred(fname,natoms)
+    told,mold,rold=measure(legacy_read_gred,fname)
+    tnew,mnew,rnew=measure(read_gred,fname)
+    assert same(rold,rnew), "Parsers disagree for %d atoms."%natoms
+    print("%8d %10.1f %12.3f %12.3f %10.1f %12.1f %12.1f"%(natoms,os.path.getsize(fname)/1e6,
+        told,tnew,told/tnew,mold/1e6,mnew/1e6))
+    os.remove(fname)
+  os.rmdir(tmpdir)
+
+if __name__=='__main__':
+  run_benchmark()
@@ -0,0 +1,200 @@
+'''
+Benchmark reading KRED.DAT with `crystal2qmc.read_kred` against the reader it replaced,
+which kept every word of the file in a list and every eigenvector of every k-point.
+
+Synthetic GRED and KRED files (see synthetic_crystal.py) are written for systems of increasing
+size on a 2x2x3 k-mesh, which has 4 real and 8 complex k-points. The new reader is timed reading
+everything (as convert_crystal does for kset='complex' and nvirtual large enough), and reading
+only the real k-points and a quarter of the orbitals. The orbitals it keeps must match the legacy
+reader's. Memory is the peak traced by tracemalloc.
+
+Run from this directory: python3 kred_bench.py
+'''
+import sys
+sys.path.append('../..')
+import os
+import time
+import tracemalloc
+import tempfile
+import numpy as np
+from crystal2qmc import read_gred, read_kred, error
+from synthetic_crystal import write_gred, write_kred
+
+#------------------------------------------------
+# read_kred before it streamed the file.
+def legacy_read_kred(info,basis,kred="KRED.DAT"):
+  eigsys = {}
+
+  kred = open(kred)
+#  print(kred.readline())
+#  kred=kred.read()
+  kred_words = [] #kred.split()
+  for lin in kred:
+    kred_words += lin.split()
+  cursor = 0
+
+  # Number of k-points in each direction.
+  eigsys['nkpts_dir'] = np.array([int(w) for w in kred_words[cursor:cursor+3]])
+  cursor += 3
+  # Total number of inequivilent k-points.
+  nikpts = int(kred_words[cursor])
+  cursor += 1
+  # Reciprocal basis.
+  recip_vecs = np.array(kred_words[cursor:cursor+9],dtype=float)
+  eigsys['recip_vecs'] = recip_vecs.reshape(3,3)
+  cursor += 9
+  # Inequivilent k-point coord in reciprocal basis.
+  ikpt_coords = np.array(kred_words[cursor:cursor+3*nikpts],int)
+  ikpt_coords = list(map(tuple,ikpt_coords.reshape(nikpts,3)))
+  # Useful to compare to old output format.
+  eigsys['kpt_index'] = dict(zip(ikpt_coords,range(len(ikpt_coords))))
+  cursor += 3*nikpts
+  # is complex (0) or not (1), converted to True (if complex) or False
+  ikpt_iscmpx = \
+    np.array([int(w) for w in kred_words[cursor:cursor+nikpts]]) == 0
+  eigsys['ikpt_iscmpx'] = dict(zip(ikpt_coords,ikpt_iscmpx))
+  cursor += nikpts
+  # Skip symmetry information.
+  cursor += 9*48
+  # Geometric weight of kpoints.
+  eigsys['kpt_weights'] = np.array(kred_words[cursor:cursor+nikpts],dtype=float)
+  cursor += nikpts
+  # Eigenvalues: (how many) = (spin) * (number of basis) * (number of kpoints)
+  eigsys['nspin'] = info[63]+1
+  nevals = eigsys['nspin']*info[6]*nikpts
+  eigsys['eigvals'] = np.array(kred_words[cursor:cursor+nevals],dtype=float)
+  cursor += nevals
+  # Weights of eigenvales--incorperating Fermi energy cutoff.
+  nbands = int(round(nevals / nikpts / eigsys['nspin']))
+  eigsys['eig_weights'] = np.array(kred_words[cursor:cursor+nevals],dtype=float)\
+      .reshape(nikpts,eigsys['nspin'],nbands)
+  cursor += nevals
+
+  # Read in eigenvectors at inequivilent kpoints. Can't do all kpoints because we 
+  # don't know if non-inequivilent kpoints are real or complex (without symmetry
+  # info)
+  nbands = int(round(nevals / nikpts / eigsys['nspin']))
+  nkpts  = np.prod(eigsys['nkpts_dir'])
+  nao = sum(basis['nao_shell'])
+  ncpnts = int(nbands * nao)
+  kpt_coords   = []
+  # Format: eigvecs[kpoint][<real/imag>][<spin up/spin down>]
+  eigvecs = {}
+  for kpt in range(nkpts*eigsys['nspin']):
+    try:
+      new_kpt_coord = tuple([int(w) for w in kred_words[cursor:cursor+3]])
+    except IndexError: # End of file.
+      error("ERROR: KRED.DAT seems to have ended prematurely.\n" + \
+            "Didn't find all {0} kpoints.".format(nikpts),"IO Error")
+    cursor += 3
+
+    # If new_kpt_coord is an inequivilent point...
+    if new_kpt_coord in ikpt_coords:
+      # If complex...
+      if eigsys['ikpt_iscmpx'][new_kpt_coord]:
+        eig_k = np.array(kred_words[cursor:cursor+2*ncpnts],dtype=float)
+        cursor += 2*ncpnts
+        eig_k = eig_k.reshape(ncpnts,2)
+        kpt_coords.append(new_kpt_coord)
+        if new_kpt_coord in eigvecs.keys():
+          eigvecs[new_kpt_coord]['real'].append(
+              eig_k[:,0].reshape(int(round(ncpnts/nao)),nao)
+            )
+          eigvecs[new_kpt_coord]['imag'].append(
+              eig_k[:,1].reshape(int(round(ncpnts/nao)),nao)
+            )
+        else:
+          eigvecs[new_kpt_coord] = {}
+          eigvecs[new_kpt_coord]['real'] = \
+            [eig_k[:,0].reshape(int(round(ncpnts/nao)),nao)]
+          eigvecs[new_kpt_coord]['imag'] = \
+            [eig_k[:,1].reshape(int(round(ncpnts/nao)),nao)]
+      else: # ...else real.
+        eig_k = np.array(kred_words[cursor:cursor+ncpnts],dtype=float)
+        cursor += ncpnts
+        kpt_coords.append(new_kpt_coord)
+        if new_kpt_coord in eigvecs.keys():
+          eigvecs[new_kpt_coord]['real'].append(
+              eig_k.reshape(int(round(ncpnts/nao)),nao)
+            )
+          eigvecs[new_kpt_coord]['imag'].append(
+              np.zeros((int(round(ncpnts/nao)),nao))
+            ) # Not efficient, but safe.
+        else:
+          eigvecs[new_kpt_coord] = {}
+          eigvecs[new_kpt_coord]['real'] = \
+            [eig_k.reshape(int(round(ncpnts/nao)),nao)]
+          eigvecs[new_kpt_coord]['imag'] = \
+            [np.zeros((int(round(ncpnts/nao)),nao))]
+    else: # ...else, skip.
+      skip = True
+      while skip:
+        try: # If there's an int, we're at next kpoint.
+          int(kred_words[cursor])
+          skip = False
+        except ValueError: # Keep skipping.
+          cursor += ncpnts
+        except IndexError: # End of file.
+          skip = False
+          break
+
+  # It's probably true that kpt_coords == ikpt_coords, with repitition for spin
+  # up and spin down, because we only read in inequivilent kpoints. However,
+  # ordering might be different, and the ordering is correct for kpt_coords.
+  # If there are bugs, this might be a source.
+  eigsys['kpt_coords'] = ikpt_coords # kpt_coords
+  eigsys['eigvecs'] = eigvecs
+
+  return eigsys
+
+#------------------------------------------------
+def consistent(old,new):
+  ''' Whether the orbitals new kept are the same as the first ones of old.'''
+  for kpt in new['eigvecs']:
+    for part in new['eigvecs'][kpt]:
+      for vold,vnew in zip(old['eigvecs'][kpt][part],new['eigvecs'][kpt][part]):
+        if not np.array_equal(vold[:vnew.shape[0]],vnew):
+          return False
+  return np.array_equal(old['eigvals'],new['eigvals'])
+
+def measure(func,nrep=3):
+  ''' Best time and peak traced memory of calling func.'''
+  best=np.inf
+  for rep in range(nrep):
+    start=time.perf_counter()
+    func()
+    best=min(best,time.perf_counter()-start)
+  tracemalloc.start()
+  result=func()
+  peak=tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return best,peak,result
+
+def run_benchmark(sizes=(2,4,8)):
+  print("%6s %6s %10s %-14s %10s %10s %12s"%("atoms","nao","file (MB)","reader","time (s)","speedup","memory (MB)"))
+  tmpdir=tempfile.mkdtemp()
+  gred=os.path.join(tmpdir,"GRED.DAT")
+  kred=os.path.join(tmpdir,"KRED.DAT")
+  for natoms in sizes:
+    nao=write_gred(gred,natoms)
+    write_kred(kred,nao,kmesh=(2,2,3))
+    info,lat_parm,ions,basis,pseudo=read_gred(gred)
+    readers=[
+        ('legacy',lambda:legacy_read_kred(info,basis,kred)),
+        ('all',lambda:read_kred(info,basis,kred)),
+        ('real, nao/4',lambda:read_kred(info,basis,kred,kset='real',maxmo_spin=nao//4))
+      ]
+    for name,func in readers:
+      elapsed,peak,result=measure(func)
+      if name=='legacy':
+        told,rold=elapsed,result
+      else:
+        assert consistent(rold,result), "Readers disagree for %d atoms (%s)."%(natoms,name)
+      print("%6d %6d %10.1f %-14s %10.3f %10.1f %12.1f"%(natoms,nao,os.path.getsize(kred)/1e6,
+          name,elapsed,told/elapsed,peak/1e6))
+  os.remove(gred)
+  os.remove(kred)
+  os.rmdir(tmpdir)
+
+if __name__=='__main__':
+  run_benchmark()
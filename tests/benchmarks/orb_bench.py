@@ -0,0 +1,143 @@
+'''
+Benchmark writing QWalk .orb files with `orbfile` against the loops it replaced, which
+formatted and wrote one index line or one coefficient at a time.
+
+Both file formats are timed: crystal2qmc's (fixed-width index, 12-digit exponents, 5 per line)
+and pyscf2qwalk's (shortest float repr, 10 per line), for real and complex orbitals of
+systems of increasing size, with 13 AOs per atom, 2 electrons per atom, 50 virtuals, and
+two spins. The files must be byte-identical.
+
+Run from this directory: python3 orb_bench.py
+'''
+import sys
+sys.path.append('../..')
+import os
+import tempfile
+import time
+import numpy as np
+import orbfile
+
+#------------------------------------------------
+# Index and coefficients of crystal2qmc.write_orb before orbfile.
+def legacy_crystal_orb(outf,atidxs,nao_atom,totnmo,eigvecs_real,eigvecs_imag,maxmo_spin):
+  coef_cnt = 1
+  for moidx in np.arange(totnmo)+1:
+    for atidx in atidxs+1:
+      for aoidx in np.arange(nao_atom[atidx-1])+1:
+        outf.write(" {:5d} {:5d} {:5d} {:5d}\n"\
+            .format(moidx,aoidx,atidx,coef_cnt))
+        coef_cnt += 1
+  eigreal_flat = [e[0:maxmo_spin,:].flatten() for e in eigvecs_real]
+  print_cnt = 0
+  outf.write("COEFFICIENTS\n")
+  if eigvecs_imag is not None: #complex coefficients
+    eigimag_flat = [e[0:maxmo_spin,:].flatten() for e in eigvecs_imag]
+    for eigr,eigi in zip(eigreal_flat,eigimag_flat):
+      for r,i in zip(eigr,eigi):
+        outf.write("({:<.12e},{:<.12e}) "\
+            .format(r,i))
+        print_cnt+=1
+        if print_cnt%5==0: outf.write("\n")
+  else: #Real coefficients
+    for eigr in eigreal_flat:
+      for r in eigr:
+        outf.write("{:< 15.12e} ".format(r))
+        print_cnt+=1
+        if print_cnt%5==0: outf.write("\n")
+
+def crystal_orb(outf,atidxs,nao_atom,totnmo,eigvecs_real,eigvecs_imag,maxmo_spin):
+  orbfile.write_index(outf,totnmo,nao_atom[atidxs],atidxs+1,fmt=" %5d %5d %5d %5d\n")
+  outf.write("COEFFICIENTS\n")
+  if eigvecs_imag is not None:
+    eigvecs = []
+    for eigr,eigi in zip(eigvecs_real,eigvecs_imag):
+      eig = np.empty(eigr[0:maxmo_spin,:].shape,dtype=complex)
+      eig.real = eigr[0:maxmo_spin,:]
+      eig.imag = eigi[0:maxmo_spin,:]
+      eigvecs.append(eig)
+    orbfile.write_coefficients(outf,eigvecs,None,5,cfmt="(%.12e,%.12e) ")
+  else:
+    orbfile.write_coefficients(outf,[e[0:maxmo_spin,:] for e in eigvecs_real],"% -15.12e ",5)
+
+#------------------------------------------------
+# Index and coefficients of pyscf2qwalk.print_orb_coeff before orbfile, with the AO
+# ranges of mol.offset_nr_by_atom() and the labels of gto.mole.spheric_labels(mol) given.
+def legacy_pyscf_orb(f,aos_atom,aosym,norms,coeff):
+  nmo=coeff.shape[1]
+  count=0
+  for ni in range(nmo):
+    for ai,a in enumerate(aos_atom):
+      for bi,b in enumerate(range(a[2],a[3])):
+        f.write("%i %i %i %i\n"%(ni+1,bi+1,ai+1,count+1))
+        count += 1
+  count=0
+  f.write("COEFFICIENTS\n")
+  for a in coeff.T:
+    for ib,b in enumerate(a):
+      c=norms[aosym[ib]]*b
+      if isinstance(c,float):
+        f.write(str(c)+" ")
+      else:
+        f.write("("+str(c.real)+","+str(c.imag)+") ")
+      count+=1
+      if count%10==0:
+        f.write("\n")
+  f.write("\n")
+
+def pyscf_orb(f,aos_atom,aosym,norms,coeff):
+  nmo=coeff.shape[1]
+  orbfile.write_index(f,nmo,[a[3]-a[2] for a in aos_atom])
+  f.write("COEFFICIENTS\n")
+  aonorms=np.array([norms[sym] for sym in aosym])
+  orbfile.write_coefficients(f,aonorms*coeff.T,"%r ",10,cfmt="(%r,%r) ")
+  f.write("\n")
+
+#------------------------------------------------
+def crystal_case(natoms,iscomplex,rng):
+  nao_atom=np.full(natoms,13)
+  nao=nao_atom.sum()
+  maxmo_spin=2*natoms//2+50
+  real=[rng.uniform(-1,1,(nao,nao)) for spin in range(2)]
+  if iscomplex: imag=[rng.uniform(-1,1,(nao,nao)) for spin in range(2)]
+  else:         imag=None
+  return (np.arange(natoms),nao_atom,2*maxmo_spin,real,imag,maxmo_spin)
+
+def pyscf_case(natoms,iscomplex,rng):
+  labels=['s','s','s','px','py','pz','px','py','pz','dxy','dyz','dz^2','dxz']
+  norms=dict([(label,rng.uniform(0.1,2)) for label in labels])
+  aos_atom=[(0,0,13*a,13*(a+1)) for a in range(natoms)]
+  nao=13*natoms
+  nmo=2*(2*natoms//2+50)
+  coeff=rng.uniform(-1,1,(nao,nmo))*10.**rng.randint(-6,2,(nao,nmo))
+  coeff[0,:2]=-0.0
+  if iscomplex: coeff=coeff+1j*rng.uniform(-1,1,(nao,nmo))
+  return (aos_atom,labels*natoms,norms,coeff)
+
+def measure(func,args,fname):
+  ''' Time to write fname, and its contents.'''
+  start=time.perf_counter()
+  with open(fname,'w') as outf:
+    func(outf,*args)
+  elapsed=time.perf_counter()-start
+  with open(fname) as inpf:
+    text=inpf.read()
+  os.remove(fname)
+  return elapsed,text
+
+def run_benchmark(sizes=(8,32,64)):
+  rng=np.random.RandomState(0)
+  fname=os.path.join(tempfile.mkdtemp(),"bench.orb")
+  print("%-8s %-8s %6s %10s %12s %12s %10s %12s"%("format","orbitals","atoms","file (MB)","legacy (s)","new (s)","speedup","new (MB/s)"))
+  for name,case,legacy,new in (('crystal',crystal_case,legacy_crystal_orb,crystal_orb),('pyscf',pyscf_case,legacy_pyscf_orb,pyscf_orb)):
+    for iscomplex in (False,True):
+      for natoms in sizes:
+        args=case(natoms,iscomplex,rng)
+        told,old=measure(legacy,args,fname)
+        tnew,text=measure(new,args,fname)
+        assert old==text, "Files differ for the %s format and %d atoms."%(name,natoms)
+        print("%-8s %-8s %6d %10.1f %12.3f %12.3f %10.1f %12.1f"%(name,['real','complex'][iscomplex],natoms,
+            len(text)/1e6,told,tnew,told/tnew,len(text)/1e6/tnew))
+  os.rmdir(os.path.dirname(fname))
+
+if __name__=='__main__':
+  run_benchmark()
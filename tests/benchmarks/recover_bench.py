@@ -0,0 +1,62 @@
+'''
+Benchmark the cost of recover() against the size of reader.output.
+
+Compares the fingerprint fast path in `manager_tools.update_attributes` with a
+full `deep_compare` of every attribute (the behavior before fingerprints).
+Times don't include unpickling the saved state, which both need.
+
+Run from this directory: python3 recover_bench.py
+'''
+import sys
+sys.path.append('../..')
+import time
+import pickle as pkl
+import numpy as np
+from manager_tools import update_attributes, deep_compare, fingerprint, fingerprint_skip_keys
+from variance import VarianceReader
+
+def make_reader(nbasis):
+  ''' Reader with a PySCFReader-sized output (two spin density matrices and orbitals).'''
+  reader=VarianceReader()
+  reader.completed=True
+  reader.output={
+      'density_matrix':np.random.random((2,nbasis,nbasis)),
+      'scf':{'mo_coeff':np.random.random((2,nbasis,nbasis)),'mo_energy':np.random.random((2,nbasis))},
+      'file':'scf.py.o'
+    }
+  return reader
+
+def time_call(func,setup,nrep=5):
+  ''' Best time of func(setup()), not counting setup (e.g. unpickling the saved state).'''
+  best=np.inf
+  for rep in range(nrep):
+    arg=setup()
+    start=time.perf_counter()
+    func(arg)
+    best=min(best,time.perf_counter()-start)
+  return best
+
+def full_compare(inmemory,loaded):
+  ''' The comparison update_attributes made before fingerprints.'''
+  return [deep_compare(inmemory.__dict__[k],v) for k,v in loaded.__dict__.items() if k not in fingerprint_skip_keys]
+
+def run_benchmark(sizes=(50,100,200,400,800,1600)):
+  print("%8s %12s %14s %14s %14s"%("nbasis","output (MB)","first (ms)","fast (ms)","full (ms)"))
+  for nbasis in sizes:
+    inmemory=make_reader(nbasis)
+    # Fingerprints are computed when the manager is saved.
+    fingerprint(inmemory)
+    saved=pkl.dumps(inmemory)
+    size=sum([v.nbytes for v in (inmemory.output['density_matrix'],)+tuple(inmemory.output['scf'].values())])
+    load=lambda: pkl.loads(saved)
+
+    # First comparison in a new process: nothing cached for the fresh object.
+    first=time_call(lambda loaded: update_attributes(make_reader(nbasis),loaded,take_keys=['completed','output']),load,nrep=1)
+
+    # Repeated recovers (what nextstep does): digests are cached on both sides.
+    fast=time_call(lambda loaded: update_attributes(inmemory,loaded,take_keys=['completed','output']),load)
+    full=time_call(lambda loaded: full_compare(inmemory,loaded),load)
+    print("%8d %12.1f %14.2f %14.2f %14.2f"%(nbasis,size/1e6,first*1e3,fast*1e3,full*1e3))
+
+if __name__=='__main__':
+  run_benchmark()
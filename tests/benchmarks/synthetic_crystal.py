@@ -0,0 +1,104 @@
+'''
+Synthetic GRED.DAT and KRED.DAT files, with the layout crystal2qmc reads, for benchmarks.
+
+The basis has only p shells, so the files also go through the normalization and the writers
+of `crystal2qmc.convert_crystal`. Values are random.
+'''
+import numpy as np
+
+#------------------------------------------------
+def format_block(values,fmt,perline):
+  ''' Fortran-style lines: with fmt like "% .12E", no space is left before negative numbers.'''
+  fields=[fmt%v for v in values]
+  return '\n'.join([''.join(fields[i:i+perline]) for i in range(0,len(fields),perline)])+'\n'
+
+#------------------------------------------------
+def write_gred(fname,natoms,shells_per_atom=20,prims_per_shell=4,ndensity=50,nspin=1):
+  ''' Write a synthetic GRED.DAT for natoms atoms.
+  ndensity numbers per primitive stand in for the density matrix and other trailing sections.
+  Returns:
+    int: number of atomic orbitals.
+  '''
+  rng=np.random.RandomState(natoms)
+  nshells=natoms*shells_per_atom
+  nprim=nshells*prims_per_shell
+  ngauss,headlen,numpseudo=12,6,1
+  info=np.zeros(80,dtype=int)
+  info[1]=4        # Symmetry operators.
+  info[4]=10       # Stars.
+  info[6]=nshells*3
+  info[9]=3
+  info[19]=nshells
+  info[23]=natoms
+  info[63]=nspin-1
+  info[74]=nprim
+  info[78]=20
+  sections=[]
+  def ints(values): sections.append(format_block(values,"%12d",6))
+  def floats(values): sections.append(format_block(values,"% .12E",4))
+  ints([0,80,100,120])
+  ints(np.concatenate([info,np.zeros(220,dtype=int)]))
+  floats(rng.uniform(-5,5,9))
+  floats(np.eye(3).ravel())
+  nskip=info[1]+48*48+9*info[1]+3*info[1]
+  nskip+=info[4]+1+info[78]*3+info[4]+1+info[4]+1+info[78]+info[78]*3
+  ints(rng.randint(-3,3,nskip))
+  floats(rng.uniform(1,30,natoms))
+  floats(rng.uniform(-5,5,3*natoms))
+  floats(np.full(nshells,2.0))
+  floats(np.zeros(nshells))
+  floats(rng.uniform(-5,5,3*nshells))
+  floats(rng.uniform(0.1,20,nprim))
+  # Only the p coefficients are nonzero, since write_basis doesn't handle hybridized shells.
+  for sec in range(6):
+    if sec==1: floats(rng.uniform(-2,2,nprim))
+    else:      floats(np.zeros(nprim))
+  ints(200+rng.randint(1,30,natoms))     # Atomic numbers with pseudopotentials.
+  ints(np.arange(natoms+1)*shells_per_atom+1)
+  ints(np.arange(nshells+1)*prims_per_shell+1)
+  ints(np.full(nshells,prims_per_shell))
+  ints(np.full(nshells,2))
+  ints(np.full(nshells,3))
+  ints(np.arange(nshells+1)*3+1)
+  ints(np.repeat(np.arange(natoms),shells_per_atom)+1)
+  ints(np.ones(natoms,dtype=int))
+  ints([0,ngauss,headlen,numpseudo])
+  ints(rng.randint(0,3,ngauss))
+  ints([2,2,2,2,2,2])
+  ints([0,0])
+  floats(rng.uniform(0.1,10,ngauss))
+  floats(rng.uniform(-10,10,ngauss))
+  floats(rng.uniform(-1,1,ndensity*nprim))
+  with open(fname,'w') as outf:
+    outf.write(''.join(sections))
+  return nshells*3
+
+#------------------------------------------------
+def write_kred(fname,nao,kmesh=(2,2,2),nspin=1,seed=0):
+  ''' Write a synthetic KRED.DAT with nao orbitals of nao atomic orbitals at every point of kmesh.
+  Points whose coordinates are all 0 or half the mesh are real, the others complex.
+  '''
+  rng=np.random.RandomState(seed)
+  coords=[(i,j,k) for i in range(kmesh[0]) for j in range(kmesh[1]) for k in range(kmesh[2])]
+  isreal=[all([(2*c)%n==0 for c,n in zip(coord,kmesh)]) for coord in coords]
+  nikpts=len(coords)
+  nevals=nspin*nao*nikpts
+  sections=[]
+  def ints(values): sections.append(format_block(values,"%12d",6))
+  def floats(values): sections.append(format_block(values,"%21.12E",4))
+  ints(kmesh)
+  ints([nikpts])
+  floats(np.eye(3).ravel())
+  ints(np.array(coords).ravel())
+  ints([1 if real else 0 for real in isreal])
+  ints(np.zeros(9*48,dtype=int))
+  floats(np.full(nikpts,1./nikpts))
+  floats(np.sort(rng.uniform(-2,2,nevals)))
+  floats((rng.uniform(0,1,nevals)>0.5).astype(float))
+  for spin in range(nspin):
+    for coord,real in zip(coords,isreal):
+      ints(coord)
+      if real: floats(rng.uniform(-1,1,nao*nao))
+      else:    floats(rng.uniform(-1,1,2*nao*nao))
+  with open(fname,'w') as outf:
+    outf.write(''.join(sections))
@@ -15,6 +15,8 @@ from variance import VarianceWriter,VarianceReader
 from linear import LinearWriter,LinearReader
 from dmc import DMCWriter,DMCReader
 from trialfunc import SlaterJastrow
+from workflow import Workflow
+import statestore
 import sys
 
 h2='\n'.join([
@@ -236,7 +238,7 @@ def mno_test():
   return jobs
 
 def run_tests():
-  ''' Choose which tests to run and execute `nextstep()`.'''
+  ''' Choose which tests to run and make one pass over them.'''
   jobs=[]
   jobs+=h2_test_local()
   jobs+=h2_test_PBS()
@@ -244,8 +246,11 @@ def run_tests():
   jobs+=si_pyscf_test()
   jobs+=mno_test()
 
-  for job in jobs:
-    job.nextstep()
+  # Managers only advance once their dependencies are done. Use flow.run() to loop until completion.
+  flow=Workflow(jobs)
+  states=flow.step()
+  print("Manager states:",flow.summary(states))
+  print("State file writes this pass:",statestore.default_store.stats())
 
 if __name__=='__main__':
   run_tests()
@@ -0,0 +1,43 @@
+'''
+Tests of how bundles are planned, with managers that only have what the bundler looks at.
+
+Run from the repository: python3 -m pytest tests/test_bundler.py
+'''
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import runtimedb
+from autorunner import FakeRunner
+from bundler import Bundler
+
+class DMCWriter:
+  qmc_abr='dmc'
+  trialfunc=''
+
+class DMCManager:
+  def __init__(self,name,walltime='10:00:00'):
+    self.name=name
+    self.path='./'
+    self.writer=DMCWriter()
+    self.runner=FakeRunner()
+    self.runner.nn=1
+    self.runner.np='allprocs'
+    self.runner.walltime=walltime
+    self.bundle_ready=True
+    self.scriptfile=name+'.run'
+
+#------------------------------------------------
+def test_estimates_come_from_runtime_db(tmp_path):
+  db=runtimedb.RuntimeDB(str(tmp_path/'runtimes.db'))
+  bundler=Bundler(walltime='10:00:00',db=db)
+  mgr=DMCManager('dmc_0')
+  assert bundler.estimate(mgr)==36000.0
+
+  db.record('qwalk:dmc',{},3600.0,1,'allprocs',path='./',name='dmc_1')
+  db.record('qwalk:dmc',{},3600.0,1,'allprocs',path='./',name='dmc_2')
+  assert abs(bundler.estimate(mgr)-3600.0)<1e-6
+  # A new database object on the same file sees the runs.
+  assert abs(Bundler(db=runtimedb.RuntimeDB(str(tmp_path/'runtimes.db'))).estimate(mgr)-3600.0)<1e-6
+
+  bundler.estimates={'qwalk:dmc':60.0}
+  assert bundler.estimate(mgr)==60.0
@@ -0,0 +1,73 @@
+'''
+Tests of how managers save their state, with runners that don't need a queue.
+
+Run from the repository: python3 -m pytest tests/test_managers.py
+The managers need autopaths.py (written by setup.py); without it these tests are skipped.
+'''
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import pytest
+pytest.importorskip('autopaths')
+from autorunner import FakeRunner
+from qwalkmanager import QWalkManager
+from variance import VarianceWriter,VarianceReader
+import statestore
+
+class QueuedRunner(FakeRunner):
+  ''' Runner of a job that stays in the queue.'''
+  def __init__(self):
+    FakeRunner.__init__(self)
+    self.queueid=['1']
+
+  def check_status(self):
+    return 'running'
+
+class TrialFunction:
+  ''' Stands in for the manager of a finished trial wave function.'''
+  def export(self,path):
+    return 'include qw.sys\ntrialfunc { }'
+
+def make_manager(store,options={}):
+  return QWalkManager(VarianceWriter(options),VarianceReader(),runner=QueuedRunner(),trialfunc=TrialFunction(),
+      name='var',path='var',store=store)
+
+#------------------------------------------------
+def test_store_indexes_run_status(tmp_path,monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  store=statestore.SQLiteStore(str(tmp_path/'autogen.db'))
+  make_manager(store).nextstep()
+  found=store.query(status='running')
+  assert [(name,status) for path,name,kind,status,completed,queueid in found]==[('var','running')]
+  assert store.query(status='done')==[]
+
+#------------------------------------------------
+def test_unchanged_queued_manager_is_not_saved(tmp_path,monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  store=statestore.PickleStore()
+  mgr=make_manager(store)
+  mgr.nextstep()
+  infile=os.path.join('var',mgr.infile)
+  written=os.path.getmtime(infile)
+
+  # Another step in the same process, and one by a driver that's run again.
+  store.reset_stats()
+  mgr.nextstep()
+  make_manager(store).nextstep()
+  assert store.stats()['writes']==0
+  assert store.stats()['writes_avoided']==3
+  assert os.path.getmtime(infile)==written
+
+#------------------------------------------------
+def test_changed_writer_is_saved(tmp_path,monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  store=statestore.PickleStore()
+  make_manager(store).nextstep()
+
+  store.reset_stats()
+  # errtol may be changed without a rerun, but the input has to be written again.
+  mgr=make_manager(store,{'errtol':5})
+  mgr.nextstep()
+  assert store.stats()['writes']>0
+  assert mgr.writer.completed
+  assert store.load(mgr.path,mgr.name).writer.errtol==5
@@ -0,0 +1,75 @@
+'''
+Tests of the submission governor in submitter.py, with schedulers that don't need a queue.
+
+Run from the repository: python3 -m pytest tests/test_submitter.py
+'''
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import subprocess as sub
+import time
+import submitter
+import schedulers
+
+# Submissions tried. Schedulers are pickled into the governor's state file, so it's kept here.
+attempts=[]
+
+class BrokenScheduler(schedulers.LocalScheduler):
+  ''' Refuses every submission, like qsub past a per-user limit.'''
+  def submit(self,scriptfile,cwd=None):
+    attempts.append(scriptfile)
+    raise sub.CalledProcessError(1,'qsub')
+
+#------------------------------------------------
+def test_dropped_submission_raises_once(tmp_path):
+  gov=submitter.SubmissionGovernor(statefile=str(tmp_path/'gov.pkl'),backoff=0.0,maxbackoff=0.0,maxattempts=3)
+  del attempts[:]
+  scheduler=BrokenScheduler()
+  qid=gov.submit(scheduler,'job.sh',cwd=str(tmp_path))
+  assert qid.startswith('pending:')
+
+  raised=0
+  for attempt in range(6):
+    try:
+      gov.status(scheduler,[qid])
+    except submitter.SubmissionError:
+      raised+=1
+  assert raised==1
+  assert len(attempts)==3
+
+  # The failure is forgotten in the state file too, so another governor doesn't raise it again.
+  other=submitter.SubmissionGovernor(statefile=str(tmp_path/'gov.pkl'))
+  assert other.status(scheduler,[qid])=='unknown'
+  assert len(attempts)==3
+
+#------------------------------------------------
+def test_shared_statefile_ids_are_unique(tmp_path):
+  statefile=str(tmp_path/'gov.pkl')
+  scheduler=BrokenScheduler()
+  first=submitter.SubmissionGovernor(maxjobs=1,statefile=statefile,backoff=100.0)
+  second=submitter.SubmissionGovernor(maxjobs=1,statefile=statefile,backoff=100.0)
+  ids=[first.submit(scheduler,'a.sh',cwd=str(tmp_path)),second.submit(scheduler,'b.sh',cwd=str(tmp_path)),
+      first.submit(scheduler,'c.sh',cwd=str(tmp_path))]
+  assert len(set(ids))==3
+
+#------------------------------------------------
+def test_array_waits_for_room(tmp_path):
+  gov=submitter.SubmissionGovernor(maxjobs=1,statefile=str(tmp_path/'gov.pkl'))
+  scheduler=schedulers.LocalScheduler()
+  with open(str(tmp_path/'first.sh'),'w') as f:
+    f.write('sleep 0.5\n')
+  with open(str(tmp_path/'array.sh'),'w') as f:
+    f.write('touch element_%s\n'%scheduler.array_index)
+  first=gov.submit(scheduler,'first.sh',cwd=str(tmp_path))
+  array=gov.submit(scheduler,'array.sh',cwd=str(tmp_path),njobs=2)
+  assert array.startswith('pending:')
+  elements=[gov.array_element(scheduler,array,index) for index in range(2)]
+  assert gov.status(scheduler,elements[1:])=='running'
+  assert not os.path.exists(str(tmp_path/'element_1'))
+
+  scheduler.wait([first],timeout=10)
+  for attempt in range(200):
+    if gov.status(scheduler,elements)!='running': break
+    time.sleep(0.05)
+  assert os.path.exists(str(tmp_path/'element_0'))
+  assert os.path.exists(str(tmp_path/'element_1'))
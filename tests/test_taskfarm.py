@@ -0,0 +1,42 @@
+'''
+Tests of the task farm launcher, run in the test process instead of an allocation.
+
+Run from the repository: python3 -m pytest tests/test_taskfarm.py
+'''
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import json
+import taskfarm
+import manager_tools
+
+class FarmRunner:
+  ''' Runner whose last job was the task farm.'''
+  def __init__(self,queueid):
+    self.queueid=[queueid]
+    self.asked=0
+
+  def check_status(self):
+    self.asked+=1
+    return 'unknown'
+
+class Reader:
+  completed=False
+
+#------------------------------------------------
+def test_skipped_task_has_a_record(tmp_path,monkeypatch):
+  monkeypatch.setenv('AG_JOBID','local7')
+  with open(str(tmp_path/'wide.run'),'w') as f:
+    f.write('exit 0\n')
+  with open(str(tmp_path/'farm.tasks'),'w') as f:
+    json.dump({'nodes':1,'ppn':2,'walltime':60,'poll':0.05,'tasks':[
+        {'path':str(tmp_path),'script':'wide.run','name':'wide','nodes':2,'cores':2,'estimate':1.0}]},f)
+  assert taskfarm.Launcher(str(tmp_path/'farm.tasks')).run()==1
+
+  record=taskfarm.read_record(str(tmp_path/'wide.run'))
+  assert record['state']=='E' and record['skipped']
+  runner=FarmRunner('local7')
+  status=manager_tools.resolve_status(runner,Reader(),str(tmp_path/'wide.out'),str(tmp_path/'wide.run'))
+  assert status=='not_started'
+  assert runner.asked==0
+  assert 'stale' not in taskfarm.read_record(str(tmp_path/'wide.run'))
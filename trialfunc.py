@@ -8,6 +8,10 @@ class TrialFunction:
   def export(self):
     raise NotImplementedError("All trial functions must have export function defined.")
 
+  def dependencies(self):
+    ''' Managers whose results are needed to export this trial function (see `workflow.py`).'''
+    return []
+
 #######################################################################
 class SlaterJastrow(TrialFunction):
   def __init__(self,slatman,jastman=None,kpoint=0):
@@ -29,6 +33,16 @@ class SlaterJastrow(TrialFunction):
 
     self.kpoint=kpoint
 
+  #------------------------------------------------
+  def dependencies(self):
+    ''' Managers whose results are needed to export this trial function.
+    Returns:
+      list: slatman and jastman (once if they're the same).
+    '''
+    if self.jastman is self.slatman:
+      return [self.slatman]
+    return [self.slatman,self.jastman]
+
   #------------------------------------------------
   def export(self,qmcpath):
     ''' Export the wavefunction section for this trial wave function.
@@ -43,14 +57,27 @@ class SlaterJastrow(TrialFunction):
     # Ensure files are correctly generated.
     if not (self.slatman.export_qwalk() and self.jastman.export_qwalk()):
       return ''
+    return self._section(qmcpath,self.jastman.path+self.jastman.qwfiles['jastrow2'])
 
+  #------------------------------------------------
+  def export_chained(self,qmcpath):
+    ''' Export the wavefunction section before jastman has finished, using the Jastrow file jastman
+    will produce. For running jastman and this trial function in one job (see `stagechain.py`).
+    Returns:
+      str: system and wave fumction section for QWalk. Empty string if the Slater determinant isn't ready.
+    '''
+    if not self.slatman.export_qwalk():
+      return ''
+    return self._section(qmcpath,self.jastman.path+"%s.jast"%self.jastman.infile)
+
+  #------------------------------------------------
+  def _section(self,qmcpath,jastrow):
     if type(self.slatman.qwfiles['slater'])==str:
       slater=self.slatman.qwfiles['slater']
       sys=self.slatman.qwfiles['sys']
     else:
       slater=self.slatman.qwfiles['slater'][self.kpoint]
       sys=self.slatman.qwfiles['sys'][self.kpoint]
-    jastrow=self.jastman.qwfiles['jastrow2']
 
     # There may be a use case for these two to be different, but I want to check the first time this happens. 
     # You can have weird bugs if you use different system files for each wave function term, I think.
@@ -64,7 +91,7 @@ class SlaterJastrow(TrialFunction):
         'include %s'%os.path.relpath(self.slatman.path+sys,qmcpath),
         'trialfunc { slater-jastrow ',
         '  wf1 { include %s }'%os.path.relpath(self.slatman.path+slater,qmcpath),
-        '  wf2 { include %s }'%os.path.relpath(self.slatman.path+jastrow,qmcpath),
+        '  wf2 { include %s }'%os.path.relpath(jastrow,qmcpath),
         '}'
       ]
     return '\n'.join(outlines)
@@ -57,9 +57,13 @@ class VarianceReader:
     Attributes:
       output (dict): Results for energy, error, and other information.
       completed (bool): Whether no more runs are needed.
+      segments (list): outputs of earlier attempts, when restarts continue from the last wave function.
+        `output` then holds the steps of all the attempts, and the tests apply to all of them.
     '''
     self.output={}
     self.completed=False
+    self.segments=[]
+    self.last_segment=None
 
     self.vartol=vartol
     self.vardifftol=vardifftol
@@ -91,7 +95,7 @@ class VarianceReader:
       return False
     if (self.output['sigma'][-1]-self.output['sigma'][-2]) > self.vardifftol:
       print(self.__class__.__name__,": Variance optimize incomplete: change in variance (%f) less than tolerance (%f)"%\
-          (self.output['sigma'],self.vardifftol))
+          (self.output['sigma'][-1]-self.output['sigma'][-2],self.vardifftol))
       return False
     return True
           
@@ -107,8 +111,12 @@ class VarianceReader:
     # Gather output from files.
     status='unknown'
     if os.path.exists(outfile):
-      self.output=self.read_outputfile(outfile)
-      self.output['file']=outfile
+      self.last_segment=self.read_outputfile(outfile)
+      self.last_segment['file']=outfile
+      self.output=dict(self.last_segment)
+      # Steps of earlier attempts come first.
+      self.output['sigma']=sum([seg['sigma'] for seg in self.segments],[])+self.output['sigma']
+      self.output['attempts']=len(self.segments)+1
 
     # Check files.
     self.completed=self.check_complete()
@@ -118,6 +126,12 @@ class VarianceReader:
       status='ok'
     return status
 
+  #------------------------------------------------
+  def checkpoint(self):
+    ''' Keep the last attempt, before restarting from its wave function.'''
+    self.segments.append(self.last_segment)
+    self.last_segment=None
+
   #------------------------------------------------
   def write_summary(self):
     print("#### Variance optimization")
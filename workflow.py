@@ -0,0 +1,213 @@
+''' Drive a set of managers to completion, respecting the dependencies between them.
+
+The dependencies come from the trial functions of the managers (see `TrialFunction.dependencies`).
+Each manager is a node in a directed acyclic graph, and is in one of the states:
+  done: completed, and its files are exported if other managers depend on it.
+  blocked: some manager it depends on is not done.
+  running: its job is in the queue.
+  ready: anything else; `nextstep` (or `export_qwalk` for managers others depend on) is called.
+  error: raised an exception this pass (reported after the pass; other managers carry on).
+Blocked managers are never touched, so upstream managers are only advanced once per pass
+instead of once per downstream consumer.
+Before a manager is advanced, its runners get a priority: the number of managers downstream of it.
+When `submitter.governor` holds jobs back, the jobs that unblock the most work (e.g. the SCF
+everything else needs) are then submitted ahead of leaf jobs like DMC.
+'''
+import time
+import statestore
+from executor import ManagerExecutor
+
+#######################################################################
+def _key(mgr):
+  return mgr.path+mgr.name
+
+#######################################################################
+def _exported(mgr):
+  ''' Whether a manager has made the files that its consumers need (see the `export_qwalk` methods).'''
+  if 'slater' in mgr.qwfiles:
+    return len(mgr.qwfiles['slater'])>0
+  return mgr.qwfiles.get('wfout','')!=''
+
+#######################################################################
+class Workflow:
+  ''' Dependency graph of managers.'''
+  def __init__(self,managers=(),store=None):
+    '''
+    Args:
+      managers (list): managers to run. Managers they depend on are added automatically.
+      store (store object): store the managers save to, used for reporting writes (None implies statestore.default_store).
+    '''
+    self.nodes={}
+    self.deps={}
+    self.consumers={}
+    self.order=[]
+    self.errors={}
+    if store is None: self.store=statestore.default_store
+    else: self.store=store
+    for mgr in managers:
+      self.add(mgr)
+
+  #------------------------------------------------
+  def add(self,mgr):
+    ''' Add a manager and (recursively) the managers its trial function depends on.
+    Returns:
+      str: key (path+name) of the node.
+    '''
+    key=_key(mgr)
+    if key in self.nodes:
+      return key
+    self.nodes[key]=mgr
+    self.deps[key]=[]
+    self.consumers.setdefault(key,[])
+    trialfunc=getattr(mgr,'trialfunc',None)
+    if trialfunc is not None:
+      for dep in trialfunc.dependencies():
+        depkey=self.add(dep)
+        if depkey not in self.deps[key]:
+          self.deps[key].append(depkey)
+          self.consumers.setdefault(depkey,[]).append(key)
+    self.order=self._toposort()
+    return key
+
+  #------------------------------------------------
+  def _toposort(self):
+    ''' Order the nodes so that every manager comes after the managers it depends on.'''
+    ndeps=dict([(key,len(deps)) for key,deps in self.deps.items()])
+    order=[]
+    front=sorted([key for key in ndeps if ndeps[key]==0])
+    while len(front)>0:
+      key=front.pop(0)
+      order.append(key)
+      for con in self.consumers[key]:
+        ndeps[con]-=1
+        if ndeps[con]==0: front.append(con)
+    if len(order)!=len(self.nodes):
+      raise ValueError("Dependencies of managers form a cycle: %s"%
+          ', '.join(sorted(set(self.nodes)-set(order))))
+    return order
+
+  #------------------------------------------------
+  def descendants(self,key):
+    ''' Managers that depend on a node, directly or through other managers.'''
+    found=set()
+    front=list(self.consumers[key])
+    while len(front)>0:
+      con=front.pop()
+      if con not in found:
+        found.add(con)
+        front+=self.consumers[con]
+    return found
+
+  #------------------------------------------------
+  def _prioritize(self,key):
+    ''' Set the submission priority of a manager's runners (see module docstring).'''
+    mgr=self.nodes[key]
+    priority=len(self.descendants(key))
+    for attr in ('runner','prunner'):
+      runner=getattr(mgr,attr,None)
+      if runner is not None: runner.priority=priority
+
+  #------------------------------------------------
+  def state(self,key,states=None):
+    ''' State of a node (see module docstring).
+    Args:
+      key (str): node.
+      states (dict): states already determined this pass, to avoid checking dependencies twice.
+    Returns:
+      str: 'done', 'blocked', 'running', or 'ready'.
+    '''
+    if states is None: states={}
+    mgr=self.nodes[key]
+    for dep in self.deps[key]:
+      if dep not in states: states[dep]=self.state(dep,states)
+      if states[dep]!='done':
+        return 'blocked'
+    if mgr.completed and (len(self.consumers[key])==0 or _exported(mgr)):
+      return 'done'
+    if mgr.runner.check_status()=='running':
+      return 'running'
+    return 'ready'
+
+  #------------------------------------------------
+  def states(self):
+    ''' States of all nodes, without doing anything.
+    Returns:
+      dict: key to state.
+    '''
+    states={}
+    for key in self.order:
+      states[key]=self.state(key,states)
+    return states
+
+  #------------------------------------------------
+  def step(self,executor=None):
+    ''' One pass over the graph, advancing each ready manager once.
+
+    Ready managers don't depend on each other, so they're advanced together by the executor.
+    Managers that become ready as a result are advanced in the same pass.
+    Args:
+      executor (ManagerExecutor): how to advance managers (None implies one at a time).
+    Returns:
+      dict: key to state at the end of the pass. Managers that raised an exception are in state 'error'.
+    '''
+    if executor is None: executor=ManagerExecutor(nworkers=1)
+    self.store.reset_stats()
+    self.errors={}
+    advanced=set()
+    while True:
+      states=self.states()
+      ready=[key for key in self.order if states[key]=='ready' and key not in advanced]
+      if len(ready)==0: break
+      calls=[]
+      for key in ready:
+        self._prioritize(key)
+        if len(self.consumers[key])>0: calls.append((self.nodes[key],'export_qwalk'))
+        else:                          calls.append((self.nodes[key],'nextstep'))
+      self.errors.update(executor.run(calls))
+      advanced.update(ready)
+    for key in self.errors:
+      states[key]='error'
+    return states
+
+  #------------------------------------------------
+  def summary(self,states):
+    ''' Count of nodes in each state.'''
+    counts={'done':0,'running':0,'ready':0,'blocked':0,'error':0}
+    for state in states.values():
+      counts[state]+=1
+    return counts
+
+  #------------------------------------------------
+  def run(self,poll=60.0,maxpasses=None,executor=None):
+    ''' Step until every manager is done.
+
+    Stops early if a pass saves no manager state, changes no node state, and no job is running,
+    since further passes can't help (for example, a manager has exhausted its restarts).
+    Args:
+      poll (float): seconds to wait between passes.
+      maxpasses (int): stop after this many passes (None implies no limit).
+      executor (ManagerExecutor): how to advance managers (None implies one at a time).
+    Returns:
+      dict: key to state after the last pass.
+    '''
+    npass=0
+    laststates=None
+    while True:
+      states=self.step(executor)
+      npass+=1
+      counts=self.summary(states)
+      print(self.__class__.__name__,": pass %d:"%npass,
+          ', '.join(["%d %s"%(counts[s],s) for s in ('done','running','ready','blocked','error')]),
+          "; state writes:",self.store.stats())
+      if counts['done']==len(self.nodes):
+        print(self.__class__.__name__,": all managers done.")
+        break
+      if counts['running']==0 and states==laststates and self.store.stats()['writes']==0:
+        print(self.__class__.__name__,": no progress and nothing running. Human intervention required for:",
+            ', '.join([key for key in self.order if states[key] in ('ready','error')]))
+        break
+      if maxpasses is not None and npass>=maxpasses:
+        break
+      laststates=states
+      time.sleep(poll)
+    return states